@@ -0,0 +1,56 @@
+'''
+    Digest of a config tree: SHA-256 of its indented sorted JSON text, as get_all_hashes computes it,
+    against the structural Merkle digest, from scratch and for a live config after a one value patch.
+
+    The config trees are the synthetic ones of bench_deserialize.py.
+
+    usage: python benchmarks/bench_config_digest.py [--depth 5] [--fanout 4] [--parameters 12] [--repeat 5]
+'''
+import argparse
+import hashlib
+import json
+import os
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(__file__),'..'))
+import bench_deserialize
+from bench_deserialize import best_of, synthetic_tree
+from server.config_store import LiveConfig
+from server.merkle import hexdigest
+
+def text_digest(document) -> str:
+    return hashlib.sha256(json.dumps(document, indent=4, sort_keys=True).encode('utf-8')).hexdigest()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--depth', type=int, default=5)
+    parser.add_argument('--fanout', type=int, default=4)
+    parser.add_argument('--parameters', type=int, default=12)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+    bench_deserialize.PARAMETERS = args.parameters
+
+    tree = synthetic_tree(args.depth, args.fanout)
+    live = LiveConfig('bench', tree)
+    live.digest()
+    #the deepest first child, its first parameter changes on every patch
+    path = '/children/0'*(args.depth - 1) + '/p0/value'
+    values = iter(range(10**9))
+    def patched_digest():
+        live.patch([{'op': 'replace', 'path': path, 'value': float(next(values))}])
+        return live.digest()
+
+    hashed = live.merkle.hashed
+    patched_digest()
+    assert live.digest() == hexdigest(live.document)
+    print(f'{len(json.dumps(tree))} bytes of JSON, depth {args.depth}, {live.merkle.hashed - hashed} nodes hashed again per patch')
+
+    text = best_of(args.repeat, lambda: text_digest(tree))
+    full = best_of(args.repeat, lambda: hexdigest(tree))
+    patched = best_of(args.repeat, patched_digest)
+    print(f'sha256 of JSON text   {text*1000:9.3f} ms')
+    print(f'merkle, from scratch  {full*1000:9.3f} ms   {text/full:7.2f}x')
+    print(f'merkle, after patch   {patched*1000:9.3f} ms   {text/patched:7.2f}x   patch included')
+
+if __name__ == '__main__':
+    main()
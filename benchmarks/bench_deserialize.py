@@ -0,0 +1,172 @@
+'''
+    Compares the former get_class_from_dict, which inspects every node of a config tree and asks every
+    new object for its requirements, with the Deserializer, which works that out once per classname.
+
+    stored is a repeat request answered from the ObjectStore, hashing the dict and unpickling a copy.
+
+    The config trees are synthetic: Assembly nodes holding Parameters and a list of child nodes,
+    --depth levels deep with --fanout children per node. Building the default requirements of a node
+    costs about as much as in the framework Configuration classes, a dict of every Parameter's requirements.
+
+    --chain also builds a tree of single children that many levels deep, beyond the recursion limit
+    the former implementation stops at.
+
+    usage: python benchmarks/bench_deserialize.py [--depth 5] [--fanout 4] [--parameters 12] [--repeat 5] [--chain 5000]
+'''
+import argparse
+import os
+import sys
+import time
+
+sys.path.append(os.path.join(os.path.dirname(__file__),'..'))
+from server.deserialize import Deserializer
+from server.object_store import ObjectStore
+
+PARAMETERS = 12
+
+class Parameter():
+    name = 'Parameter'
+
+    def __init__(self) -> None:
+        self.value = 0.0
+        self.units = 'mm'
+        self.allowed_types = ['float']
+        self.description = 'synthetic parameter'
+
+    @property
+    def requirements(self) -> dict:
+        return {'classname': 'Parameter', 'value': self.value, 'units': self.units,
+                'allowed_types': list(self.allowed_types), 'description': self.description}
+
+class Assembly():
+    name = 'Assembly'
+
+    def __init__(self) -> None:
+        for index in range(PARAMETERS):
+            setattr(self, f'p{index}', Parameter())
+        self.label = ''
+        self.children = []
+
+    @property
+    def requirements(self) -> dict:
+        requirements = {'classname': 'Assembly', 'label': self.label, 'children': [c.requirements for c in self.children]}
+        for index in range(PARAMETERS):
+            requirements[f'p{index}'] = getattr(self, f'p{index}').requirements
+        return requirements
+
+CLASSES = {'Parameter': Parameter, 'Assembly': Assembly}
+
+def str_to_class(classname:str) -> type:
+    return CLASSES[classname]
+
+def synthetic_tree(depth:int, fanout:int) -> dict:
+    node = {'classname': 'Assembly', 'label': f'depth {depth}',
+            'children': [synthetic_tree(depth-1, fanout) for _ in range(fanout)] if depth > 1 else []}
+    for index in range(PARAMETERS):
+        node[f'p{index}'] = {'classname': 'Parameter', 'value': float(index), 'units': 'mm', 'allowed_types': ['float']}
+    return node
+
+#The former query implementation, without the dependency and Dynamic branches the synthetic tree never reaches
+def legacy_create_parameter_from_dict(parameter_dict, parameter=None):
+    if parameter is None:
+        parameter = str_to_class('Parameter')()
+    primitives = ['str', 'float', 'int','bool']
+    requirements = parameter.requirements
+    for key in parameter_dict:
+        if key in requirements:
+            if parameter_dict[key].__class__.__name__ in primitives:
+                value_type = 'primitive'
+            elif parameter_dict[key].__class__.__name__ == 'list':
+                if len(parameter_dict[key]) > 0:
+                    if all([v.__class__.__name__ in primitives for v in parameter_dict[key]]):
+                        value_type = 'list of primitives'
+                    else:
+                        value_type = 'list of objects'
+                else:
+                    value_type = 'primitive'
+            else:
+                value_type = 'object'
+            if value_type == 'primitive' or value_type == 'list of primitives':
+                setattr(parameter,key,parameter_dict[key])
+            elif value_type == 'object':
+                setattr(parameter, key, legacy_get_class_from_dict(parameter_dict[key]))
+            elif value_type == 'list of objects':
+                setattr(parameter, key, [v if v.__class__.__name__ in primitives else legacy_get_class_from_dict(v) for v in parameter_dict[key]])
+    return parameter
+
+def legacy_get_class_from_dict(parameter_dict:dict):
+    cls = str_to_class(parameter_dict['classname'])()
+    requirements = cls.requirements
+    for key in parameter_dict:
+        if key in requirements:
+            parameter = None
+            if parameter_dict[key].__class__.__name__ == 'dict':
+                if parameter_dict[key]['classname'] == 'Parameter':
+                    default_parameter = getattr(cls,key)
+                    if default_parameter.__class__.__name__ == 'Parameter':
+                        parameter = legacy_create_parameter_from_dict(parameter_dict[key], parameter=default_parameter)
+                else:
+                    parameter = legacy_get_class_from_dict(parameter_dict[key])
+            elif parameter_dict[key].__class__.__name__ == 'list':
+                parameter = [legacy_get_class_from_dict(v) if v.__class__.__name__ == 'dict' else v for v in parameter_dict[key]]
+            else:
+                parameter = parameter_dict[key]
+            if parameter is not None: setattr(cls, key, parameter)
+    return cls
+
+def chain_tree(depth:int) -> dict:
+    root = node = {'classname': 'Assembly', 'children': []}
+    for _ in range(depth - 1):
+        child = {'classname': 'Assembly', 'children': []}
+        node['children'].append(child)
+        node = child
+    return root
+
+def best_of(repeat:int, func) -> float:
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+def main():
+    global PARAMETERS
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--depth', type=int, default=5)
+    parser.add_argument('--fanout', type=int, default=4)
+    parser.add_argument('--parameters', type=int, default=12)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--chain', type=int, default=5000, help='depth of the single child tree, 0 to skip it')
+    args = parser.parse_args()
+    PARAMETERS = args.parameters
+
+    tree = synthetic_tree(args.depth, args.fanout)
+    nodes = sum(args.fanout**level for level in range(args.depth))
+    deserializer = Deserializer(str_to_class, lambda obj, dependencies: None)
+
+    legacy = legacy_get_class_from_dict(tree)
+    planned = deserializer.build(tree)
+    assert legacy.requirements == planned.requirements
+
+    old = best_of(args.repeat, lambda: legacy_get_class_from_dict(tree))
+    new = best_of(args.repeat, lambda: deserializer.build(tree))
+    store = ObjectStore()
+    store.get(tree, deserializer.build)
+    stored = best_of(args.repeat, lambda: store.get(tree, deserializer.build))
+    print(f'{nodes} nodes, {nodes*args.parameters} parameters, depth {args.depth}')
+    print(f'legacy   {old*1000:9.1f} ms')
+    print(f'planned  {new*1000:9.1f} ms   {old/new:5.2f}x')
+    print(f'stored   {stored*1000:9.1f} ms   {old/stored:5.2f}x   copy from the object store, {store.bytes} bytes kept')
+
+    if args.chain:
+        chain = chain_tree(args.chain)
+        print(f'\n{args.chain} nodes deep, recursion limit {sys.getrecursionlimit()}')
+        try:
+            print(f'legacy   {best_of(1, lambda: legacy_get_class_from_dict(chain))*1000:9.1f} ms')
+        except RecursionError:
+            print('legacy   RecursionError')
+        print(f'planned  {best_of(1, lambda: deserializer.build(chain))*1000:9.1f} ms')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+'''
+    Sequential against parallel layer generation (server/layers.py) with a synthetic toolpath generator
+    implementing the parallel methods. Every layer costs --work iterations of CPU time and writes its own
+    G-code file, the merge writes the program file from the layer results. Checks that both modes write
+    byte-identical files and return the same result.
+
+    usage: python benchmarks/bench_layers.py [--layers 32] [--work 200000] [--workers 4]
+'''
+import argparse
+import filecmp
+import math
+import os
+import sys
+import tempfile
+import time
+
+sys.path.append(os.path.join(os.path.dirname(__file__),'..'))
+from server.layers import generate_layers
+
+class SyntheticGenerator():
+    name = 'Synthetic Generator'
+
+    def __init__(self, layers:int, work:int) -> None:
+        self.layers = layers
+        self.work = work
+
+    def plan_layers(self, **kwargs) -> list[int]:
+        return list(range(self.layers))
+
+    def generateLayer(self, layer:int, output_dir:str, return_precision:int = 3, **kwargs) -> dict:
+        total = 0.0
+        for i in range(self.work):
+            total += math.sin(layer + i*1e-3)
+        moves = [f'G1 X{round(math.cos(layer + i), return_precision)} Y{round(total/(i + 1), return_precision)}' for i in range(50)]
+        with open(os.path.join(output_dir, f'layer_{layer:04d}.gcode'), 'w') as gcode:
+            gcode.write('\n'.join(moves))
+        return {f'layer {layer}': {'moves': len(moves), 'checksum': round(total, return_precision)}}
+
+    def mergeLayers(self, results:list[dict], output_dir:str, **kwargs) -> dict:
+        merged = {}
+        for result in results:
+            merged.update(result)
+        with open(os.path.join(output_dir, 'program.gcode'), 'w') as program:
+            program.write('\n'.join(f'; {key} {value["checksum"]}' for key, value in merged.items()))
+        return merged
+
+    def generateAllLayers(self, **kwargs) -> dict:
+        return self.mergeLayers([self.generateLayer(layer, **kwargs) for layer in self.plan_layers(**kwargs)], **kwargs)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--layers', type=int, default=32)
+    parser.add_argument('--work', type=int, default=200000)
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    args = parser.parse_args()
+
+    generator = SyntheticGenerator(args.layers, args.work)
+    with tempfile.TemporaryDirectory() as sequential_dir, tempfile.TemporaryDirectory() as parallel_dir:
+        start = time.perf_counter()
+        sequential = generate_layers(generator, 0, output_dir=sequential_dir, return_precision=3)
+        sequential_time = time.perf_counter() - start
+        start = time.perf_counter()
+        parallel = generate_layers(generator, args.workers, output_dir=parallel_dir, return_precision=3)
+        parallel_time = time.perf_counter() - start
+
+        files = sorted(os.listdir(sequential_dir))
+        _, mismatch, errors = filecmp.cmpfiles(sequential_dir, parallel_dir, files, shallow=False)
+        identical = sequential == parallel and files == sorted(os.listdir(parallel_dir)) and not mismatch and not errors
+
+    print(f'{args.layers} layers, {args.workers} workers')
+    print(f'sequential  {sequential_time:8.2f} s')
+    print(f'parallel    {parallel_time:8.2f} s   {sequential_time/parallel_time:5.2f}x')
+    print(f'output      {"identical" if identical else "DIFFERENT"} ({len(files)} files)')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+'''
+    Compares the old double encoding of query results with splicing RawJSON into the response envelope.
+
+    old: the query returns orjson.dumps(result).decode(), the server dumps the envelope holding that string
+         and the client parses the envelope, then parses the value string again
+    new: the query returns RawJSON, the server splices it into the envelope and the client parses once
+
+    usage: python benchmarks/bench_raw_json.py [--layers 200] [--points 5000] [--repeat 5]
+'''
+import argparse
+import os
+import random
+import sys
+import time
+
+import orjson
+
+sys.path.append(os.path.join(os.path.dirname(__file__),'..'))
+from server.framing import RawJSON, dumps
+
+def synthetic_toolpath(layers:int, points:int) -> dict:
+    '''
+        Roughly the shape of a generateAllLayers result: per layer coordinate lists and a few details
+    '''
+    rnd = random.Random(0)
+    return {f'layer_{i}': {'X': [round(rnd.uniform(-100,100),3) for _ in range(points)],
+                           'Y': [round(rnd.uniform(-100,100),3) for _ in range(points)],
+                           'Z': [round(i*0.2,3)]*points,
+                           'details': {'index': i, 'speed': 20.0, 'material': 'ink'}}
+            for i in range(layers)}
+
+def best_of(repeat:int, func) -> float:
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--layers', type=int, default=200)
+    parser.add_argument('--points', type=int, default=5000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    result = synthetic_toolpath(args.layers, args.points)
+    envelope = {'action': 'query.generate_toolpath_2', 'status': 'ok', 'uuid': 'bench'}
+
+    #the handler output, as the query module returns it
+    old_value = orjson.dumps(result, option=orjson.OPT_SERIALIZE_NUMPY).decode()
+    new_value = RawJSON.dumps(result)
+
+    #the part the server runs on the event loop for every response
+    def old_envelope():
+        return orjson.dumps({**envelope, 'value': old_value}, option=orjson.OPT_SERIALIZE_NUMPY).decode()
+
+    def new_envelope():
+        return dumps({**envelope, 'value': new_value}).decode()
+
+    old_message = old_envelope()
+    new_message = new_envelope()
+    assert orjson.loads(orjson.loads(old_message)['value']) == orjson.loads(new_message)['value']
+
+    rows = [
+        ('envelope', best_of(args.repeat, old_envelope), best_of(args.repeat, new_envelope)),
+        ('client decode', best_of(args.repeat, lambda: orjson.loads(orjson.loads(old_message)['value'])),
+                          best_of(args.repeat, lambda: orjson.loads(new_message)['value'])),
+    ]
+    print(f'{args.layers} layers x {args.points} points')
+    print(f'message size: old {len(old_message)/1e6:.2f} MB, new {len(new_message)/1e6:.2f} MB')
+    for name, old, new in rows:
+        print(f'{name:<14} old {old*1000:8.1f} ms   new {new*1000:8.1f} ms   {old/new:5.2f}x')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,110 @@
+'''
+    Cold start report for the websocket server: how long importing the query module takes when every
+    framework module is imported up front (the former star imports) and when classes are imported
+    lazily through the class registry.
+
+    Every measurement runs in a fresh interpreter:
+        eager         imports every module of the class packages, as the star imports in server/query.py did
+        lazy          imports server.query with a warm registry cache file
+        lazy (cold)   the same without the registry cache file, so the source tree is scanned first
+        first class   lazy import followed by str_to_class(--classname), the first request paying for its module
+
+    usage: python benchmarks/import_report.py [--classname Mandrel] [--repeat 3] [--top 15] [--output report.json]
+'''
+import argparse
+import os
+import subprocess
+import sys
+
+import orjson
+
+sys.path.append(os.path.join(os.path.dirname(__file__),'..'))
+from server.class_registry import class_registry
+
+REPO = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+EAGER = '''
+import time, importlib
+start = time.perf_counter()
+for module in MODULES:
+    importlib.import_module(module)
+import server.query
+print(time.perf_counter() - start)
+'''
+
+LAZY = '''
+import time
+start = time.perf_counter()
+import server.query
+server.query.class_registry.load()
+print(time.perf_counter() - start)
+'''
+
+FIRST_CLASS = '''
+import time
+start = time.perf_counter()
+import server.query
+server.query.str_to_class(CLASSNAME)
+print(time.perf_counter() - start)
+'''
+
+def measure(code:str, repeat:int, clear_cache:bool = False) -> float:
+    times = []
+    for _ in range(repeat):
+        if clear_cache and os.path.exists(class_registry.cache_path): os.remove(class_registry.cache_path)
+        result = subprocess.run([sys.executable, '-c', code], cwd=REPO, capture_output=True, text=True)
+        if result.returncode != 0:
+            raise RuntimeError(result.stderr.strip().splitlines()[-1] if result.stderr.strip() else f'exit code {result.returncode}')
+        times.append(float(result.stdout.strip().splitlines()[-1]))
+    return min(times)
+
+def slowest_imports(code:str, top:int) -> list[tuple[str, float]]:
+    '''
+        Modules with the largest cumulative import time, from python -X importtime
+    '''
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], cwd=REPO, capture_output=True, text=True)
+    modules = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line: continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        modules.append((name.strip(), int(cumulative)/1e6))
+    return sorted(modules, key=lambda item: item[1], reverse=True)[:top]
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--classname', default='Mandrel', help='class asked for by the first request')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--top', type=int, default=15, help='slowest imports listed for each mode')
+    parser.add_argument('--output', default=None, help='write the report as JSON to this file')
+    args = parser.parse_args()
+
+    class_registry.load()
+    modules = sorted(set(class_registry.modules.values()))
+    eager = EAGER.replace('MODULES', repr(modules))
+    first_class = FIRST_CLASS.replace('CLASSNAME', repr(args.classname))
+
+    report = {'modules': len(modules), 'classes': len(class_registry.modules), 'seconds': {}, 'slowest': {}}
+    for mode, code, clear_cache in (('eager', eager, False), ('lazy (cold)', LAZY, True), ('lazy', LAZY, False),
+                                    ('first class', first_class, False)):
+        try:
+            report['seconds'][mode] = measure(code, args.repeat, clear_cache)
+        except RuntimeError as error:
+            print(f'{mode:<12} failed: {error}')
+            continue
+        report['slowest'][mode] = slowest_imports(code, args.top)
+
+    print(f'{report["classes"]} classes in {report["modules"]} modules')
+    for mode, seconds in report['seconds'].items():
+        print(f'{mode:<12} {seconds*1000:9.1f} ms')
+    if 'eager' in report['seconds'] and 'lazy' in report['seconds']:
+        print(f'lazy start is {report["seconds"]["eager"]/report["seconds"]["lazy"]:.1f}x faster')
+    for mode, slowest in report['slowest'].items():
+        print(f'\nslowest imports, {mode}')
+        for name, seconds in slowest:
+            print(f'  {seconds*1000:9.1f} ms  {name}')
+    if args.output:
+        with open(args.output, 'wb') as output:
+            output.write(orjson.dumps(report, option=orjson.OPT_INDENT_2))
+
+if __name__ == '__main__':
+    main()
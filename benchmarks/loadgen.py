@@ -0,0 +1,312 @@
+'''
+    Replays recorded websocket requests against an AppServer started on localhost and reports
+    throughput, per action latency and the peak memory of the server.
+
+    The recording is a JSONL file with one request per line: {"action": ..., "value": ..., "binary"?, "compress"?}.
+    Lines without an action are skipped. Requests are replayed in order, cycling through the file,
+    by --clients concurrent connections. With --rate the requests are scheduled at that many per second
+    over all clients and latency is measured from the scheduled time, so a server falling behind shows up
+    in the latency instead of silently lowering the offered load.
+
+    usage: python benchmarks/loadgen.py recording.jsonl [--clients 8] [--rate 200] [--duration 30]
+                                        [--workers 1] [--output results.json]
+'''
+import argparse
+import asyncio
+import itertools
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+import uuid as uuid_lib
+
+import orjson
+import websockets
+
+sys.path.append(os.path.join(os.path.dirname(__file__),'..'))
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+REPO = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+#statuses ending a request, every other frame of the same uuid is an intermediate one
+FINAL_STATUSES = ('ok', 'error', 'cancelled', 'done')
+
+def load_requests(path:str) -> tuple[list[dict], int]:
+    '''
+        Returns the recorded requests and the number of skipped lines
+    '''
+    requests, skipped = [], 0
+    with open(path, 'rb') as recording:
+        for line in recording:
+            if not line.strip(): continue
+            try:
+                request = orjson.loads(line)
+            except orjson.JSONDecodeError:
+                skipped += 1
+                continue
+            if not isinstance(request, dict) or 'action' not in request:
+                skipped += 1
+                continue
+            requests.append({key: request[key] for key in ('action', 'value', 'binary', 'compress') if key in request})
+    return requests, skipped
+
+def percentile(values:list[float], q:float) -> float:
+    if not values: return 0.0
+    values = sorted(values)
+    return values[min(len(values)-1, int(q*len(values)))]
+
+def serve(port:int, workers:int, process_workers:int | None):
+    '''
+        Runs the server under test, in its own process
+    '''
+    if workers > 1:
+        from server.cluster import Supervisor
+        Supervisor(workers=workers, port=port, process_workers=process_workers).run()
+    else:
+        from server.socket_server import AppServer
+        AppServer(port=port, process_workers=process_workers).run_server()
+
+def start_server(port:int, workers:int, process_workers:int | None, timeout:float = 120) -> subprocess.Popen:
+    command = [sys.executable, os.path.abspath(__file__), '--serve', '--port', str(port), '--workers', str(workers)]
+    if process_workers: command += ['--process-workers', str(process_workers)]
+    process = subprocess.Popen(command, cwd=REPO)
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f'Server exited with {process.returncode}')
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=1):
+                return process
+        except OSError:
+            time.sleep(0.2)
+    process.kill()
+    raise RuntimeError(f'Server did not listen on port {port} within {timeout} seconds')
+
+class MemorySampler():
+    name = 'Memory Sampler'
+    description = 'Tracks the peak resident memory of a process and all of its children'
+
+    def __init__(self, pid:int, interval:float = 0.25) -> None:
+        self.pid = pid
+        self.interval = interval
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self) -> int:
+        self._stop.set()
+        self._thread.join()
+        if self.peak == 0:
+            #sampling failed, the sum of the kernel's per process peaks is an upper bound
+            self.peak = self._high_water_mark()
+        return self.peak
+
+    def _pids(self) -> list[int]:
+        if psutil is not None:
+            try:
+                parent = psutil.Process(self.pid)
+                return [self.pid] + [child.pid for child in parent.children(recursive=True)]
+            except psutil.Error:
+                return []
+        #without psutil the process tree is read from /proc
+        children = {}
+        for entry in os.listdir('/proc'):
+            if not entry.isdigit(): continue
+            try:
+                with open(f'/proc/{entry}/stat') as stat:
+                    ppid = int(stat.read().rsplit(')', 1)[1].split()[1])
+            except (OSError, IndexError, ValueError):
+                continue
+            children.setdefault(ppid, []).append(int(entry))
+        pids, pending = [], [self.pid]
+        while pending:
+            pid = pending.pop()
+            pids.append(pid)
+            pending.extend(children.get(pid, []))
+        return pids
+
+    @staticmethod
+    def _status_kb(pid:int, field:str) -> int:
+        try:
+            with open(f'/proc/{pid}/status') as status:
+                for line in status:
+                    if line.startswith(field): return int(line.split()[1])*1024
+        except (OSError, ValueError):
+            pass
+        return 0
+
+    def _rss(self) -> int:
+        if psutil is not None:
+            total = 0
+            for pid in self._pids():
+                try:
+                    total += psutil.Process(pid).memory_info().rss
+                except psutil.Error:
+                    pass
+            return total
+        return sum(self._status_kb(pid, 'VmRSS:') for pid in self._pids())
+
+    def _high_water_mark(self) -> int:
+        if not os.path.isdir('/proc'): return 0
+        return sum(self._status_kb(pid, 'VmHWM:') for pid in self._pids())
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.peak = max(self.peak, self._rss())
+
+class LoadGenerator():
+    name = 'Load Generator'
+    description = 'Replays requests from concurrent websocket clients and collects per action latencies'
+
+    def __init__(self, url:str, requests:list[dict], clients:int, rate:float | None, duration:float | None, count:int | None) -> None:
+        '''
+            rate -> requests per second over all clients, as fast as the server answers when None
+            duration / count -> stop after this many seconds / requests, whichever comes first
+        '''
+        self.url = url
+        self.requests = requests
+        self.clients = clients
+        self.rate = rate
+        self.duration = duration
+        self.count = count
+        self.latencies: dict[str, list[float]] = {}
+        self.errors: dict[str, int] = {}
+        self.response_bytes = 0
+        self.sent = 0
+
+    def _next(self, schedule, start:float):
+        '''
+            Index and scheduled send time of the next request, None once the run is over.
+            Shared by all clients, so requests are replayed in recorded order
+        '''
+        index = next(schedule)
+        if self.count is not None and index >= self.count: return None
+        scheduled = start + index/self.rate if self.rate else time.perf_counter()
+        if self.duration is not None and scheduled - start > self.duration: return None
+        return index, scheduled
+
+    async def _client(self, schedule, start:float):
+        async with websockets.connect(self.url, max_size=None, compression=None) as websocket:
+            while (item := self._next(schedule, start)) is not None:
+                index, scheduled = item
+                delay = scheduled - time.perf_counter()
+                if delay > 0: await asyncio.sleep(delay)
+                request = self.requests[index % len(self.requests)]
+                uuid = uuid_lib.uuid4().hex
+                await websocket.send(orjson.dumps({**request, 'uuid': uuid}).decode())
+                self.sent += 1
+                status = await self._receive(websocket, uuid)
+                latency = time.perf_counter() - scheduled
+                action = request['action']
+                self.latencies.setdefault(action, []).append(latency)
+                if status not in ('ok', 'done'): self.errors[action] = self.errors.get(action, 0) + 1
+
+    async def _receive(self, websocket, uuid:str) -> str:
+        '''
+            Reads frames until the final response of uuid and returns its status
+        '''
+        while True:
+            frame = await websocket.recv()
+            self.response_bytes += len(frame)
+            if isinstance(frame, bytes): continue
+            response = orjson.loads(frame)
+            if response.get('uuid') != uuid: continue
+            status = response.get('status')
+            if status == 'compressed':
+                #the deflated response follows as a binary frame
+                compressed = await websocket.recv()
+                self.response_bytes += len(compressed)
+                return 'ok'
+            if status in FINAL_STATUSES: return status
+
+    async def run(self) -> float:
+        schedule = itertools.count()
+        start = time.perf_counter()
+        await asyncio.gather(*[self._client(schedule, start) for _ in range(self.clients)])
+        return time.perf_counter() - start
+
+    def report(self, elapsed:float) -> dict:
+        actions = {}
+        for action, latencies in sorted(self.latencies.items()):
+            actions[action] = {'count': len(latencies), 'errors': self.errors.get(action, 0),
+                               'p50': percentile(latencies, 0.5), 'p99': percentile(latencies, 0.99),
+                               'mean': sum(latencies)/len(latencies), 'max': max(latencies)}
+        completed = sum(len(latencies) for latencies in self.latencies.values())
+        return {'elapsed': elapsed, 'completed': completed, 'errors': sum(self.errors.values()),
+                'throughput': completed/elapsed if elapsed else 0.0, 'response_bytes': self.response_bytes,
+                'actions': actions}
+
+def git_commit() -> str | None:
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=REPO, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('recording', nargs='?', help='JSONL file of recorded requests')
+    parser.add_argument('--clients', type=int, default=8)
+    parser.add_argument('--rate', type=float, default=None, help='requests per second over all clients')
+    parser.add_argument('--duration', type=float, default=30.0, help='seconds to run for')
+    parser.add_argument('--count', type=int, default=None, help='requests to send, instead of or together with --duration')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--workers', type=int, default=1, help='AppServer processes, more than one runs the cluster Supervisor')
+    parser.add_argument('--process-workers', type=int, default=None)
+    parser.add_argument('--url', default=None, help='replay against an already running server instead of starting one')
+    parser.add_argument('--output', default=None, help='write the results as JSON to this file')
+    parser.add_argument('--serve', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        serve(args.port, args.workers, args.process_workers)
+        return
+    if args.recording is None:
+        parser.error('a recording is required')
+
+    requests, skipped = load_requests(args.recording)
+    if not requests:
+        sys.exit(f'No requests with an action in {args.recording}')
+
+    server, sampler = None, None
+    url = args.url
+    if url is None:
+        server = start_server(args.port, args.workers, args.process_workers)
+        sampler = MemorySampler(server.pid)
+        sampler.start()
+        url = f'ws://127.0.0.1:{args.port}'
+    try:
+        generator = LoadGenerator(url, requests, args.clients, args.rate, args.duration, args.count)
+        elapsed = asyncio.run(generator.run())
+    finally:
+        peak_rss = sampler.stop() if sampler is not None else None
+        if server is not None:
+            server.terminate()
+            try:
+                server.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                server.kill()
+
+    results = {'commit': git_commit(), 'recording': os.path.basename(args.recording), 'recorded_requests': len(requests),
+               'skipped_lines': skipped, 'clients': args.clients, 'rate': args.rate, 'workers': args.workers,
+               'peak_rss_bytes': peak_rss, **generator.report(elapsed)}
+
+    print(f'{results["completed"]} requests in {elapsed:.1f} s from {args.clients} clients: '
+          f'{results["throughput"]:.1f} req/s, {results["errors"]} errors')
+    if peak_rss is not None: print(f'peak server RSS {peak_rss/1e6:.1f} MB')
+    for action, stats in results['actions'].items():
+        print(f'{action:<40} {stats["count"]:>7}  p50 {stats["p50"]*1000:9.2f} ms  p99 {stats["p99"]*1000:9.2f} ms  errors {stats["errors"]}')
+    if args.output:
+        with open(args.output, 'wb') as output:
+            output.write(orjson.dumps(results, option=orjson.OPT_INDENT_2))
+
+if __name__ == '__main__':
+    main()
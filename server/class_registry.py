@@ -0,0 +1,233 @@
+import ast
+import hashlib
+from importlib import import_module
+import os
+import sys
+import tempfile
+import threading
+
+import orjson
+
+#Repository root, the packages holding framework classes and the packages scanned for @route handlers
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+CLASS_PACKAGES = ('core', 'geometry', 'primitives', 'utils')
+ROUTE_PACKAGES = ('core', 'geometry', 'primitives', 'utils', 'server')
+CACHE_VERSION = 1
+
+def _default_cache_path() -> str:
+    root_key = hashlib.blake2b(ROOT.encode(), digest_size=8).hexdigest()
+    return os.path.join(tempfile.gettempdir(), f'framework_class_registry_{root_key}.json')
+
+def _base_name(node) -> str | None:
+    '''
+        Name of a base class as written in the class statement: Base, module.Base or Base[T]
+    '''
+    if isinstance(node, ast.Subscript): node = node.value
+    if isinstance(node, ast.Name): return node.id
+    if isinstance(node, ast.Attribute): return node.attr
+    return None
+
+def _route_name(decorator) -> str | None:
+    if not isinstance(decorator, ast.Call) or not decorator.args: return None
+    func = decorator.func
+    name = func.id if isinstance(func, ast.Name) else func.attr if isinstance(func, ast.Attribute) else None
+    if name != 'route': return None
+    arg = decorator.args[0]
+    return arg.value if isinstance(arg, ast.Constant) and isinstance(arg.value, str) else None
+
+def scan_source(path:str) -> dict:
+    '''
+        Top level classes with their base names, and the @route names, defined in a source file
+    '''
+    try:
+        with open(path, 'rb') as source:
+            tree = ast.parse(source.read(), filename=path)
+    except (OSError, SyntaxError, ValueError):
+        return {'classes': {}, 'routes': []}
+    classes, routes = {}, []
+    for node in tree.body:
+        if isinstance(node, ast.ClassDef):
+            classes[node.name] = [base for base in map(_base_name, node.bases) if base]
+        elif isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)):
+            routes.extend(name for name in map(_route_name, node.decorator_list) if name)
+    return {'classes': classes, 'routes': routes}
+
+def module_name(relative_path:str) -> str:
+    parts = relative_path[:-len('.py')].split(os.sep)
+    if parts[-1] == '__init__': parts = parts[:-1]
+    return '.'.join(parts)
+
+class ClassRegistry():
+    name = 'Class Registry'
+    description = 'Maps framework class names and route names to their modules, importing a module only when first needed'
+
+    def __init__(self, root:str = ROOT, class_packages:tuple[str, ...] = CLASS_PACKAGES, route_packages:tuple[str, ...] = ROUTE_PACKAGES,
+                 cache_path:str | None = None) -> None:
+        '''
+            root -> directory holding the packages
+            class_packages -> packages whose classes str_to_class can return
+            route_packages -> packages scanned for @route handlers
+            cache_path -> file keeping the scan between runs, invalidated by the mtime of every scanned file
+        '''
+        self.root = root
+        self.class_packages = class_packages
+        self.packages = tuple(dict.fromkeys(class_packages + route_packages))
+        self.cache_path = cache_path or _default_cache_path()
+        self.files: dict[str, dict] = {}
+        self.modules: dict[str, str] = {}
+        self.bases: dict[str, list[str]] = {}
+        self.children: dict[str, set[str]] = {}
+        self.routes: dict[str, str] = {}
+        #bumped every time the scan changes, so caches built from the class hierarchy know to rebuild
+        self.generation = 0
+        #bumped every time a module is first imported through the registry, it may define new subclasses
+        self.imports = 0
+        self.loaded = False
+        self.rescanned = 0
+        self._lock = threading.RLock()
+
+    def _source_files(self) -> dict[str, list[int]]:
+        files = {}
+        for package in self.packages:
+            for directory, subdirectories, filenames in os.walk(os.path.join(self.root, package)):
+                subdirectories[:] = [d for d in subdirectories if d != '__pycache__' and not d.startswith('.')]
+                for filename in filenames:
+                    if not filename.endswith('.py'): continue
+                    path = os.path.join(directory, filename)
+                    try:
+                        stat = os.stat(path)
+                    except OSError:
+                        continue
+                    files[os.path.relpath(path, self.root)] = [stat.st_mtime_ns, stat.st_size]
+        return files
+
+    def _read_cache(self) -> dict:
+        try:
+            with open(self.cache_path, 'rb') as cache_file:
+                cache = orjson.loads(cache_file.read())
+        except (OSError, orjson.JSONDecodeError):
+            return {}
+        if cache.get('version') != CACHE_VERSION or cache.get('root') != self.root: return {}
+        return cache.get('files', {})
+
+    def _write_cache(self):
+        cache = {'version': CACHE_VERSION, 'root': self.root, 'files': self.files}
+        temporary = f'{self.cache_path}.{os.getpid()}.tmp'
+        try:
+            with open(temporary, 'wb') as cache_file:
+                cache_file.write(orjson.dumps(cache))
+            os.replace(temporary, self.cache_path)
+        except OSError:
+            #the registry still works, the next start scans again
+            pass
+
+    def load(self, refresh:bool = False):
+        '''
+            Builds the registry from the cache file, scanning again only the files that changed
+        '''
+        with self._lock:
+            if self.loaded and not refresh: return
+            cached = self.files if self.loaded else self._read_cache()
+            files, dirty = {}, False
+            for path, stamp in self._source_files().items():
+                entry = cached.get(path)
+                if entry is None or entry['stamp'] != stamp:
+                    entry = {'stamp': stamp, 'module': module_name(path), **scan_source(os.path.join(self.root, path))}
+                    self.rescanned += 1
+                    dirty = True
+                files[path] = entry
+            if len(files) != len(cached): dirty = True
+            if self.loaded and not dirty: return
+            self.files = files
+            self._index()
+            self.loaded = True
+            self.generation += 1
+            if dirty: self._write_cache()
+
+    def _index(self):
+        modules, bases, children, routes = {}, {}, {}, {}
+        #a class defined in several modules resolves to the last module, as with the former star imports
+        for path in sorted(self.files):
+            entry = self.files[path]
+            if entry['module'].split('.')[0] not in self.class_packages: continue
+            for classname, class_bases in entry['classes'].items():
+                modules[classname] = entry['module']
+                bases[classname] = class_bases
+        for path in sorted(self.files):
+            for route in self.files[path]['routes']:
+                routes[route] = self.files[path]['module']
+        for classname, class_bases in bases.items():
+            for base in class_bases:
+                children.setdefault(base, set()).add(classname)
+        self.modules, self.bases, self.children, self.routes = modules, bases, children, routes
+
+    def module_of(self, classname:str) -> str | None:
+        self.load()
+        return self.modules.get(classname)
+
+    def get_class(self, classname:str):
+        '''
+            Imports the module defining classname and returns the class. Raises NameError for unknown classes
+        '''
+        module = self.module_of(classname)
+        if module is None:
+            raise NameError(f'Class "{classname}" does not exist.')
+        return getattr(self.import_module(module), classname)
+
+    def descendants(self, classname:str) -> set[str]:
+        '''
+            Names of every class deriving from classname, directly or not, according to the scan
+        '''
+        self.load()
+        found, pending = set(), [classname]
+        while pending:
+            for child in self.children.get(pending.pop(), ()):
+                if child not in found:
+                    found.add(child)
+                    pending.append(child)
+        return found
+
+    def import_descendants(self, classname:str):
+        '''
+            Imports the modules of every descendant so __subclasses__ walks see all of them
+        '''
+        for module in sorted({self.modules[name] for name in self.descendants(classname) if name in self.modules}):
+            self.import_module(module)
+
+    def import_route(self, action:str) -> bool:
+        '''
+            Imports the module registering the route action. Returns False if no scanned module does
+        '''
+        self.load()
+        module = self.routes.get(action)
+        if module is None: return False
+        self.import_module(module)
+        return True
+
+    def import_module(self, module:str):
+        '''
+            Imports module. Class and route modules are imported through here so caches of the class
+            hierarchy see the classes they create, see imports and classes_changed
+        '''
+        loaded = sys.modules.get(module)
+        if loaded is not None: return loaded
+        try:
+            return import_module(module)
+        finally:
+            #also counted when the import fails, the modules it imported before failing stay loaded
+            self.classes_changed()
+
+    def classes_changed(self):
+        '''
+            Tells the caches of the class hierarchy that classes were created. Code creating classes
+            without importing them through the registry calls it
+        '''
+        with self._lock:
+            self.imports += 1
+
+    def stats(self) -> dict:
+        return {'classes': len(self.modules), 'routes': len(self.routes), 'files': len(self.files),
+                'rescanned': self.rescanned, 'generation': self.generation, 'imports': self.imports}
+
+#Process wide registry, each worker process builds its own from the shared cache file
+class_registry = ClassRegistry()
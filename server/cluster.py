@@ -0,0 +1,278 @@
+'''
+    Runs several AppServer worker processes behind one host and port.
+
+    Every worker is a full AppServer with its own event loop, Router and ExecutionPool, so JSON parsing,
+    serialization and routing of different connections run on different cores. The kernel spreads new
+    connections over the workers, either through SO_REUSEPORT or a listening socket bound once here
+    and shared by every worker.
+
+    Jobs are shared by the workers through the jobs_dir they all use: a client that reconnects to another
+    worker can still follow, fetch and cancel its jobs. Everything else a client holds is kept by the worker
+    its connection landed on and needs that same connection, or one to the same worker:
+        live configs (config.* actions, {'config_id': ...} references)
+        requests in flight, cancelled by their uuid with the 'cancel' action
+
+    usage: python server/cluster.py [--workers 4] [--host 127.0.0.1] [--port 8000]
+    SIGHUP restarts the workers gracefully, retiring workers run their jobs to the end before they exit.
+    SIGINT / SIGTERM stop them, workers still running jobs drain_timeout seconds later are terminated
+'''
+import sys, os
+sys.path.append(os.path.join(os.path.dirname(__file__),'..'))
+import argparse
+import asyncio
+import multiprocessing
+import queue
+import signal
+import socket
+import threading
+import time
+import traceback
+
+from server.metrics import registry
+
+def _worker_main(server_kwargs:dict, worker_id:int, generation:int, sock, reuse_port:bool, health_queue, stop_event,
+                 health_interval:float, drain_timeout:float):
+    '''
+        Entry point of a worker process
+    '''
+    #the supervisor decides when workers stop, a Ctrl-C on the terminal reaches it as well
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    from server.socket_server import AppServer
+    server = AppServer(**server_kwargs)
+    asyncio.run(_serve_worker(server, worker_id, generation, sock, reuse_port, health_queue, stop_event, health_interval, drain_timeout))
+
+async def _serve_worker(server, worker_id:int, generation:int, sock, reuse_port:bool, health_queue, stop_event,
+                        health_interval:float, drain_timeout:float):
+    stop = asyncio.Event()
+    started = time.time()
+
+    async def wait_for_stop():
+        await asyncio.to_thread(stop_event.wait)
+        stop.set()
+
+    async def heartbeat():
+        while True:
+            health = {**server.health(), 'worker': worker_id, 'generation': generation, 'uptime': time.time() - started,
+                      'draining': stop.is_set()}
+            try:
+                health_queue.put_nowait(health)
+            except (queue.Full, OSError, ValueError):
+                pass
+            await asyncio.sleep(health_interval)
+
+    tasks = [asyncio.create_task(wait_for_stop()), asyncio.create_task(heartbeat())]
+    try:
+        await server._run_server(sock=sock, reuse_port=reuse_port, stop=stop, drain_timeout=drain_timeout)
+    finally:
+        for task in tasks:
+            task.cancel()
+        #releases the thread blocked in stop_event.wait
+        stop_event.set()
+
+class Worker():
+    name = 'Worker'
+    description = 'A worker process of the Supervisor and its last reported health'
+
+    def __init__(self, worker_id:int, generation:int, process, stop_event) -> None:
+        self.id = worker_id
+        self.generation = generation
+        self.process = process
+        self.stop_event = stop_event
+        self.health = None
+        self.last_seen = None
+
+    def stop(self):
+        '''
+            Asks the worker to stop accepting connections and drain
+        '''
+        self.stop_event.set()
+
+class Supervisor():
+    name = 'Supervisor'
+    description = 'Runs several AppServer worker processes on one host and port, restarts them gracefully and reports their health'
+
+    def __init__(self, workers:int | None = None, host:str = '127.0.0.1', port:int = 8000, reuse_port:bool | None = None,
+                 health_interval:float = 2.0, start_timeout:float = 120.0, drain_timeout:float = 60.0, **server_kwargs) -> None:
+        '''
+            workers -> number of AppServer processes, defaults to the number of cores
+            reuse_port -> bind every worker with SO_REUSEPORT, defaults to True where the platform has it.
+                          Otherwise the listening socket is bound here and shared by the workers
+            health_interval -> seconds between the heartbeats of every worker
+            start_timeout -> seconds a restart waits for the new workers before giving up on them
+            drain_timeout -> seconds a stopping worker waits for its requests in flight. A retiring worker runs
+                             its jobs to the end, on stop workers still running are terminated after drain_timeout + 10
+            server_kwargs -> passed to every AppServer. Each worker has its own execution pool, so
+                             process_workers defaults to the cores divided between the workers
+        '''
+        self.workers_count = workers or os.cpu_count() or 1
+        self.host = host
+        self.port = port
+        self.reuse_port = hasattr(socket, 'SO_REUSEPORT') if reuse_port is None else reuse_port
+        self.health_interval = health_interval
+        self.start_timeout = start_timeout
+        self.drain_timeout = drain_timeout
+        server_kwargs.setdefault('process_workers', max(1, (os.cpu_count() or 1)//self.workers_count))
+        self.server_kwargs = {'host': host, 'port': port, **server_kwargs}
+        self.context = multiprocessing.get_context('spawn')
+        self.health_queue = None
+        self.sock = None
+        self.generation = 0
+        self.workers: dict[int, Worker] = {}
+        self.retiring: list[Worker] = []
+        self.restarts = 0
+        self.replaced = 0
+        self.stopping = False
+        self._restart_requested = threading.Event()
+        registry.add_source('workers', self.stats)
+
+    def _bind(self) -> socket.socket:
+        sock = socket.create_server((self.host, self.port), backlog=1024)
+        sock.set_inheritable(True)
+        return sock
+
+    def _spawn(self, worker_id:int) -> Worker:
+        stop_event = self.context.Event()
+        process = self.context.Process(
+            target=_worker_main,
+            args=(self.server_kwargs, worker_id, self.generation, self.sock, self.reuse_port, self.health_queue, stop_event,
+                  self.health_interval, self.drain_timeout),
+            name=f'AppServer-{self.generation}-{worker_id}',
+            daemon=False)
+        process.start()
+        return Worker(worker_id, self.generation, process, stop_event)
+
+    def start(self):
+        if self.health_queue is not None: return
+        self.health_queue = self.context.Queue()
+        if not self.reuse_port: self.sock = self._bind()
+        self.generation += 1
+        self.workers = {worker_id: self._spawn(worker_id) for worker_id in range(self.workers_count)}
+
+    def restart(self):
+        '''
+            Graceful restart: a new generation of workers is started and the old workers only stop
+            accepting connections once every new worker has reported healthy, then drain and exit
+        '''
+        old = list(self.workers.values())
+        self.generation += 1
+        self.restarts += 1
+        self.workers = {worker_id: self._spawn(worker_id) for worker_id in range(self.workers_count)}
+        deadline = time.time() + self.start_timeout
+        while any(worker.health is None for worker in self.workers.values()):
+            if time.time() > deadline or any(not worker.process.is_alive() for worker in self.workers.values()):
+                #the new generation does not come up, keep the old one serving
+                for worker in self.workers.values():
+                    worker.stop()
+                self.retiring.extend(self.workers.values())
+                self.workers = {worker.id: worker for worker in old}
+                return False
+            self._read_health(timeout=0.1)
+        for worker in old:
+            worker.stop()
+        self.retiring.extend(old)
+        return True
+
+    def request_restart(self, *_):
+        self._restart_requested.set()
+
+    def _read_health(self, timeout:float):
+        try:
+            health = self.health_queue.get(timeout=timeout)
+        except queue.Empty:
+            return
+        while True:
+            worker = self.workers.get(health['worker'])
+            if worker is None or worker.generation != health['generation']:
+                worker = next((w for w in self.retiring if w.id == health['worker'] and w.generation == health['generation']), None)
+            if worker is not None:
+                worker.health = health
+                worker.last_seen = time.time()
+            try:
+                health = self.health_queue.get_nowait()
+            except queue.Empty:
+                return
+
+    def _check_workers(self):
+        '''
+            Replaces workers that died and forgets retired workers that finished draining
+        '''
+        for worker_id, worker in list(self.workers.items()):
+            if not worker.process.is_alive():
+                print(f'Worker {worker_id} (pid {worker.process.pid}) exited with {worker.process.exitcode}, restarting', flush=True)
+                self.workers[worker_id] = self._spawn(worker_id)
+                self.replaced += 1
+        for worker in list(self.retiring):
+            if not worker.process.is_alive():
+                worker.process.join()
+                self.retiring.remove(worker)
+
+    def health(self) -> dict:
+        '''
+            Last reported health of every worker by worker id. A worker is stale when it missed three heartbeats
+        '''
+        now = time.time()
+        report = {}
+        for worker in list(self.workers.values()) + list(self.retiring):
+            key = str(worker.id) if worker in self.workers.values() else f'{worker.id}_retiring_{worker.generation}'
+            report[key] = {**(worker.health or {}), 'alive': worker.process.is_alive(),
+                           'stale': worker.last_seen is None or now - worker.last_seen > 3*self.health_interval}
+        return report
+
+    def stats(self) -> dict:
+        return {'workers': len(self.workers), 'retiring': len(self.retiring), 'generation': self.generation,
+                'restarts': self.restarts, 'replaced': self.replaced, **self.health()}
+
+    def stop(self):
+        self.stopping = True
+        workers = list(self.workers.values()) + self.retiring
+        for worker in workers:
+            worker.stop()
+        for worker in workers:
+            worker.process.join(self.drain_timeout + 10)
+            if worker.process.is_alive(): worker.process.terminate()
+        self.workers = {}
+        self.retiring = []
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+    def run(self):
+        '''
+            Starts the workers and supervises them until SIGINT or SIGTERM
+        '''
+        def shutdown(*_):
+            raise KeyboardInterrupt
+        signal.signal(signal.SIGTERM, shutdown)
+        if hasattr(signal, 'SIGHUP'):
+            signal.signal(signal.SIGHUP, self.request_restart)
+        self.start()
+        try:
+            while True:
+                self._read_health(timeout=0.5)
+                if self._restart_requested.is_set():
+                    self._restart_requested.clear()
+                    print(f'Restarting workers, generation {self.generation+1}', flush=True)
+                    if not self.restart(): print('New workers failed to start, keeping the running ones', flush=True)
+                self._check_workers()
+        except KeyboardInterrupt:
+            pass
+        except Exception:
+            print(traceback.format_exc())
+        finally:
+            self.stop()
+
+if __name__ == '__main__':
+    import server.http_server as http_server
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--http-port', type=int, default=8001)
+    args = parser.parse_args()
+
+    #the http server of the supervisor reports the health of every worker on /metrics
+    http_server_thread = threading.Thread(target=http_server.run, args=(args.http_port,), daemon=True)
+    http_server_thread.start()
+
+    supervisor = Supervisor(workers=args.workers, host=args.host, port=args.port, allowed_clients=[args.host], logging=True)
+    supervisor.run()
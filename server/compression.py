@@ -0,0 +1,101 @@
+import time
+import zlib
+
+from websockets.extensions.permessage_deflate import PerMessageDeflate, ServerPerMessageDeflateFactory
+from websockets.frames import CTRL_OPCODES, OP_CONT
+
+DEFLATE = 'deflate'
+#Metrics label of the frames deflated by the permessage-deflate extension
+PERMESSAGE_DEFLATE = 'permessage-deflate'
+
+class CompressionPolicy():
+    name = 'Compression Policy'
+    description = 'Decides which response frames are deflated, and how hard, for clients that ask for compression'
+
+    def __init__(self, min_size:int = int(1000*32), level:int = 6, min_saving:float = 0.1, negotiate:bool = True) -> None:
+        '''
+            min_size -> frames smaller than this many bytes are sent as is, deflating them costs more than it saves
+            level -> zlib level, 1 is fastest, 9 is smallest
+            min_saving -> a deflated frame is only sent when it is at least this fraction smaller
+            negotiate -> accept the permessage-deflate websocket extension for clients offering it, as browsers do.
+                         The extension follows this policy too, see PolicyDeflate, but compresses on the event loop.
+                         The 'compress' request flag is ignored on its connections. False leaves compression to
+                         the clients sending 'compress'
+        '''
+        if not 0 <= level <= 9:
+            raise ValueError(f'Compression level must be between 0 and 9, got {level}')
+        self.min_size = min_size
+        self.level = level
+        self.min_saving = min_saving
+        self.negotiate = negotiate
+
+    def should_compress(self, nbytes:int) -> bool:
+        return self.level > 0 and nbytes >= self.min_size
+
+    def worthwhile(self, nbytes:int, compressed:int) -> bool:
+        return compressed <= nbytes*(1 - self.min_saving)
+
+    def extension(self, observe) -> ServerPerMessageDeflateFactory:
+        '''
+            Factory of the permessage-deflate extension following this policy.
+            observe -> observe(nbytes, compressed, seconds) called for every message the extension deflates
+        '''
+        return PolicyDeflateFactory(self, observe)
+
+    def deflate(self, data) -> tuple[bytes, float]:
+        '''
+            Compresses a frame, returns the compressed bytes and the CPU seconds spent.
+            Runs in a worker thread, zlib releases the GIL while compressing
+        '''
+        start = time.thread_time()
+        compressed = zlib.compress(data, self.level)
+        return compressed, time.thread_time() - start
+
+class PolicyDeflate(PerMessageDeflate):
+    '''
+        permessage-deflate following a CompressionPolicy. Messages below min_size, and messages deflating by less
+        than min_saving, are sent as they are: RFC 7692 lets the sender leave any message uncompressed.
+        Every message is deflated on its own (server_no_context_takeover) so a discarded attempt leaves no trace
+        in the compressor, and connections hold no compressor between messages
+    '''
+
+    def __init__(self, policy:CompressionPolicy, observe, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.policy = policy
+        self.observe = observe
+        #the first frame of the fragmented message being sent was deflated, so are its continuation frames
+        self.encode_cont_data = False
+
+    def encode(self, frame):
+        if frame.opcode in CTRL_OPCODES: return frame
+        if frame.opcode is OP_CONT:
+            if not self.encode_cont_data: return frame
+            if frame.fin: self.encode_cont_data = False
+            return super().encode(frame)
+        if not self.policy.should_compress(len(frame.data)): return frame
+        start = time.thread_time()
+        encoded = super().encode(frame)
+        seconds = time.thread_time() - start
+        self.observe(len(frame.data), len(encoded.data), seconds)
+        #a fragmented message is deflated whole once its first frame is
+        if not frame.fin:
+            self.encode_cont_data = True
+        elif not self.policy.worthwhile(len(frame.data), len(encoded.data)):
+            return frame
+        return encoded
+
+class PolicyDeflateFactory(ServerPerMessageDeflateFactory):
+    '''
+        Negotiates PolicyDeflate with clients offering permessage-deflate, at the zlib level of the policy
+    '''
+
+    def __init__(self, policy:CompressionPolicy, observe) -> None:
+        super().__init__(server_no_context_takeover=True, compress_settings={'level': policy.level})
+        self.policy = policy
+        self.observe = observe
+
+    def process_request_params(self, params, accepted_extensions):
+        response_params, extension = super().process_request_params(params, accepted_extensions)
+        return response_params, PolicyDeflate(self.policy, self.observe, extension.remote_no_context_takeover,
+                                              extension.local_no_context_takeover, extension.remote_max_window_bits,
+                                              extension.local_max_window_bits, extension.compress_settings)
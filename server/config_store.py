@@ -0,0 +1,487 @@
+from collections import OrderedDict
+import pickle
+import threading
+import uuid as uuid_lib
+
+from server.merkle import MerkleTree
+
+#Patches kept since the base document before it is compacted, workers further behind rebuild from the new base
+MAX_LOG = 64
+#Depth of a request value searched for config references, references sit in the value, a part/setup wrapper or a list of them
+REF_DEPTH = 4
+REF_KEYS = frozenset(('config_id', 'version'))
+
+def _default_deserializer():
+    from server.query import deserializer
+    return deserializer
+
+def parse_pointer(pointer:str) -> list[str]:
+    '''
+        Tokens of a JSON Pointer (RFC 6901), '' points to the whole document
+    '''
+    if not isinstance(pointer, str):
+        raise ValueError(f'JSON Pointer must be a string, got {pointer!r}')
+    if pointer == '': return []
+    if not pointer.startswith('/'):
+        raise ValueError(f'JSON Pointer "{pointer}" must start with "/"')
+    return [token.replace('~1', '/').replace('~0', '~') for token in pointer[1:].split('/')]
+
+def _list_index(items:list, token:str, adding:bool = False) -> int:
+    if adding and token == '-': return len(items)
+    if not token.isdigit() or (len(token) > 1 and token[0] == '0'):
+        raise ValueError(f'"{token}" is not a valid list index')
+    index = int(token)
+    if index > len(items) or (index == len(items) and not adding):
+        raise ValueError(f'list index {index} is out of range')
+    return index
+
+def _get(document, tokens:list[str]):
+    node = document
+    for token in tokens:
+        if type(node) is dict:
+            if token not in node: raise ValueError(f'path "/{"/".join(tokens)}" does not exist')
+            node = node[token]
+        elif type(node) is list:
+            node = node[_list_index(node, token)]
+        else:
+            raise ValueError(f'path "/{"/".join(tokens)}" does not exist')
+    return node
+
+def _copy_to_parent(document, tokens:list[str]):
+    '''
+        Shallow copies every container from the root down to the parent of tokens.
+        Returns the new root and the copied parent, every other container is shared with document
+    '''
+    root = parent = document.copy() if type(document) in (dict, list) else document
+    for token in tokens[:-1]:
+        if type(parent) is dict:
+            if token not in parent: raise ValueError(f'path "/{"/".join(tokens)}" does not exist')
+            child = parent[token]
+        elif type(parent) is list:
+            token = _list_index(parent, token)
+            child = parent[token]
+        else:
+            raise ValueError(f'path "/{"/".join(tokens)}" does not exist')
+        if type(child) not in (dict, list):
+            raise ValueError(f'path "/{"/".join(tokens)}" does not exist')
+        child = parent[token] = child.copy()
+        parent = child
+    if type(parent) not in (dict, list):
+        raise ValueError(f'path "/{"/".join(tokens)}" does not exist')
+    return root, parent
+
+def _add(document, tokens:list[str], value):
+    if not tokens: return value
+    root, parent = _copy_to_parent(document, tokens)
+    if type(parent) is dict:
+        parent[tokens[-1]] = value
+    else:
+        parent.insert(_list_index(parent, tokens[-1], adding=True), value)
+    return root
+
+def _remove(document, tokens:list[str]):
+    if not tokens: raise ValueError('the whole document cannot be removed')
+    root, parent = _copy_to_parent(document, tokens)
+    if type(parent) is dict:
+        if tokens[-1] not in parent: raise ValueError(f'path "/{"/".join(tokens)}" does not exist')
+        del parent[tokens[-1]]
+    else:
+        del parent[_list_index(parent, tokens[-1])]
+    return root
+
+def apply_operation(document, operation:dict):
+    '''
+        Applies one JSON Patch (RFC 6902) operation. document is never modified, the containers on the
+        changed path are copied and everything else is shared. Returns the new document and the paths
+        whose value changed, as token lists
+    '''
+    if not isinstance(operation, dict) or 'op' not in operation or 'path' not in operation:
+        raise ValueError(f'JSON Patch operation must hold "op" and "path", got {operation!r}')
+    op = operation['op']
+    path = parse_pointer(operation['path'])
+    if op in ('add', 'replace', 'test') and 'value' not in operation:
+        raise ValueError(f'JSON Patch "{op}" operation requires a "value"')
+    if op == 'add':
+        return _add(document, path, operation['value']), [path]
+    if op == 'remove':
+        return _remove(document, path), [path]
+    if op == 'replace':
+        if not path: return operation['value'], [path]
+        root, parent = _copy_to_parent(document, path)
+        if type(parent) is dict:
+            if path[-1] not in parent: raise ValueError(f'path "{operation["path"]}" does not exist')
+            parent[path[-1]] = operation['value']
+        else:
+            parent[_list_index(parent, path[-1])] = operation['value']
+        return root, [path]
+    if op == 'test':
+        if _get(document, path) != operation['value']:
+            raise ValueError(f'JSON Patch test failed at "{operation["path"]}"')
+        return document, []
+    if op in ('move', 'copy'):
+        if 'from' not in operation:
+            raise ValueError(f'JSON Patch "{op}" operation requires a "from"')
+        source = parse_pointer(operation['from'])
+        value = _get(document, source)
+        if op == 'copy':
+            return _add(document, path, value), [path]
+        if path[:len(source)] == source and path != source:
+            raise ValueError('a value cannot be moved into one of its children')
+        if path == source: return document, []
+        return _add(_remove(document, source), path, value), [source, path]
+    raise ValueError(f'Unknown JSON Patch operation "{op}"')
+
+def apply_patch(document, operations:list):
+    '''
+        Applies a JSON Patch. All or nothing, document is left as it was if an operation fails
+    '''
+    if not isinstance(operations, list):
+        raise ValueError('a JSON Patch must be a list of operations')
+    for operation in operations:
+        document, _ = apply_operation(document, operation)
+    return document
+
+def is_ref(value) -> bool:
+    '''
+        True for a reference to a live config, {'config_id'} with an optional 'version'
+    '''
+    return type(value) in (dict, ConfigRef) and 'config_id' in value and value.keys() <= REF_KEYS
+
+class ConfigRef(dict):
+    '''
+        A reference pinned to one version of a live config, {'config_id', 'version'}.
+        It carries the base document and the patches since, so a worker process that holds an older
+        version of the config catches up by applying only the patches it has not seen
+    '''
+
+    def __init__(self, config_id:str, version:int, base, base_version:int, patches:list) -> None:
+        super().__init__(config_id=config_id, version=version)
+        self.base = base
+        self.base_version = base_version
+        self.patches = patches
+
+class LiveConfig():
+    name = 'Live Config'
+    description = 'A config document held by id with the object graph built from it, both updated in place by JSON Patches'
+
+    def __init__(self, config_id:str, document:dict, version:int = 0, deserializer = None) -> None:
+        '''
+            config_id -> id clients refer to the config by
+            document -> config dict as sent to get_class_from_dict, never modified afterwards
+            version -> version of document, incremented by every patch
+            deserializer -> Deserializer building the objects, defaults to the one of server.query
+        '''
+        self.config_id = config_id
+        self.document = document
+        self.version = version
+        self.base = document
+        self.base_version = version
+        self.log: list[list] = []
+        self.deserializer = deserializer
+        self.obj = None
+        self.snapshot = None
+        self.merkle = MerkleTree()
+        self.incremental = 0
+        self.rebuilt = 0
+        self._lock = threading.RLock()
+
+    def objects(self):
+        '''
+            The live object graph, built on first use. Callers must not modify it, see copy
+        '''
+        with self._lock:
+            if self.obj is None:
+                if self.deserializer is None: self.deserializer = _default_deserializer()
+                self.obj = self.deserializer.build(self.document)
+                self.rebuilt += 1
+            return self.obj
+
+    def copy(self):
+        '''
+            A private copy of the object graph. Handlers modify the objects they get (activeSetup, offsets...),
+            so every request unpickles its own copy of a snapshot taken once per version
+        '''
+        with self._lock:
+            obj = self.objects()
+            if self.snapshot is None:
+                try:
+                    self.snapshot = pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL)
+                except Exception:
+                    #objects holding unpicklable state are built from the document every time
+                    self.snapshot = False
+            snapshot, document = self.snapshot, self.document
+        if snapshot is False:
+            return self.deserializer.build(document)
+        return pickle.loads(snapshot)
+
+    def digest(self) -> str:
+        '''
+            Structural digest of the document, only the paths changed since the last digest are hashed again
+        '''
+        with self._lock:
+            return self.merkle.hexdigest(self.document)
+
+    def ref(self) -> ConfigRef:
+        with self._lock:
+            return ConfigRef(self.config_id, self.version, self.base, self.base_version, list(self.log))
+
+    def patch(self, operations:list) -> int:
+        '''
+            Applies a JSON Patch to the document and the objects built from it, rebuilding only the
+            objects on the changed paths. All or nothing: a failing patch leaves the version unchanged
+        '''
+        if not isinstance(operations, list):
+            raise ValueError('a JSON Patch must be a list of operations')
+        with self._lock:
+            document = self.document
+            try:
+                for operation in operations:
+                    document, paths = apply_operation(document, operation)
+                    #dropping digests is safe even if a later operation fails, they are computed again
+                    for path in paths:
+                        self.merkle.invalidate(path)
+                    if self.obj is None: continue
+                    for path in paths:
+                        self._update(document, path)
+            except Exception:
+                #the objects may be half updated, they are built again from the unchanged document when next used
+                self.obj = None
+                raise
+            self.document = document
+            self.version += 1
+            self.snapshot = None
+            self.log.append(operations)
+            if len(self.log) > MAX_LOG:
+                self.base, self.base_version, self.log = self.document, self.version, []
+            return self.version
+
+    def _update(self, document:dict, path:list[str]):
+        '''
+            Brings the objects up to date with a change of the value at path. Walks down the objects along
+            path and rebuilds the key of the deepest object the change is confined to
+        '''
+        deserializer = self.deserializer
+        node, obj, owner = document, self.obj, None
+        index = 0
+        while index < len(path) and 'found_dependencies' not in node:
+            plan = deserializer.plan(node['classname'])
+            if plan.dynamic or type(obj) is not plan.cls: break
+            key = path[index]
+            if key in ('classname', 'found_dependencies') or key in deserializer.constants: break
+            #build ignores keys outside of the requirements
+            if key not in plan.keys: return
+            value = node.get(key)
+            index += 1
+            if index < len(path) and type(value) is dict and value.get('classname', 'Parameter') != 'Parameter':
+                owner = (obj, node, key, None)
+                node, obj = value, getattr(obj, key, None)
+                continue
+            if index + 1 < len(path) and type(value) is list and path[index].isdigit():
+                items, position = getattr(obj, key, None), int(path[index])
+                if (type(items) is list and len(items) == len(value) and position < len(value)
+                        and type(value[position]) is dict and value[position].get('classname', 'Parameter') != 'Parameter'):
+                    owner = (items, value, position, None)
+                    node, obj = value[position], items[position]
+                    index += 1
+                    continue
+            deserializer.rebuild(obj, node, key)
+            self.incremental += 1
+            return
+
+        #the change reaches an object that has to be built whole, replace it in its owner
+        if owner is None:
+            self.obj = deserializer.build(document)
+            self.rebuilt += 1
+        elif type(owner[0]) is list:
+            items, value, position, _ = owner
+            items[position] = deserializer.build(value[position])
+            self.incremental += 1
+        else:
+            parent, parent_node, key, _ = owner
+            deserializer.rebuild(parent, parent_node, key)
+            self.incremental += 1
+
+    def stats(self) -> dict:
+        return {'version': self.version, 'patches': len(self.log), 'incremental': self.incremental, 'rebuilt': self.rebuilt}
+
+class ConfigStore():
+    name = 'Config Store'
+    description = 'Live configs opened by clients, edited with JSON Patches and referred to by id in requests'
+
+    def __init__(self, max_configs:int = 64, deserializer = None) -> None:
+        '''
+            max_configs -> live configs kept, the least recently used is closed beyond it
+            deserializer -> Deserializer building the objects, defaults to the one of server.query
+        '''
+        self.max_configs = max_configs
+        self.deserializer = deserializer
+        self.configs: OrderedDict[str, LiveConfig] = OrderedDict()
+        self.patches = 0
+        self.evicted = 0
+        self._lock = threading.Lock()
+
+    def open(self, config:dict, config_id:str | None = None) -> LiveConfig:
+        '''
+            Builds the objects of config, raising if it is invalid, and keeps them under config_id.
+            Opening an id again replaces the config held under it
+        '''
+        if not isinstance(config, dict):
+            raise ValueError('config must be a config dict')
+        deserializer = self.deserializer or _default_deserializer()
+        live = LiveConfig(config_id or uuid_lib.uuid4().hex, config, deserializer=deserializer)
+        previous = self.configs.get(live.config_id)
+        if previous is not None: live.version = live.base_version = previous.version + 1
+        live.objects()
+        with self._lock:
+            self.configs[live.config_id] = live
+            self.configs.move_to_end(live.config_id)
+            while len(self.configs) > self.max_configs:
+                self.configs.popitem(last=False)
+                self.evicted += 1
+        return live
+
+    def get(self, config_id:str) -> LiveConfig:
+        with self._lock:
+            live = self.configs.get(config_id)
+            if live is None:
+                raise KeyError(f'Unknown config "{config_id}". It was closed or evicted, open it again')
+            self.configs.move_to_end(config_id)
+            return live
+
+    def patch(self, config_id:str, operations:list, version:int | None = None) -> LiveConfig:
+        '''
+            Applies a JSON Patch to a live config. version is the version the patch was made against,
+            the patch is refused if the config changed since
+        '''
+        live = self.get(config_id)
+        with live._lock:
+            if version is not None and version != live.version:
+                raise ValueError(f'Config "{config_id}" is at version {live.version}, the patch was made against version {version}')
+            #the objects validate the patch, they are built again first if a failed patch dropped them
+            live.objects()
+            live.patch(operations)
+        self.patches += 1
+        return live
+
+    def close(self, config_id:str) -> bool:
+        with self._lock:
+            return self.configs.pop(config_id, None) is not None
+
+    def pin(self, value):
+        '''
+            Replaces every config reference in a request value by a ConfigRef to the current version,
+            so the request uses the config as it is now whichever process runs it.
+            The request value itself is not modified
+        '''
+        if not self.configs: return value
+        return self._pin(value, REF_DEPTH)
+
+    def _pin(self, value, depth:int):
+        if type(value) is ConfigRef: return value
+        if is_ref(value):
+            live = self.get(value['config_id'])
+            ref = live.ref()
+            if value.get('version', ref['version']) != ref['version']:
+                raise ValueError(f'Config "{ref["config_id"]}" is at version {ref["version"]}, the request expects version {value["version"]}')
+            return ref
+        if depth == 0: return value
+        if type(value) is dict:
+            pinned = None
+            for key, item in value.items():
+                if type(item) not in (dict, list): continue
+                new_item = self._pin(item, depth-1)
+                if new_item is not item:
+                    if pinned is None: pinned = dict(value)
+                    pinned[key] = new_item
+            return value if pinned is None else pinned
+        if type(value) is list and value and type(value[0]) is dict:
+            pinned = [self._pin(item, depth-1) for item in value]
+            return value if all(new_item is item for new_item, item in zip(pinned, value)) else pinned
+        return value
+
+    def stats(self) -> dict:
+        with self._lock:
+            configs = list(self.configs.values())
+        return {'configs': len(configs), 'patches': self.patches, 'evicted': self.evicted,
+                'incremental': sum(live.incremental for live in configs), 'rebuilt': sum(live.rebuilt for live in configs)}
+
+class ConfigCache():
+    name = 'Config Cache'
+    description = 'Live configs of a worker process, caught up with the patches carried by the ConfigRefs it receives'
+
+    def __init__(self, max_configs:int = 16, deserializer = None) -> None:
+        self.max_configs = max_configs
+        self.deserializer = deserializer
+        self.configs: OrderedDict[str, LiveConfig] = OrderedDict()
+        self.hits = 0
+        self.caught_up = 0
+        self.rebuilt = 0
+        self._lock = threading.Lock()
+
+    def get(self, ref:ConfigRef) -> LiveConfig:
+        config_id, version = ref['config_id'], ref['version']
+        with self._lock:
+            live = self.configs.get(config_id)
+            if live is not None and live.version == version:
+                self.configs.move_to_end(config_id)
+                self.hits += 1
+                return live
+            if live is not None and ref.base_version <= live.version < version:
+                for operations in ref.patches[live.version - ref.base_version:]:
+                    live.patch(operations)
+                self.configs.move_to_end(config_id)
+                self.caught_up += 1
+                return live
+            fresh = LiveConfig(config_id, ref.base, ref.base_version, self.deserializer or _default_deserializer())
+            for operations in ref.patches:
+                fresh.patch(operations)
+            self.rebuilt += 1
+            #a request pinned before a newer version got here does not replace it
+            if live is None or live.version < version:
+                self.configs[config_id] = fresh
+                self.configs.move_to_end(config_id)
+                while len(self.configs) > self.max_configs:
+                    self.configs.popitem(last=False)
+            return fresh
+
+    def stats(self) -> dict:
+        return {'configs': len(self.configs), 'hits': self.hits, 'caught_up': self.caught_up, 'rebuilt': self.rebuilt}
+
+#Process wide store of the configs opened by clients, and the copies of them worker processes catch up with
+config_store = ConfigStore()
+config_cache = ConfigCache()
+
+def _live(ref:dict) -> LiveConfig:
+    if not isinstance(ref, ConfigRef):
+        #a reference that never went through ConfigStore.pin, only valid where the store lives
+        ref = config_store._pin(ref, 0)
+    live = config_store.configs.get(ref['config_id'])
+    if live is None or live.version != ref['version']:
+        live = config_cache.get(ref)
+    return live
+
+def resolve(ref:dict):
+    '''
+        A private copy of the objects of a referenced config, from the store of this process when it holds
+        the pinned version, otherwise from the config cache
+    '''
+    return _live(ref).copy()
+
+def digest(ref:dict) -> str:
+    '''
+        Structural digest of a referenced config, see LiveConfig.digest
+    '''
+    return _live(ref).digest()
+
+def contents(value, depth:int = REF_DEPTH):
+    '''
+        value with every live config reference replaced by {'config_digest'} of the config it points to,
+        so content keys of requests do not depend on config ids
+    '''
+    if is_ref(value): return {'config_digest': digest(value)}
+    if depth == 0: return value
+    if type(value) is dict:
+        return {key: contents(item, depth-1) if type(item) in (dict, list) else item for key, item in value.items()}
+    if type(value) is list and value and type(value[0]) is dict:
+        return [contents(item, depth-1) for item in value]
+    return value
@@ -0,0 +1,196 @@
+import threading
+
+from server.class_registry import class_registry
+
+PRIMITIVES = (str, float, int, bool)
+
+class ClassPlan():
+    name = 'Class Plan'
+    description = 'What the deserializer needs to know about a class, worked out once per class'
+
+    def __init__(self, cls:type) -> None:
+        instance = cls()
+        self.cls = cls
+        #keys accepted from a config dict, the requirements of the class
+        self.keys = frozenset(instance.requirements)
+        #keys whose default value is a Parameter, a Parameter dict for them updates that default
+        self.parameter_keys = frozenset(key for key in self.keys if getattr(instance, key, None).__class__.__name__ == 'Parameter')
+        #Dynamic classes validate keys they have no value for through evaluate_property
+        self.dynamic = 'Dynamic' in [base.__name__ for base in cls.__bases__]
+
+class Deserializer():
+    name = 'Deserializer'
+    description = 'Builds framework objects from config dicts using a cached plan per classname'
+
+    def __init__(self, str_to_class, update_with_dependencies, constants = (), registry = class_registry) -> None:
+        '''
+            str_to_class -> resolves a classname to its class
+            update_with_dependencies -> update_with_dependencies(obj, dependencies) for dicts holding 'found_dependencies'
+            constants -> keys of framework constants, a Parameter dict for them becomes a new Parameter
+            registry -> ClassRegistry whose generation invalidates the plans when the source tree changes
+        '''
+        self.str_to_class = str_to_class
+        self.update_with_dependencies = update_with_dependencies
+        self.constants = frozenset(constants)
+        self.registry = registry
+        self.plans: dict[str, ClassPlan] = {}
+        self.built = 0
+        self._generation = registry.generation
+        self._lock = threading.Lock()
+
+    def plan(self, classname:str) -> ClassPlan:
+        if self.registry.generation != self._generation:
+            with self._lock:
+                self.plans = {}
+                self._generation = self.registry.generation
+        plan = self.plans.get(classname)
+        cls = self.str_to_class(classname)
+        if plan is None or plan.cls is not cls:
+            plan = self.plans[classname] = ClassPlan(cls)
+        return plan
+
+    def build(self, data:dict):
+        '''
+            Creates the framework object described by data, with get_class_from_dict semantics
+        '''
+        return self._run(self._object(data))
+
+    def build_parameter(self, data:dict, parameter = None):
+        '''
+            Creates a Parameter from data, or updates parameter, with create_parameter_from_dict semantics
+        '''
+        return self._run(self._parameter(data, parameter))
+
+    def rebuild(self, obj, data:dict, key:str):
+        '''
+            Sets key of obj, an object built from data, to what build(data) would give it now.
+            Lets a live object take an edit of one key without building the rest of its tree again.
+            Not valid for Dynamic classes, constants or data holding found_dependencies, rebuild those whole
+        '''
+        plan = self.plan(data['classname'])
+        defaults = plan.cls()
+        if key in data and key in plan.keys:
+            if self._run(self._key(obj, plan, key, data[key], defaults)): return
+        #build would have left the key at the value of a new object
+        if hasattr(defaults, key):
+            setattr(obj, key, getattr(defaults, key))
+        elif key in obj.__dict__:
+            delattr(obj, key)
+
+    def _run(self, frame):
+        '''
+            Drives the build frames with an explicit stack instead of the Python call stack, so the depth
+            of a config tree is only limited by memory. A frame yields the frame of a nested object and is
+            resumed with the object built, or with the exception raised while building it
+        '''
+        stack = [frame]
+        value, error = None, None
+        while stack:
+            try:
+                child = stack[-1].send(value) if error is None else stack[-1].throw(error)
+            except StopIteration as done:
+                stack.pop()
+                value, error = done.value, None
+                continue
+            except Exception as e:
+                stack.pop()
+                if not stack: raise
+                value, error = None, e
+                continue
+            stack.append(child)
+            value, error = None, None
+        return value
+
+    def _object(self, data:dict):
+        if 'classname' not in data.keys():
+            raise Exception('ERROR:query.get_class_from_dict -- Provided dictionary does not include the required key "classname"')
+        try:
+            plan = self.plan(data['classname'])
+            obj = plan.cls()
+        except Exception:
+            raise Exception(f'ERROR:query.get_class_from_dict -- Could not create the class {data["classname"]}. Make sure this class exists and is visible to query imports.')
+        self.built += 1
+
+        for key, value in data.items():
+            if key in plan.keys: yield from self._key(obj, plan, key, value, obj)
+
+        #UPDATE with dependencies once, after all parameters have been set
+        if 'found_dependencies' in data:
+            self.update_with_dependencies(obj, data['found_dependencies'])
+        return obj
+
+    def _key(self, obj, plan:ClassPlan, key:str, value, defaults):
+        '''
+            Sets key of obj from its config value. A Parameter dict updates the default Parameter of defaults.
+            Returns False if key keeps the value obj was created with
+        '''
+        parameter = None
+        value_type = type(value)
+        #Determine if the key is a nested parameter or another framework Configuration class
+        if value_type is dict:
+            if 'classname' not in value:
+                raise Exception(f'The key "classname" must be provided at every level of the config tree. No classname key found for object {key}')
+            if value['classname'] != 'Parameter':
+                parameter = yield self._object(value)
+            elif key in plan.parameter_keys:
+                default_parameter = getattr(defaults, key)
+                if default_parameter.__class__.__name__ == 'Parameter':
+                    parameter = yield self._parameter(value, default_parameter)
+        elif value_type is list:
+            parameter = []
+            for item in value:
+                parameter.append((yield self._object(item)) if type(item) is dict else item)
+        else:
+            parameter = value
+
+        if parameter is not None:
+            setattr(obj, key, parameter)
+            return True
+        if key in self.constants:
+            if value_type is dict:
+                setattr(obj, key, (yield self._parameter(value, None)))
+                return True
+        elif plan.dynamic:
+            #Evaluate property method throws an exception if the value is invalid, invalid properties are ignored
+            try:
+                if value_type is dict and 'classname' in value:
+                    value = yield self._object(value)
+                verified_value = obj.evaluate_property(key, value)
+                if key not in obj.__dict__.keys():
+                    setattr(obj, key, verified_value)
+                    return True
+            except Exception:
+                pass
+        return False
+
+    def _parameter(self, data:dict, parameter):
+        if 'classname' not in data.keys():
+            raise Exception('Provided dictionary does not include the required key "classname"')
+        if data['classname'] != 'Parameter':
+            raise Exception('Provided dictionary is not of type "Parameter". Cannot create class from the provided arguments')
+        plan = self.plan('Parameter')
+        if parameter is None:
+            parameter = plan.cls()
+        self.built += 1
+
+        for key, value in data.items():
+            if key not in plan.keys: continue
+            value_type = type(value)
+            if value_type in PRIMITIVES:
+                setattr(parameter, key, value)
+            elif value_type is list:
+                #lists of primitives are kept as they are, objects mixed in with primitives are built
+                if all(type(item) in PRIMITIVES for item in value):
+                    setattr(parameter, key, value)
+                else:
+                    items = []
+                    for item in value:
+                        items.append(item if type(item) in PRIMITIVES else (yield self._object(item)))
+                    setattr(parameter, key, items)
+            else:
+                #check if the provided object is a valid framework class
+                setattr(parameter, key, (yield self._object(value)))
+        return parameter
+
+    def stats(self) -> dict:
+        return {'plans': len(self.plans), 'built': self.built}
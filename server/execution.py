@@ -0,0 +1,277 @@
+import asyncio
+import concurrent.futures
+from concurrent.futures.process import BrokenProcessPool
+import multiprocessing
+import os
+import signal
+
+from utils.decorators import route_handlers
+from server.class_registry import class_registry
+from server.object_store import object_store
+
+INLINE  = 'inline'  #runs on the event loop -- only for trivial handlers
+THREAD  = 'thread'  #runs in the thread pool -- I/O bound or GIL releasing handlers
+PROCESS = 'process' #runs in the warm process pool -- CPU heavy handlers
+EXECUTION_MODES = (INLINE, THREAD, PROCESS)
+
+def execution(mode:str):
+    '''
+        Marks a route handler with the execution mode the Router should use for it.
+        Place below @route so the registered handler carries the mark:
+
+            @route('query.generate_toolpath_2')
+            @execution(PROCESS)
+            def generate_toolpath_2(uuid, request): ...
+    '''
+    if mode not in EXECUTION_MODES:
+        raise ValueError(f'Unknown execution mode "{mode}". Expected one of {EXECUTION_MODES}')
+    def decorator(func):
+        func.execution_mode = mode
+        return func
+    return decorator
+
+def streaming(func):
+    '''
+        Marks a route handler that returns an iterable of chunks.
+        Every chunk is sent to the client as its own frame as soon as it is produced
+    '''
+    func.streaming = True
+    return func
+
+def _init_worker(object_store_bytes:int | None = None):
+    '''
+        Runs once in every process pool worker.
+        Workers are warmed in the background, so they import every route module up front
+        instead of paying for the import on their first request.
+        Every worker leads its own process group, holding the processes its handlers start.
+        object_store_bytes -> budget of the worker's own ObjectStore, its share of the pool's
+    '''
+    if hasattr(os, 'setpgid'): os.setpgid(0, 0)
+    if object_store_bytes is not None:
+        object_store.resize(object_store_bytes)
+    from server.routes import import_all
+    import_all()
+
+def _warm_up():
+    return os.getpid()
+
+def call_route(action:str, uuid:str, value):
+    '''
+        Calls the handler registered for action. Module level so it can be pickled into the process pool
+    '''
+    if action not in route_handlers: class_registry.import_route(action)
+    return route_handlers[action](uuid, value)
+
+class _EndOfStream():
+    '''
+        Marks the end of a stream. Compared by type because it crosses process boundaries
+    '''
+
+def stream_route(connection, window:int, action:str, uuid:str, value):
+    '''
+        Runs a streaming handler in a worker process and sends every chunk through connection.
+        At most window chunks are sent ahead of the ones the event loop acknowledged
+    '''
+    unacknowledged = 0
+    try:
+        for chunk in call_route(action, uuid, value):
+            #acknowledgements are read as they come so they never fill the pipe
+            while unacknowledged >= window or (unacknowledged and connection.poll()):
+                connection.recv()
+                unacknowledged -= 1
+            connection.send(chunk)
+            unacknowledged += 1
+        connection.send(_EndOfStream())
+    finally:
+        connection.close()
+
+class WorkerLane():
+    name = 'Worker Lane'
+    description = 'A single warm worker process. Killing it to cancel a job leaves every other worker running'
+
+    def __init__(self, context, object_store_bytes:int | None = None) -> None:
+        self.executor = concurrent.futures.ProcessPoolExecutor(max_workers=1, mp_context=context, initializer=_init_worker,
+                                                               initargs=(object_store_bytes,))
+        self.pid = self.executor.submit(_warm_up)
+        self.broken = False
+
+    def submit(self, fn, *args) -> asyncio.Future:
+        return asyncio.wrap_future(self.executor.submit(fn, *args))
+
+    def kill(self):
+        '''
+            Terminates the worker process with the processes it started, such as the layer workers of
+            server/layers.py. The lane is replaced by the pool afterwards
+        '''
+        self.broken = True
+        if self.pid.done() and not self.pid.cancelled() and self.pid.exception() is None:
+            try:
+                if hasattr(os, 'killpg'):
+                    os.killpg(self.pid.result(), signal.SIGTERM)
+                else:
+                    os.kill(self.pid.result(), signal.SIGTERM)
+            except OSError:
+                pass
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+class ExecutionPool():
+    name = 'Execution Pool'
+    description = 'Runs route handlers inline, in a thread pool or in warm worker processes'
+
+    def __init__(self, process_workers:int | None = None, thread_workers:int | None = None, stream_buffer:int = 8,
+                 object_store_bytes:int = int(1000000*128)) -> None:
+        '''
+            process_workers -> number of worker processes for PROCESS routes, defaults to the number of cores
+            thread_workers -> number of threads for THREAD routes, defaults to the ThreadPoolExecutor default
+            stream_buffer -> chunks a streaming PROCESS handler may produce ahead of the connection
+            object_store_bytes -> memory budget of the ObjectStores of the pool. Every worker process and the
+                                  server process, running INLINE and THREAD routes, keep their own store,
+                                  so each gets an equal share of it
+        '''
+        self.process_workers = process_workers or os.cpu_count() or 1
+        self.thread_workers = thread_workers
+        self.stream_buffer = stream_buffer
+        self.object_store_bytes = object_store_bytes
+        self.lane_object_store_bytes = object_store_bytes//(self.process_workers + 1)
+        self.context = multiprocessing.get_context('spawn')
+        self.lanes: set[WorkerLane] = set()
+        self.idle_lanes = None
+        self.thread_pool = None
+        self.threads_busy = 0
+        self.cancelled = 0
+        self.abandoned = 0
+        self.replaced = 0
+
+    def start(self):
+        '''
+            Creates the thread pool and the worker processes. Workers are warmed straight away so the
+            first heavy request does not pay for spawning them and importing the framework
+        '''
+        if self.thread_pool is None:
+            object_store.resize(self.lane_object_store_bytes)
+            self.thread_pool = concurrent.futures.ThreadPoolExecutor(max_workers=self.thread_workers, thread_name_prefix='route')
+        if self.idle_lanes is None:
+            #spawn instead of fork: the server process runs an event loop and the http server thread
+            self.idle_lanes = asyncio.Queue()
+            for _ in range(self.process_workers):
+                self.idle_lanes.put_nowait(self._new_lane())
+
+    def _new_lane(self) -> WorkerLane:
+        lane = WorkerLane(self.context, self.lane_object_store_bytes)
+        self.lanes.add(lane)
+        return lane
+
+    def shutdown(self, wait:bool = True):
+        if self.thread_pool is not None:
+            self.thread_pool.shutdown(wait=wait, cancel_futures=True)
+            self.thread_pool = None
+        for lane in self.lanes:
+            lane.executor.shutdown(wait=wait, cancel_futures=True)
+        self.lanes.clear()
+        self.idle_lanes = None
+
+    def stats(self) -> dict:
+        '''
+            Capacity of the pool. A cancelled job's worker counts as idle as soon as it is killed
+        '''
+        idle = self.idle_lanes.qsize() if self.idle_lanes is not None else self.process_workers
+        return {'process_workers': self.process_workers, 'process_busy': self.process_workers - idle, 'process_idle': idle,
+                'threads_busy': self.threads_busy, 'cancelled': self.cancelled, 'abandoned_threads': self.abandoned,
+                'replaced_workers': self.replaced}
+
+    def _track_thread(self, fn, *args):
+        self.threads_busy += 1
+        try:
+            return fn(*args)
+        finally:
+            self.threads_busy -= 1
+
+    async def _run_in_thread(self, fn, *args):
+        loop = asyncio.get_running_loop()
+        try:
+            return await loop.run_in_executor(self.thread_pool, self._track_thread, fn, *args)
+        except asyncio.CancelledError:
+            #a running thread cannot be stopped, its result is dropped when it finishes
+            self.cancelled += 1
+            self.abandoned += 1
+            raise
+
+    async def _run_in_lane(self, fn, *args):
+        lane = await self.idle_lanes.get()
+        try:
+            return await lane.submit(fn, *args)
+        except asyncio.CancelledError:
+            lane.kill()
+            self.cancelled += 1
+            raise
+        except BrokenProcessPool:
+            lane.broken = True
+            raise
+        finally:
+            if lane.broken:
+                self.lanes.discard(lane)
+                lane = self._new_lane()
+                self.replaced += 1
+            self.idle_lanes.put_nowait(lane)
+
+    async def run(self, mode:str, action:str, uuid:str, value):
+        '''
+            Runs the handler for action with the given execution mode and returns its result.
+            Cancelling the caller kills the worker process of a PROCESS handler
+        '''
+        if mode == INLINE:
+            return call_route(action, uuid, value)
+        if self.thread_pool is None or self.idle_lanes is None:
+            self.start()
+        if mode == PROCESS:
+            return await self._run_in_lane(call_route, action, uuid, value)
+        return await self._run_in_thread(call_route, action, uuid, value)
+
+    async def stream(self, mode:str, action:str, uuid:str, value):
+        '''
+            Runs a streaming handler for action and yields its chunks as they are produced
+        '''
+        if mode == INLINE:
+            for chunk in call_route(action, uuid, value):
+                yield chunk
+            return
+        if self.thread_pool is None or self.idle_lanes is None:
+            self.start()
+        if mode == THREAD:
+            chunks = iter(await self._run_in_thread(call_route, action, uuid, value))
+            while not isinstance(chunk := await self._run_in_thread(next, chunks, _EndOfStream()), _EndOfStream):
+                yield chunk
+            return
+
+        #PROCESS handlers send their chunks straight to the event loop through a pipe, acknowledging each
+        #chunk once it is read keeps the worker at most stream_buffer chunks ahead of the connection
+        reader, writer = self.context.Pipe()
+        job = asyncio.ensure_future(self._run_in_lane(stream_route, writer, self.stream_buffer, action, uuid, value))
+        try:
+            while not isinstance(chunk := await _receive(reader, job), _EndOfStream):
+                reader.send(None)
+                yield chunk
+            #surfaces any exception raised by the handler
+            await job
+        finally:
+            job.cancel()
+            reader.close()
+            #kept open until the lane has received its copy
+            job.add_done_callback(lambda _: writer.close())
+
+async def _receive(reader, job:asyncio.Future):
+    '''
+        Next object sent through reader, or an _EndOfStream once job is done without sending one,
+        as it does when it is cancelled or its worker dies
+    '''
+    loop = asyncio.get_running_loop()
+    while not reader.poll():
+        if job.done(): return _EndOfStream()
+        readable = loop.create_future()
+        loop.add_reader(reader.fileno(), lambda: readable.done() or readable.set_result(None))
+        try:
+            await asyncio.wait([readable, job], return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            loop.remove_reader(reader.fileno())
+    #the worker writes a chunk whole, so once it has started arriving reading it does not wait on the handler
+    return reader.recv()
@@ -0,0 +1,139 @@
+import asyncio
+import time
+
+from server.framing import frame_size
+
+class ConnectionLimits():
+    name = 'Connection Limits'
+    description = 'Per websocket connection limits on in-flight requests and queued response bytes'
+
+    def __init__(self, max_in_flight:int = 32, max_queued_bytes:int = int(1000000*256), read_queue:int = 4) -> None:
+        '''
+            max_in_flight -> requests accepted from one connection that have not been answered yet
+            max_queued_bytes -> serialized response bytes waiting to be sent on one connection
+            read_queue -> incoming messages buffered by the websocket library, and requests read while waiting for
+                          a request slot, before it stops reading the socket
+        '''
+        self.max_in_flight = max_in_flight
+        self.max_queued_bytes = max_queued_bytes
+        self.read_queue = read_queue
+
+class FlowStats():
+    name = 'Flow Stats'
+    description = 'Server wide counters showing when connection limits are engaged'
+
+    def __init__(self) -> None:
+        self.connections = 0
+        self.requests = 0
+        self.in_flight = 0
+        self.queued_bytes = 0
+        self.peak_in_flight = 0
+        self.peak_queued_bytes = 0
+        self.throttled = 0          #times a connection stopped reading because a limit was hit
+        self.throttled_seconds = 0.0
+
+    def snapshot(self) -> dict:
+        return dict(self.__dict__)
+
+class FlowControl():
+    name = 'Flow Control'
+    description = 'Backpressure for a single websocket connection'
+
+    def __init__(self, limits:ConnectionLimits, stats:FlowStats | None = None) -> None:
+        self.limits = limits
+        self.stats = stats if stats is not None else FlowStats()
+        self.in_flight = 0
+        self.queued_bytes = 0
+        self.throttled = 0
+        self.closed = False
+        self._changed = asyncio.Condition()
+
+    def _limited(self) -> bool:
+        return self.in_flight >= self.limits.max_in_flight or self.queued_bytes >= self.limits.max_queued_bytes
+
+    async def acquire(self):
+        '''
+            Waits for room for one more request. Requests read from a busy connection wait here before
+            they start, and once a few are waiting it stops reading from the socket instead of allocating more work
+        '''
+        async with self._changed:
+            if self._limited():
+                self.throttled += 1
+                self.stats.throttled += 1
+                start = time.perf_counter()
+                await self._changed.wait_for(lambda: not self._limited())
+                self.stats.throttled_seconds += time.perf_counter() - start
+            self.in_flight += 1
+            self.stats.requests += 1
+            self.stats.in_flight += 1
+            self.stats.peak_in_flight = max(self.stats.peak_in_flight, self.stats.in_flight)
+
+    async def release(self):
+        '''
+            Frees the request slot once its response has been sent
+        '''
+        async with self._changed:
+            if self.closed: return
+            self.in_flight -= 1
+            self.stats.in_flight -= 1
+            self._changed.notify_all()
+
+    async def wait_for_room(self):
+        '''
+            Waits until queued response bytes are back under the limit.
+            Used by streaming responses so one request cannot queue unbounded frames
+        '''
+        async with self._changed:
+            await self._changed.wait_for(lambda: self.closed or self.queued_bytes < self.limits.max_queued_bytes)
+
+    def add_bytes(self, nbytes:int):
+        if self.closed: return
+        self.queued_bytes += nbytes
+        self.stats.queued_bytes += nbytes
+        self.stats.peak_queued_bytes = max(self.stats.peak_queued_bytes, self.stats.queued_bytes)
+
+    async def remove_bytes(self, nbytes:int):
+        async with self._changed:
+            if self.closed: return
+            self.queued_bytes -= nbytes
+            self.stats.queued_bytes -= nbytes
+            self._changed.notify_all()
+
+    async def close(self):
+        '''
+            Returns whatever this connection still holds to the server wide counters
+        '''
+        async with self._changed:
+            self.stats.in_flight -= self.in_flight
+            self.stats.queued_bytes -= self.queued_bytes
+            self.in_flight = 0
+            self.queued_bytes = 0
+            self.closed = True
+            self._changed.notify_all()
+
+class ResponseQueue(asyncio.Queue):
+    '''
+        Output queue of a single connection. Accounts the serialized frames it holds against the FlowControl
+        and keeps the connection's running API tasks
+    '''
+    def __init__(self, flow:FlowControl, maxsize:int = 0) -> None:
+        super().__init__(maxsize)
+        self.flow = flow
+        #API tasks of the connection, cancelled when it disconnects
+        self.tasks: set[asyncio.Task] = set()
+
+    async def put(self, frame, final:bool = True):
+        '''
+            Queues a serialized frame. final marks the last frame of a request, which frees its request slot
+        '''
+        if not final: await self.flow.wait_for_room()
+        self.flow.add_bytes(frame_size(frame))
+        await super().put((frame, final))
+
+    async def sent(self, frame, final:bool = True):
+        '''
+            Called by the producer once a frame has been written to the websocket
+        '''
+        await self.flow.remove_bytes(frame_size(frame))
+        if final: await self.flow.release()
+        self.task_done()
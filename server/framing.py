@@ -0,0 +1,78 @@
+import orjson
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+DUMPS_OPTIONS = orjson.OPT_SERIALIZE_NUMPY
+
+class RawJSON(bytes):
+    '''
+        Already serialized JSON. Spliced into the response envelope as is instead of being encoded again
+    '''
+
+    @classmethod
+    def dumps(cls, value, option:int = DUMPS_OPTIONS) -> 'RawJSON':
+        return cls(orjson.dumps(value, option=option))
+
+def raw_object(items) -> RawJSON:
+    '''
+        A JSON object built from (key, RawJSON) pairs, the values are copied in verbatim
+    '''
+    return RawJSON(b'{' + b','.join(orjson.dumps(str(key)) + b':' + value for key, value in items) + b'}')
+
+def raw_array(values) -> RawJSON:
+    '''
+        A JSON array built from RawJSON values, copied in verbatim
+    '''
+    return RawJSON(b'[' + b','.join(values) + b']')
+
+def dumps(message) -> bytes:
+    '''
+        Serializes a response envelope. A RawJSON value is copied in verbatim
+    '''
+    value = message.get('value') if isinstance(message, dict) else None
+    if not isinstance(value, RawJSON):
+        return orjson.dumps(message, option=DUMPS_OPTIONS)
+    head = orjson.dumps({key: v for key, v in message.items() if key != 'value'}, option=DUMPS_OPTIONS)
+    separator = b',' if len(head) > 2 else b''
+    return b''.join((head[:-1], separator, b'"value":', value, b'}'))
+
+def frame_size(frame) -> int:
+    '''
+        Size in bytes of a text or binary websocket frame
+    '''
+    if isinstance(frame, memoryview): return frame.nbytes
+    return len(frame)
+
+def split_arrays(value) -> tuple[object, list]:
+    '''
+        Pulls the top level NumPy arrays out of a response value.
+        Returns the remaining value and a list of (field, array) pairs.
+        Object arrays cannot be sent as raw buffers and stay in the value
+    '''
+    if np is None or not isinstance(value, dict):
+        return value, []
+    arrays = [(field, array) for field, array in value.items()
+              if isinstance(array, np.ndarray) and not array.dtype.hasobject]
+    if not arrays:
+        return value, []
+    fields = [field for field, _ in arrays]
+    value = {field: v for field, v in value.items() if field not in fields}
+    return value, arrays
+
+def array_frames(response:dict, arrays:list) -> list[tuple[dict, memoryview]]:
+    '''
+        Builds a header and a binary frame for every array.
+        The header is a small JSON frame the client uses to read the binary frame that follows:
+        {'action', 'uuid', 'status': 'binary', 'field', 'dtype', 'shape', 'encoding'?}
+        The binary frame is a view on the array's contiguous buffer, the array is not copied
+    '''
+    frames = []
+    for field, array in arrays:
+        array = np.ascontiguousarray(array)
+        header = {'action': response.get('action'), 'uuid': response.get('uuid'), 'status': 'binary',
+                  'field': field, 'dtype': array.dtype.str, 'shape': array.shape}
+        frames.append((header, memoryview(array).cast('B')))
+    return frames
@@ -0,0 +1,89 @@
+import inspect
+import threading
+
+from server.class_registry import class_registry
+
+class HierarchyIndex():
+    name = 'Hierarchy Index'
+    description = 'Memoized subclass lookups and abstractness flags of the framework class hierarchy'
+
+    def __init__(self, walk, registry = class_registry) -> None:
+        '''
+            walk -> walk(parent) or walk(parent, match) returning the subclasses of parent, as get_subclasses does
+            registry -> ClassRegistry whose generation invalidates the index when the source tree changes
+
+            Framework classes appear when the registry imports their module, so the index is also dropped
+            whenever registry.imports changes. Classes created any other way need invalidate(), or
+            registry.classes_changed() to reach every cache of the class hierarchy
+        '''
+        self.walk = walk
+        self.registry = registry
+        self.subclass_index: dict[tuple, tuple] = {}
+        self.concrete_index: dict[tuple, tuple] = {}
+        self.abstract: dict[type, bool] = {}
+        self.hits = 0
+        self.misses = 0
+        self.rebuilds = 0
+        self._key = None
+        self._lock = threading.Lock()
+
+    def invalidate(self):
+        with self._lock:
+            self._clear()
+
+    def _clear(self):
+        self.subclass_index = {}
+        self.concrete_index = {}
+        self._key = None
+        self.rebuilds += 1
+
+    def _check(self):
+        key = (self.registry.generation, self.registry.imports)
+        if key == self._key: return
+        with self._lock:
+            if key == self._key: return
+            self._clear()
+            self._key = key
+
+    def subclasses(self, parent:type, match = None) -> tuple:
+        '''
+            Every subclass of parent, filtered by match, in the order walk returns them
+        '''
+        self._check()
+        key = (parent, match)
+        found = self.subclass_index.get(key)
+        if found is not None:
+            self.hits += 1
+            return found
+        self.misses += 1
+        found = tuple(self.walk(parent) if match is None else self.walk(parent, match))
+        #the walk may import descendant modules, which must not make this result look stale
+        self._check()
+        self.subclass_index[key] = found
+        return found
+
+    def concrete(self, parent:type, match = None) -> tuple:
+        '''
+            The subclasses of parent that can be instantiated
+        '''
+        self._check()
+        key = (parent, match)
+        found = self.concrete_index.get(key)
+        if found is not None:
+            self.hits += 1
+            return found
+        found = tuple(c for c in self.subclasses(parent, match) if not self.isabstract(c))
+        self.concrete_index[key] = found
+        return found
+
+    def isabstract(self, cls:type) -> bool:
+        #abstract methods are fixed when the class is created
+        abstract = self.abstract.get(cls)
+        if abstract is None:
+            abstract = self.abstract[cls] = inspect.isabstract(cls)
+        return abstract
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {'entries': len(self.subclass_index), 'hits': self.hits, 'misses': self.misses, 'rebuilds': self.rebuilds,
+                'hit_rate': self.hits/lookups if lookups else 0.0}
@@ -1,22 +1,231 @@
+from collections import OrderedDict
+from email.utils import formatdate, parsedate_to_datetime
+import functools
+import gzip
 import http.server
-import socketserver
 import os
+import re
+import sys
+import threading
+sys.path.append(os.path.join(os.path.dirname(__file__),'..'))
+
+from server.metrics import registry
+
+#files at least this large are written with sendfile, smaller ones are copied through the socket writer
+SENDFILE_MIN_SIZE = int(1000*64)
+#only files between these sizes get a gzip variant, tiny files do not shrink and huge ones would fill the cache
+GZIP_MIN_SIZE = 1000
+GZIP_MAX_SIZE = int(1000000*8)
+GZIP_TYPES = ('text/', 'application/javascript', 'application/json', 'image/svg+xml', 'application/xml')
+
+RANGE_PATTERN = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+class GzipCache():
+    name = 'Gzip Cache'
+    description = 'LRU cache of gzip compressed static files, keyed by path and ETag'
+
+    def __init__(self, max_bytes:int = int(1000000*64), level:int = 6) -> None:
+        self.max_bytes = max_bytes
+        self.level = level
+        self.entries: OrderedDict[tuple[str, str], bytes] = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def get(self, path:str, etag:str) -> bytes:
+        key = (path, etag)
+        with self._lock:
+            body = self.entries.get(key)
+            if body is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return body
+            self.misses += 1
+        #compressed outside the lock so other files are served meanwhile
+        with open(path, 'rb') as source:
+            body = gzip.compress(source.read(), compresslevel=self.level, mtime=0)
+        with self._lock:
+            if key not in self.entries:
+                #older versions of the same file are never asked for again
+                for stale in [k for k in self.entries if k[0] == path]:
+                    self.bytes -= len(self.entries.pop(stale))
+                self.entries[key] = body
+                self.bytes += len(body)
+            while self.bytes > self.max_bytes and self.entries:
+                _, evicted = self.entries.popitem(last=False)
+                self.bytes -= len(evicted)
+        return body
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {'entries': len(self.entries), 'bytes': self.bytes, 'hits': self.hits, 'misses': self.misses}
+
+gzip_cache = GzipCache()
+registry.add_source('http_gzip', gzip_cache.stats)
 
 class HttpRequestHandler(http.server.SimpleHTTPRequestHandler):
+    '''
+        Serves the UI. Files are revalidated with ETag / Last-Modified, text assets are sent gzip
+        compressed from memory, single byte ranges are honoured and large files go out with sendfile
+    '''
+    protocol_version = 'HTTP/1.1'
+
     def do_GET(self):
+        if self.path == '/metrics':
+            return self.send_metrics()
+        if self.path == '/':
+            self.path = 'index.html'
+        self.send_file(head_only=False)
+
+    def do_HEAD(self):
         if self.path == '/':
             self.path = 'index.html'
-        return http.server.SimpleHTTPRequestHandler.do_GET(self)
+        self.send_file(head_only=True)
+
+    def send_metrics(self):
+        '''
+            Plain text metrics of the websocket server running in this process, for scraping
+        '''
+        body = registry.render_text().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Cache-Control', 'no-store')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_file(self, head_only:bool):
+        path = self.translate_path(self.path)
+        if not os.path.isfile(path):
+            #directories and missing files keep the default listing, redirects and 404s
+            f = self.send_head()
+            if f:
+                try:
+                    if not head_only: self.copyfile(f, self.wfile)
+                finally:
+                    f.close()
+            return
+        try:
+            f = open(path, 'rb')
+        except OSError:
+            self.send_error(http.HTTPStatus.NOT_FOUND, 'File not found')
+            return
+        with f:
+            stat = os.fstat(f.fileno())
+            size = stat.st_size
+            etag = f'"{size:x}-{stat.st_mtime_ns:x}"'
+            last_modified = formatdate(stat.st_mtime, usegmt=True)
+            ctype = self.guess_type(path)
+
+            if self.not_modified(etag, stat.st_mtime):
+                self.send_response(http.HTTPStatus.NOT_MODIFIED)
+                self.send_header('ETag', etag)
+                self.send_header('Last-Modified', last_modified)
+                self.end_headers()
+                return
+
+            byte_range = self.requested_range(size, etag)
+            if byte_range == 'invalid':
+                self.send_response(http.HTTPStatus.REQUESTED_RANGE_NOT_SATISFIABLE)
+                self.send_header('Content-Range', f'bytes */{size}')
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+
+            if byte_range is None and self.accepts_gzip() and ctype.startswith(GZIP_TYPES) and GZIP_MIN_SIZE <= size <= GZIP_MAX_SIZE:
+                body = gzip_cache.get(path, etag)
+                self.send_response(http.HTTPStatus.OK)
+                self.send_common_headers(ctype, etag[:-1] + '-gz"', last_modified)
+                self.send_header('Content-Encoding', 'gzip')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                if not head_only: self.wfile.write(body)
+                return
+
+            if byte_range is None:
+                start, length = 0, size
+                self.send_response(http.HTTPStatus.OK)
+            else:
+                start, end = byte_range
+                length = end - start + 1
+                self.send_response(http.HTTPStatus.PARTIAL_CONTENT)
+                self.send_header('Content-Range', f'bytes {start}-{end}/{size}')
+            self.send_common_headers(ctype, etag, last_modified)
+            self.send_header('Content-Length', str(length))
+            self.end_headers()
+            if head_only or length == 0: return
+            if length >= SENDFILE_MIN_SIZE:
+                #the kernel copies straight from the page cache to the socket
+                self.connection.sendfile(f, start, length)
+            else:
+                f.seek(start)
+                self.wfile.write(f.read(length))
+
+    def send_common_headers(self, ctype:str, etag:str, last_modified:str):
+        self.send_header('Content-Type', ctype)
+        self.send_header('ETag', etag)
+        self.send_header('Last-Modified', last_modified)
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('Vary', 'Accept-Encoding')
+        #the UI changes between releases, browsers keep it but revalidate it on every load
+        self.send_header('Cache-Control', 'no-cache')
+
+    def not_modified(self, etag:str, mtime:float) -> bool:
+        if_none_match = self.headers.get('If-None-Match')
+        if if_none_match is not None:
+            tags = [tag.strip() for tag in if_none_match.split(',')]
+            return '*' in tags or etag in tags or etag[:-1] + '-gz"' in tags
+        if_modified_since = self.headers.get('If-Modified-Since')
+        if if_modified_since is not None:
+            try:
+                return int(mtime) <= parsedate_to_datetime(if_modified_since).timestamp()
+            except (TypeError, ValueError, IndexError, OverflowError):
+                return False
+        return False
+
+    def requested_range(self, size:int, etag:str):
+        '''
+            (start, end) of a single byte range request, None to send the whole file
+            or 'invalid' when the range cannot be satisfied. Multiple ranges are answered with the whole file
+        '''
+        header = self.headers.get('Range')
+        if header is None: return None
+        if_range = self.headers.get('If-Range')
+        if if_range is not None and if_range.strip() != etag: return None
+        match = RANGE_PATTERN.match(header.strip())
+        if match is None: return None
+        first, last = match.groups()
+        if not first and not last: return None
+        if not first:
+            #suffix range, the last n bytes
+            length = int(last)
+            if length == 0 or size == 0: return 'invalid'
+            return max(0, size - length), size - 1
+        start = int(first)
+        end = min(int(last), size - 1) if last else size - 1
+        if start >= size or end < start: return 'invalid'
+        return start, end
+
+    def accepts_gzip(self) -> bool:
+        accept_encoding = self.headers.get('Accept-Encoding', '')
+        for coding in accept_encoding.split(','):
+            name, _, params = coding.strip().partition(';')
+            if name.strip() == 'gzip':
+                return params.replace(' ', '') not in ('q=0', 'q=0.0', 'q=0.00', 'q=0.000')
+        return False
 
 def run(port: int = 8001):
     web_dir = os.path.join(os.path.dirname(__file__))
-    os.chdir(web_dir)
 
-    Handler = HttpRequestHandler
+    #serves from web_dir without changing the working directory of the whole process
+    Handler = functools.partial(HttpRequestHandler, directory=web_dir)
 
-    with socketserver.TCPServer(("", port), Handler) as httpd:
+    #one thread per connection, a slow client no longer blocks every other asset load
+    with http.server.ThreadingHTTPServer(("", port), Handler) as httpd:
+        httpd.daemon_threads = True
         print("Serving HTTP at port", port)
         httpd.serve_forever()
 
 if __name__ == '__main__':
-    run()
\ No newline at end of file
+    run()
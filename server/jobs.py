@@ -0,0 +1,407 @@
+import asyncio
+from collections import deque
+import itertools
+import os
+import time
+import traceback
+import uuid as uuid_lib
+
+import orjson
+
+from server.framing import RawJSON
+from server.storage import private_directory, server_directory
+
+QUEUED    = 'queued'
+RUNNING   = 'running'
+DONE      = 'done'
+FAILED    = 'failed'
+CANCELLED = 'cancelled'
+
+ACTIVE   = (QUEUED, RUNNING)
+
+FIFO     = 'fifo'
+PRIORITY = 'priority'
+
+def _alive(pid) -> bool:
+    if not isinstance(pid, int): return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        #exists, owned by another user
+        return True
+    return True
+
+class Job():
+    name = 'Job'
+    description = 'A long running request executed by the JobManager'
+
+    def __init__(self, action:str, value, priority:int = 0, job_id:str | None = None) -> None:
+        self.id = job_id or uuid_lib.uuid4().hex
+        self.action = action
+        self.value = value
+        self.priority = priority
+        self.state = QUEUED
+        self.progress = 0
+        self.error = None
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+        self.task = None
+        #pid of the server process running the job, the status file of another one's jobs is their current state
+        self.owner = os.getpid()
+
+    def status(self) -> dict:
+        return {'job': self.id, 'action': self.action, 'state': self.state, 'priority': self.priority,
+                'progress': self.progress, 'error': self.error,
+                'submitted': self.submitted, 'started': self.started, 'finished': self.finished}
+
+class Subscriber():
+    name = 'Subscriber'
+    description = 'Delivers the events of one job to one connection without holding up the job'
+
+    def __init__(self, send, on_error) -> None:
+        '''
+            send -> awaited with every event, may wait on a slow connection
+            on_error -> called once send raised, the subscriber stops
+        '''
+        self.send = send
+        self.on_error = on_error
+        self.events = deque()
+        self.coalesced = 0
+        self._ready = asyncio.Event()
+        self.task = asyncio.create_task(self._deliver())
+
+    def push(self, event:dict, coalesce:bool = False):
+        '''
+            Queues an event without waiting. A coalesce event, progress, replaces the last queued one if that
+            is progress as well, so a slow connection only holds state changes and the latest progress
+        '''
+        if coalesce and self.events and self.events[-1][1]:
+            self.events[-1] = (event, coalesce)
+            self.coalesced += 1
+        else:
+            self.events.append((event, coalesce))
+        self._ready.set()
+
+    async def _deliver(self):
+        while True:
+            await self._ready.wait()
+            self._ready.clear()
+            while self.events:
+                event, _ = self.events.popleft()
+                try:
+                    await self.send(event)
+                except Exception:
+                    self.on_error()
+                    return
+
+    def close(self):
+        self.task.cancel()
+
+class JobManager():
+    name = 'Job Manager'
+    description = 'Runs long requests detached from the connection that submitted them'
+
+    def __init__(self, router, jobs_dir:str | None = None, concurrency:int = 2, ordering:str = FIFO,
+                 retention:float = 7*24*3600, poll_interval:float = 1.0) -> None:
+        '''
+            router -> Router used to run the jobs, so they use its execution pool
+            jobs_dir -> directory holding finished job results until they are fetched, private to the server user
+            concurrency -> number of jobs running at the same time
+            ordering -> FIFO, or PRIORITY to run higher priority jobs first (FIFO among equal priorities)
+            retention -> seconds a finished job is kept after it finished, with its result if it was never fetched
+            poll_interval -> seconds between reads of the status of jobs run by other server processes sharing
+                             jobs_dir, and between writes of the progress of the jobs run here
+
+            Every state change of a job is written to its status file, so a client that reconnects to another
+            server process of a cluster can still follow, fetch or cancel it. Cancelling another process's job
+            leaves a cancel file in jobs_dir for that process to act on
+        '''
+        if ordering not in (FIFO, PRIORITY):
+            raise ValueError(f'Unknown job ordering "{ordering}". Expected "{FIFO}" or "{PRIORITY}"')
+        self.router = router
+        self.jobs_dir = jobs_dir or server_directory('jobs')
+        self.concurrency = concurrency
+        self.ordering = ordering
+        self.retention = retention
+        self.poll_interval = poll_interval
+        self.jobs: dict[str, Job] = {}
+        self.subscribers: dict[str, dict[object, Subscriber]] = {}
+        self.pruned = 0
+        self.queue = None
+        self.workers = []
+        self._order = itertools.count()
+        #status files are loaded back as jobs, only the server user may write them
+        private_directory(self.jobs_dir)
+        self._load_finished()
+
+    def _result_path(self, job_id:str) -> str:
+        return os.path.join(self.jobs_dir, f'{job_id}.json')
+
+    def _status_path(self, job_id:str) -> str:
+        return os.path.join(self.jobs_dir, f'{job_id}.status.json')
+
+    def _cancel_path(self, job_id:str) -> str:
+        return os.path.join(self.jobs_dir, f'{job_id}.cancel')
+
+    def _save(self, job:Job):
+        '''
+            Writes the status of job, replacing the file at once so other processes never read half of it
+        '''
+        path = self._status_path(job.id)
+        self._write(f'{path}.{os.getpid()}.tmp', orjson.dumps({**job.status(), 'owner': job.owner}))
+        os.replace(f'{path}.{os.getpid()}.tmp', path)
+
+    def _load_finished(self):
+        '''
+            Picks up the results of jobs that finished before a restart and were never fetched,
+            and the jobs other server processes run
+        '''
+        for filename in os.listdir(self.jobs_dir):
+            if not filename.endswith('.status.json'): continue
+            self._load_status(os.path.join(self.jobs_dir, filename))
+
+    def _load_status(self, path:str) -> Job | None:
+        try:
+            with open(path, 'rb') as status_file:
+                status = orjson.loads(status_file.read())
+        except (OSError, orjson.JSONDecodeError):
+            return None
+        known = self.jobs.get(status['job'])
+        #the jobs of this process are more recent than their file
+        if known is not None and known.owner == os.getpid(): return known
+        job = Job(status['action'], None, status['priority'], job_id=status['job'])
+        for key in ('state', 'progress', 'error', 'submitted', 'started', 'finished'):
+            setattr(job, key, status[key])
+        job.owner = status.get('owner')
+        if job.state in ACTIVE and not _alive(job.owner):
+            job.state = FAILED
+            job.error = 'The server process running the job exited'
+            job.finished = time.time()
+        self.jobs[job.id] = job
+        return job
+
+    def start(self):
+        if self.queue is not None: return
+        self.queue = asyncio.PriorityQueue()
+        self.workers = [asyncio.create_task(self._worker()) for _ in range(self.concurrency)]
+        self.workers.append(asyncio.create_task(self._watch()))
+
+    async def stop(self):
+        for worker in self.workers:
+            worker.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+        self.workers = []
+        self.queue = None
+
+    def stats(self) -> dict:
+        '''
+            Jobs of this process by state
+        '''
+        states = [job.state for job in self.jobs.values() if job.owner == os.getpid()]
+        return {**{state: states.count(state) for state in (QUEUED, RUNNING, DONE, FAILED, CANCELLED)},
+                'subscribers': sum(len(subscribers) for subscribers in self.subscribers.values()), 'pruned': self.pruned}
+
+    def prune(self):
+        '''
+            Forgets the jobs that finished more than retention seconds ago, deleting the results nobody fetched
+        '''
+        oldest = time.time() - self.retention
+        for job_id, job in list(self.jobs.items()):
+            if job.state in (DONE, FAILED, CANCELLED) and job.finished is not None and job.finished < oldest:
+                self.discard(job_id)
+                self.pruned += 1
+
+    def submit(self, action:str, value, priority:int = 0) -> Job:
+        if not self.router.has_route(action):
+            raise KeyError(f'Unknown action "{action}"')
+        self.start()
+        self.prune()
+        #a job uses its live configs as they were when it was submitted
+        job = Job(action, self.router.pin(action, value), priority)
+        self.jobs[job.id] = job
+        self._save(job)
+        rank = -priority if self.ordering == PRIORITY else 0
+        self.queue.put_nowait((rank, next(self._order), job.id))
+        return job
+
+    def get(self, job_id:str) -> Job:
+        job = self.jobs.get(job_id)
+        if job is None or (job.owner != os.getpid() and job.state in ACTIVE):
+            #run by another server process sharing jobs_dir, its status file holds the current state
+            if isinstance(job_id, str) and job_id.isalnum(): job = self._load_status(self._status_path(job_id)) or job
+            if job is None: raise KeyError(f'Unknown job "{job_id}"')
+        return job
+
+    def subscribe(self, job_id:str, key, send):
+        '''
+            send is awaited with every event of the job, by a task of the subscriber so a slow connection
+            never holds up the job. key identifies the subscriber, usually its connection
+        '''
+        self.get(job_id)
+        self.unsubscribe(job_id, key)
+        #a subscriber that cannot receive events is dropped
+        self.subscribers.setdefault(job_id, {})[key] = Subscriber(send, lambda: self.unsubscribe(job_id, key))
+
+    def unsubscribe(self, job_id:str, key):
+        subscriber = self.subscribers.get(job_id, {}).pop(key, None)
+        if subscriber is not None: subscriber.close()
+
+    def unsubscribe_all(self, key):
+        for job_id in list(self.subscribers):
+            self.unsubscribe(job_id, key)
+
+    def publish(self, job:Job, progress:bool = False):
+        '''
+            Queues the status of job for its subscribers. progress events may be coalesced, state changes never are
+        '''
+        event = job.status()
+        for subscriber in self.subscribers.get(job.id, {}).values():
+            subscriber.push(event, coalesce=progress)
+
+    def cancel(self, job_id:str) -> bool:
+        job = self.get(job_id)
+        if job.owner != os.getpid():
+            if job.state not in ACTIVE: return False
+            #picked up by the process running the job within poll_interval
+            self._write(self._cancel_path(job_id), b'')
+            return True
+        if job.state == QUEUED:
+            #dropped by the worker when it reaches the front of the queue
+            job.state = CANCELLED
+            job.finished = time.time()
+            self._save(job)
+            self.publish(job)
+            return True
+        if job.state == RUNNING and job.task is not None:
+            job.task.cancel()
+            return True
+        return False
+
+    async def fetch(self, job_id:str, keep:bool = False) -> RawJSON:
+        '''
+            Returns the stored result of a finished job. The result is deleted unless keep is set
+        '''
+        job = self.get(job_id)
+        if job.state != DONE:
+            raise ValueError(f'Job "{job_id}" is {job.state}, it has no result')
+        with open(self._result_path(job_id), 'rb') as result_file:
+            result = RawJSON(await asyncio.to_thread(result_file.read))
+        if not keep: self.discard(job_id)
+        return result
+
+    def discard(self, job_id:str):
+        for path in (self._result_path(job_id), self._status_path(job_id), self._cancel_path(job_id)):
+            if os.path.isfile(path): os.remove(path)
+        self.jobs.pop(job_id, None)
+        for subscriber in self.subscribers.pop(job_id, {}).values():
+            subscriber.close()
+
+    async def _worker(self):
+        while True:
+            _, _, job_id = await self.queue.get()
+            job = self.jobs.get(job_id)
+            if job is None or job.state != QUEUED: continue
+            #_run reports its own failures and cancellation, stopping the worker cancels the job as well
+            task = job.task = asyncio.create_task(self._run(job))
+            try:
+                await asyncio.wait([task])
+            except asyncio.CancelledError:
+                task.cancel()
+                raise
+
+    async def _run(self, job:Job):
+        job.state = RUNNING
+        job.started = time.time()
+        self._save(job)
+        self.publish(job)
+        try:
+            if self.router.is_streaming(job.action):
+                #streaming handlers report every chunk as progress
+                chunks = []
+                saved = time.time()
+                async for chunk in self.router.pool.stream(self.router.execution_mode(job.action), job.action, job.id, job.value):
+                    chunks.append(chunk if isinstance(chunk, RawJSON) else RawJSON.dumps(chunk))
+                    job.progress = len(chunks)
+                    self.publish(job, progress=True)
+                    if time.time() - saved >= self.poll_interval:
+                        self._save(job)
+                        saved = time.time()
+                result = RawJSON(b'[' + b','.join(chunks) + b']')
+            else:
+                result = await self.router.call(job.action, job.id, job.value)
+                if not isinstance(result, RawJSON): result = RawJSON.dumps(result)
+            await asyncio.to_thread(self._write, self._result_path(job.id), result)
+            job.state = DONE
+        except asyncio.CancelledError:
+            job.state = CANCELLED
+        except Exception:
+            job.state = FAILED
+            job.error = traceback.format_exc()
+        finally:
+            job.finished = time.time()
+            job.task = None
+            job.value = None
+            #kept with the result so it can still be fetched after a restart
+            self._save(job)
+            self.publish(job)
+
+    async def _watch(self):
+        '''
+            Sends the events of the jobs of other processes to their subscribers here, and cancels the jobs
+            of this process that another process was asked to cancel
+        '''
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            for job_id in list(self.subscribers):
+                job = self.jobs.get(job_id)
+                if job is None or job.owner == os.getpid() or job.state not in ACTIVE: continue
+                before = job.status()
+                job = self.get(job_id)
+                if job.status() != before: self.publish(job, progress=job.state == before['state'])
+            for job in list(self.jobs.values()):
+                if job.owner != os.getpid() or job.state not in ACTIVE: continue
+                if os.path.exists(self._cancel_path(job.id)):
+                    os.remove(self._cancel_path(job.id))
+                    self.cancel(job.id)
+
+    @staticmethod
+    def _write(path:str, data:bytes):
+        with open(path, 'wb') as out_file:
+            out_file.write(data)
+
+    async def handle(self, action:str, value, key, send):
+        '''
+            Handles the jobs.* websocket actions for one connection:
+                jobs.submit      {'action', 'value', 'priority'?, 'subscribe'?} -> job status
+                jobs.status      job id -> job status
+                jobs.list        -> status of every job, of every server process sharing jobs_dir
+                jobs.subscribe   job id -> job status, events follow as 'jobs.event' frames
+                jobs.unsubscribe job id
+                jobs.result      job id or {'job', 'keep'?} -> stored result, deleted unless keep
+                jobs.cancel      job id -> {'job', 'cancelled'}
+        '''
+        if action == 'jobs.submit':
+            job = self.submit(value['action'], value.get('value'), value.get('priority', 0))
+            if value.get('subscribe', True): self.subscribe(job.id, key, send)
+            return job.status()
+        if action == 'jobs.list':
+            #with the jobs other server processes started since
+            self._load_finished()
+            return [job.status() for job in self.jobs.values()]
+        job_id = value.get('job') if isinstance(value, dict) else value
+        if action == 'jobs.status':
+            return self.get(job_id).status()
+        if action == 'jobs.subscribe':
+            self.subscribe(job_id, key, send)
+            return self.get(job_id).status()
+        if action == 'jobs.unsubscribe':
+            self.unsubscribe(job_id, key)
+            return {'job': job_id}
+        if action == 'jobs.result':
+            return await self.fetch(job_id, keep=isinstance(value, dict) and value.get('keep', False))
+        if action == 'jobs.cancel':
+            return {'job': job_id, 'cancelled': self.cancel(job_id)}
+        raise KeyError(f'Unknown jobs action "{action}"')
@@ -0,0 +1,89 @@
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from itertools import repeat
+import multiprocessing
+import os
+import pickle
+import tempfile
+import uuid as uuid_lib
+
+#A toolpath generator implementing these methods can have its layers generated in parallel:
+#   plan_layers(**kwargs) -> layers that can be generated independently of each other, in output order
+#   generateLayer(layer, **kwargs) -> result of one layer, writing the files of that layer only
+#   mergeLayers(results, **kwargs) -> the generateAllLayers result from the layer results, in plan order
+#kwargs are the generateAllLayers keyword arguments. The ToolpathGenerator of core does not implement them yet,
+#until it does every toolpath is generated by generateAllLayers
+PARALLEL_METHODS = ('plan_layers', 'generateLayer', 'mergeLayers')
+
+#Below this many layers handing the generator to the workers costs more than it saves
+MIN_PARALLEL_LAYERS = 4
+
+def supports_parallel(generator) -> bool:
+    return all(callable(getattr(generator, method, None)) for method in PARALLEL_METHODS)
+
+#Layer workers of this process, kept warm between requests. They run in the process group of the
+#worker lane that started them, so killing the lane kills them as well, see WorkerLane.kill
+_pool = None
+_pool_workers = 0
+
+#the generator of this layer worker and the request it was handed for
+_generator = None
+_generator_key = None
+
+def _generate_layer(key:str, path:str, layer, kwargs:dict):
+    global _generator, _generator_key
+    if _generator_key != key:
+        #unpickled once per request by every worker, not once per layer
+        with open(path, 'rb') as frozen:
+            _generator = pickle.load(frozen)
+        _generator_key = key
+    return _generator.generateLayer(layer, **kwargs)
+
+def _layer_pool(workers:int) -> ProcessPoolExecutor:
+    global _pool, _pool_workers
+    if _pool is None or _pool_workers != workers:
+        if _pool is not None: _pool.shutdown(wait=False, cancel_futures=True)
+        _pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+        _pool_workers = workers
+    return _pool
+
+def shutdown():
+    global _pool
+    if _pool is not None:
+        _pool.shutdown(wait=False, cancel_futures=True)
+        _pool = None
+
+def generate_layers(generator, workers:int | None = None, **kwargs):
+    '''
+        generator.generateAllLayers(**kwargs), generating the layers in up to workers processes at once when the
+        generator supports it. The generator, with its part and setup, is pickled once per request and unpickled
+        once by every worker. Results are merged in plan order whichever worker finishes first, so the output
+        matches the sequential one.
+        Falls back to generateAllLayers for generators without the PARALLEL_METHODS, few layers or workers <= 1
+    '''
+    if not workers or workers <= 1 or not supports_parallel(generator):
+        return generator.generateAllLayers(**kwargs)
+    layers = list(generator.plan_layers(**kwargs))
+    if len(layers) < MIN_PARALLEL_LAYERS:
+        return generator.generateAllLayers(**kwargs)
+    try:
+        frozen = pickle.dumps(generator, protocol=pickle.HIGHEST_PROTOCOL)
+    except Exception:
+        #generators holding unpicklable state stay on one core
+        return generator.generateAllLayers(**kwargs)
+
+    #mkstemp creates the file readable by this user only
+    handle, path = tempfile.mkstemp(prefix='layers-', suffix='.pickle')
+    try:
+        with os.fdopen(handle, 'wb') as frozen_file:
+            frozen_file.write(frozen)
+        pool = _layer_pool(workers)
+        try:
+            #map yields in submission order
+            results = list(pool.map(_generate_layer, repeat(uuid_lib.uuid4().hex), repeat(path), layers, repeat(kwargs)))
+        except BrokenProcessPool:
+            shutdown()
+            raise
+    finally:
+        os.remove(path)
+    return generator.mergeLayers(results, **kwargs)
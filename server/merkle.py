@@ -0,0 +1,100 @@
+import hashlib
+
+import orjson
+
+DIGEST_SIZE = 32
+
+def _scalar(value) -> bytes:
+    #values outside of JSON, such as objects in a hash() result, are hashed by their str
+    return orjson.dumps(value, option=orjson.OPT_SERIALIZE_NUMPY, default=str)
+
+class MerkleNode():
+    '''
+        Cached digest of a dict or list of a config tree and the nodes of its dict and list values
+    '''
+    __slots__ = ('digest', 'is_list', 'children')
+
+    def __init__(self) -> None:
+        self.digest: bytes | None = None
+        self.is_list = False
+        self.children: dict = {}
+
+class MerkleTree():
+    name = 'Merkle Tree'
+    description = 'Structural digest of a config tree, every dict and list digest combines the digests of its children'
+
+    def __init__(self) -> None:
+        self.root = MerkleNode()
+        #dicts and lists hashed, a digest after a change only hashes the path to the root again
+        self.hashed = 0
+
+    def digest(self, document) -> bytes:
+        '''
+            Digest of document. Independent of dict key order, 1 and 1.0 differ as they do in JSON.
+            Digests of subtrees are reused until invalidate drops them, so document must be the same tree,
+            or one changed along invalidated paths only, every time
+        '''
+        if type(document) not in (dict, list):
+            return hashlib.blake2b(b'$' + _scalar(document), digest_size=DIGEST_SIZE).digest()
+        #post order with an explicit stack, config trees can be deeper than the recursion limit
+        stack = [(document, self.root, False)]
+        while stack:
+            node, cache, expanded = stack.pop()
+            if cache.digest is not None: continue
+            is_list = type(node) is list
+            keys = range(len(node)) if is_list else sorted(node)
+            if not expanded:
+                cache.is_list = is_list
+                stack.append((node, cache, True))
+                for key in keys:
+                    child = node[key]
+                    if type(child) in (dict, list):
+                        child_cache = cache.children.get(key)
+                        if child_cache is None: child_cache = cache.children[key] = MerkleNode()
+                        if child_cache.digest is None: stack.append((child, child_cache, False))
+                continue
+            parts = [b'[' if is_list else b'{']
+            for key in keys:
+                if not is_list:
+                    parts.append(orjson.dumps(key))
+                    parts.append(b':')
+                child = node[key]
+                if type(child) in (dict, list):
+                    parts.append(b'#')
+                    parts.append(cache.children[key].digest)
+                else:
+                    parts.append(_scalar(child))
+                parts.append(b',')
+            cache.digest = hashlib.blake2b(b''.join(parts), digest_size=DIGEST_SIZE).digest()
+            self.hashed += 1
+        return self.root.digest
+
+    def hexdigest(self, document) -> str:
+        return self.digest(document).hex()
+
+    def invalidate(self, path:list[str]):
+        '''
+            Drops the digests a change of the value at path makes stale: those of its ancestors and of the value itself.
+            A change inside a list drops the whole list, the indexes after it may have moved
+        '''
+        if not path:
+            self.root = MerkleNode()
+            return
+        node = self.root
+        for token in path[:-1]:
+            node.digest = None
+            child = node.children.get(int(token) if node.is_list and token.isdigit() else token)
+            #nothing below was hashed yet
+            if child is None: return
+            node = child
+        node.digest = None
+        if node.is_list:
+            node.children.clear()
+        else:
+            node.children.pop(path[-1], None)
+
+def hexdigest(document) -> str:
+    '''
+        Structural digest of a config tree, computed from scratch
+    '''
+    return MerkleTree().hexdigest(document)
@@ -0,0 +1,150 @@
+from bisect import bisect_left
+import threading
+import time
+
+#latency buckets grow by 25% from 10us to ~2.8hr
+LATENCY_BUCKETS = [1e-5 * 1.25**i for i in range(115)]
+QUANTILES = (0.5, 0.95, 0.99)
+
+class LatencyHistogram():
+    name = 'Latency Histogram'
+    description = 'Fixed log-spaced histogram of latencies in seconds'
+
+    def __init__(self) -> None:
+        self.counts = [0]*(len(LATENCY_BUCKETS)+1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds:float):
+        self.counts[bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+        self.max = max(self.max, seconds)
+
+    def quantile(self, q:float) -> float:
+        '''
+            Upper bound of the bucket holding the q-th observation, within 25% of the true value
+        '''
+        if self.count == 0: return 0.0
+        rank = q*self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return min(LATENCY_BUCKETS[index], self.max) if index < len(LATENCY_BUCKETS) else self.max
+        return self.max
+
+    def snapshot(self) -> dict:
+        snapshot = {f'p{int(q*100)}': self.quantile(q) for q in QUANTILES}
+        snapshot['mean'] = self.sum/self.count if self.count else 0.0
+        snapshot['max'] = self.max
+        return snapshot
+
+class ActionMetrics():
+    name = 'Action Metrics'
+    description = 'Counters and latency histogram of a single action'
+
+    def __init__(self) -> None:
+        self.count = 0
+        self.errors = 0
+        self.latency = LatencyHistogram()
+        self.request_bytes = 0
+        self.response_bytes = 0
+        self.compressed_frames = 0
+        self.compress_in_bytes = 0
+        self.compress_out_bytes = 0
+        self.compress_seconds = 0.0
+
+    def snapshot(self, uptime:float) -> dict:
+        compression = {'frames': self.compressed_frames, 'cpu_seconds': self.compress_seconds,
+                       'ratio': self.compress_out_bytes/self.compress_in_bytes if self.compress_in_bytes else 1.0}
+        return {'count': self.count, 'errors': self.errors, 'per_second': self.count/uptime if uptime else 0.0,
+                'latency': self.latency.snapshot(), 'request_bytes': self.request_bytes, 'response_bytes': self.response_bytes,
+                'compression': compression}
+
+class Metrics():
+    name = 'Metrics'
+    description = 'Per action request metrics plus named snapshot sources, readable from any thread'
+
+    def __init__(self) -> None:
+        self.started = time.time()
+        self.actions: dict[str, ActionMetrics] = {}
+        self.sources = {}
+        self._lock = threading.Lock()
+
+    def _action(self, action) -> ActionMetrics:
+        action = str(action)
+        if action not in self.actions:
+            self.actions[action] = ActionMetrics()
+        return self.actions[action]
+
+    def observe(self, action, seconds:float, ok:bool = True):
+        with self._lock:
+            metrics = self._action(action)
+            metrics.count += 1
+            metrics.latency.observe(seconds)
+            if not ok: metrics.errors += 1
+
+    def observe_request(self, action, nbytes:int):
+        with self._lock:
+            self._action(action).request_bytes += nbytes
+
+    def observe_response(self, action, nbytes:int):
+        with self._lock:
+            self._action(action).response_bytes += nbytes
+
+    def observe_compression(self, action, nbytes:int, compressed:int, seconds:float):
+        with self._lock:
+            metrics = self._action(action)
+            metrics.compressed_frames += 1
+            metrics.compress_in_bytes += nbytes
+            metrics.compress_out_bytes += compressed
+            metrics.compress_seconds += seconds
+
+    def add_source(self, name:str, snapshot):
+        '''
+            Registers a callable returning a dict of counters, reported under name
+        '''
+        self.sources[name] = snapshot
+
+    def snapshot(self) -> dict:
+        uptime = time.time() - self.started
+        with self._lock:
+            actions = {action: metrics.snapshot(uptime) for action, metrics in self.actions.items()}
+        sources = {name: snapshot() for name, snapshot in list(self.sources.items())}
+        return {'uptime': uptime, 'actions': actions, **sources}
+
+    def render_text(self) -> str:
+        '''
+            Plain text exposition of the snapshot, one sample per line, in the Prometheus format
+        '''
+        snapshot = self.snapshot()
+        lines = [f'server_uptime_seconds {snapshot["uptime"]:.3f}']
+        for action, metrics in snapshot['actions'].items():
+            label = f'action="{action}"'
+            lines.append(f'route_requests_total{{{label}}} {metrics["count"]}')
+            lines.append(f'route_errors_total{{{label}}} {metrics["errors"]}')
+            for q in QUANTILES:
+                lines.append(f'route_latency_seconds{{{label},quantile="{q}"}} {metrics["latency"][f"p{int(q*100)}"]:.6f}')
+            lines.append(f'route_latency_seconds_max{{{label}}} {metrics["latency"]["max"]:.6f}')
+            lines.append(f'route_request_bytes_total{{{label}}} {metrics["request_bytes"]}')
+            lines.append(f'route_response_bytes_total{{{label}}} {metrics["response_bytes"]}')
+            lines.append(f'route_compressed_frames_total{{{label}}} {metrics["compression"]["frames"]}')
+            lines.append(f'route_compression_ratio{{{label}}} {metrics["compression"]["ratio"]:.4f}')
+            lines.append(f'route_compression_cpu_seconds_total{{{label}}} {metrics["compression"]["cpu_seconds"]:.6f}')
+        for name in self.sources:
+            lines.extend(_render_source(name, snapshot.get(name, {})))
+        return '\n'.join(lines) + '\n'
+
+def _render_source(prefix:str, values:dict) -> list[str]:
+    lines = []
+    for key, value in values.items():
+        if isinstance(value, dict):
+            lines.extend(_render_source(f'{prefix}_{key}', value))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            lines.append(f'{prefix}_{key} {value}')
+    return lines
+
+#Process wide registry shared by the websocket Router and the http server
+registry = Metrics()
@@ -0,0 +1,113 @@
+from collections import OrderedDict
+import hashlib
+import pickle
+import threading
+
+import orjson
+
+from server.class_registry import class_registry
+
+def content_key(config) -> bytes:
+    '''
+        Canonical hash of a config dict: the same content gives the same key whatever the key order
+    '''
+    canonical = orjson.dumps(config, option=orjson.OPT_SORT_KEYS | orjson.OPT_SERIALIZE_NUMPY)
+    return hashlib.blake2b(canonical, digest_size=16).digest()
+
+class ObjectStore():
+    name = 'Object Store'
+    description = 'Objects built from config dicts, kept by content hash and handed out as private copies'
+
+    def __init__(self, max_bytes:int = int(1000000*128), registry = class_registry) -> None:
+        '''
+            max_bytes -> memory budget of the pickled objects, least recently used objects are dropped beyond it
+            registry -> ClassRegistry whose generation empties the store when the source tree changes
+
+            The store lives in one process, so every worker lane holds its own and the server uses up to max_bytes
+            once per lane. ExecutionPool divides its object_store_bytes between the lanes, see resize.
+            Objects are kept pickled. Handlers change the objects they are given (activeSetup, offsets...),
+            so each request unpickles its own copy instead of sharing one object
+        '''
+        self.max_bytes = max_bytes
+        self.registry = registry
+        self.entries: OrderedDict[bytes, bytes] = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.uncacheable = 0
+        self._generation = registry.generation
+        self._lock = threading.Lock()
+
+    def get(self, config:dict, build):
+        '''
+            The object build(config) returns, unpickled from the store when the same content was built before
+        '''
+        try:
+            key = content_key(config)
+        except TypeError:
+            #configs holding values orjson cannot serialize are never stored
+            self.uncacheable += 1
+            return build(config)
+        with self._lock:
+            if self.registry.generation != self._generation:
+                self._clear()
+                self._generation = self.registry.generation
+            frozen = self.entries.get(key)
+            if frozen is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+            else:
+                self.misses += 1
+        if frozen is not None:
+            return pickle.loads(frozen)
+
+        obj = build(config)
+        try:
+            #taken before the caller gets obj and starts changing it
+            frozen = pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL)
+        except Exception:
+            self.uncacheable += 1
+            return obj
+        self.put(key, frozen)
+        return obj
+
+    def put(self, key:bytes, frozen:bytes):
+        if len(frozen) > self.max_bytes: return
+        with self._lock:
+            if key in self.entries:
+                self.bytes -= len(self.entries.pop(key))
+            self.entries[key] = frozen
+            self.bytes += len(frozen)
+            while self.bytes > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.bytes -= len(evicted)
+                self.evictions += 1
+
+    def resize(self, max_bytes:int):
+        '''
+            Sets the memory budget, dropping least recently used objects until the store fits in it
+        '''
+        with self._lock:
+            self.max_bytes = max_bytes
+            while self.bytes > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.bytes -= len(evicted)
+                self.evictions += 1
+
+    def _clear(self):
+        self.entries.clear()
+        self.bytes = 0
+
+    def clear(self):
+        with self._lock:
+            self._clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {'entries': len(self.entries), 'bytes': self.bytes, 'hits': self.hits, 'misses': self.misses,
+                    'evictions': self.evictions, 'uncacheable': self.uncacheable, 'hit_rate': self.hits/lookups if lookups else 0.0}
+
+#Process wide, every worker process keeps its own store sized by its ExecutionPool
+object_store = ObjectStore()
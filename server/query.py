@@ -2,128 +2,75 @@
 import json
 import shutil
 from typing import Type, Any
-import inspect
 import orjson
 import sys
 import os
 
-# from primitives.configuration import Configuration
-# from primitives.parameter import Parameter
-# from utils import interpolate_griddata
 sys.path.append(os.path.join(os.path.dirname(__file__),'..'))
 
-from core.Apparatus import *
-from core.Executor import *
-from core.Procedure import *
-from core.boundary.boundary import *
-from core.boundary.circle_boundary import *
-from core.boundary.ellipse_boundary import *
-from core.boundary.rectangle_boundary import *
-from core.boundary.triangle_boundary import *
-from core.devices.device import *
-from core.fileparsers.fileparser import *
-from core.fileparsers.g_code_parser import *
-from core.gcode.block_gcode_writer import *
-from core.gcode.gcode_writer import *
-from core.gcode.line_comment import *
-from core.gcode.line_gcode_writer import *
-from core.gcode.scan_gcode_writer import *
-from core.gcode.section_gcode_writer import *
-from core.generators.mandrel_scan_generator import *
-from core.generators.toolpath_generator import *
-from core.layers.layer import *
-from core.machine.fiveaxis_machine import *
-from core.machine.machine import *
-from core.machine.threeaxis_machine import *
-from core.machine.axes.axis import *
-from core.machine.axes.dispenser_axis import *
-from core.machine.axes.endeffector_axis import *
-from core.machine.axes.linear_axis import *
-from core.machine.axes.mixer_axis import *
-from core.machine.axes.rotational_axis import *
-from core.materials.cartridge import *
-from core.materials.material import *
-from core.materials.retractions import *
-from core.materials.syringe import *
-from core.modifiers.bivariate_compliance_modifier import *
-from core.modifiers.bivariate_modifier import *
-from core.modifiers.modifier import *
-from core.modifiers.univariate_compliance_modifier import *
-from core.modifiers.univariate_modifier import *
-from core.motion.alternate_motion import *
-from core.motion.constant_az_motion import *
-from core.motion.elevation_smoothing_motion import *
-from core.motion.motion import *
-from core.motion.speeds_feeds import *
-from core.motion.transitions.leadin_transition import *
-from core.motion.transitions.leadout_transition import *
-from core.motion.transitions.purge_transition import *
-from core.motion.transitions.transition import *
-from core.motion.transitions.transition_position import *
-from core.part.part import *
-from core.setups.mandrel_setup import *
-from core.setups.plate_setup import *
-from core.setups.setup import *
-from core.setups.corrections.corrections import *
-from core.setups.corrections.mandrel_corrections import *
-from core.setups.corrections.plate_corrections import *
-from core.setups.offsets.mandrel_offsets import *
-from core.setups.offsets.offsets import *
-from core.setups.registration.mandrel_registration import *
-from core.setups.registration.plate_registration import *
-from core.setups.registration.registration import *
-from core.structure.structure import *
-from core.structure.conformal.conformal_structure import *
-from core.structure.conformal.hatch_structure import *
-from core.structure.conformal.hexagon_structure import *
-from core.structure.conformal.ring_structure import *
-from core.structure.conformal.spiral_structure import *
-from core.structure.explicit.explicit import *
-from core.structure.explicit.explicit3D_structure import *
-from core.substrate.mandrel import *
-from core.substrate.plate import *
-from core.substrate.substrate import *
-from core.toolpath.toolpath import *
-from geometry.coordinates import *
-from geometry.shape_utils import *
-from geometry.strand import *
-from primitives.array2D import *
-from primitives.configuration import *
-from primitives.control import *
-from primitives.data import *
-from primitives.dependency import *
-from primitives.dynamic import *
-from primitives.file import *
-from primitives.folder import *
-from primitives.mod_map import *
-from primitives.parameter import *
-from primitives.primitive import *
-from primitives.struct import *
-from utils.class_inspect import *
-from utils.decorators import *
-from utils.interpolate_griddata import *
-from utils.parse_data_A3200 import *
-from utils.read_dxf import *
-from utils.resource_path import *
-from utils.uuid_utils import *
+#Framework classes are imported on first use through the class registry, see str_to_class
+from primitives.configuration import Configuration
+from primitives.parameter import Parameter
 from utils.class_inspect import get_subclasses
+from utils.interpolate_griddata import interpolate_griddata
+from server.class_registry import class_registry
+from server.config_store import contents, is_ref, resolve, digest as config_digest
+from server.framing import RawJSON, raw_object
+from server.deserialize import Deserializer
+from server.hierarchy import HierarchyIndex
+from server.layers import generate_layers, supports_parallel
+from server.merkle import hexdigest as merkle_hexdigest
+from server.object_store import object_store
+from server.requirements_cache import RequirementsCache
+from server.toolpath_cache import toolpath_cache
 
 CONSTANTS = ['dbName','dbVersion']
 FILE_EXTENSION = '.fmwk'
 
 def str_to_class(class_name: str) -> Type:
-    try:
-        cls = getattr(sys.modules[__name__], class_name)
-    except AttributeError:
-        raise NameError(f'Class "{class_name}" does not exist.')
+    cls = getattr(sys.modules[__name__], class_name, None)
+    if cls is None:
+        #imports the defining module the first time the class is asked for
+        try:
+            cls = class_registry.get_class(class_name)
+        except AttributeError:
+            raise NameError(f'Class "{class_name}" does not exist.')
     if isinstance(cls, type):
         return cls
     raise TypeError(f'"{class_name}" is not a class')
+
+def get_descendants(cls: Type, *args, **kwargs) -> list[Type]:
+    '''
+        get_subclasses after importing every module that defines a descendant of cls.
+        Modules are imported lazily, so a subclass may not have been created yet
+    '''
+    class_registry.import_descendants(cls.__name__)
+    return get_subclasses(cls, *args, **kwargs)
+
+#get_descendants results and abstractness flags, memoized until the class registry imports new class modules
+hierarchy = HierarchyIndex(get_descendants)
+#default requirements of every class, built from one instance per class
+requirements_cache = RequirementsCache()
+
+def warm_requirements():
+    '''
+        Fills the requirements cache for every concrete Configuration and Parameter class.
+        Runs in a background thread when the server starts
+    '''
+    classnames = {'Configuration', 'Parameter'} | class_registry.descendants('Configuration') | class_registry.descendants('Parameter')
+    classes = []
+    for classname in sorted(classnames):
+        try:
+            cls = str_to_class(classname)
+        except Exception:
+            continue
+        if not hierarchy.isabstract(cls): classes.append(cls)
+    requirements_cache.warm(classes)
     
 def get_all_children_names(parent:str | Type[Any], as_JSON:bool=True)-> list[str] | str:
     if isinstance(parent,str): parent = str_to_class(parent)
-    names = [s.name for s in get_subclasses(parent) if not inspect.isabstract(s)]
-    if as_JSON: names = orjson.dumps(names).decode().encode('utf-8')
+    names = [s.name for s in hierarchy.concrete(parent)]
+    if as_JSON: names = RawJSON.dumps(names)
     return names
 
 def get_all_children_classnames(parent:str | Type[Any], as_JSON:bool=True)-> list[str] | str:
@@ -132,10 +79,10 @@ def get_all_children_classnames(parent:str | Type[Any], as_JSON:bool=True)-> lis
         parent = str_to_class(parent)
     else:
         parent_key = parent.__name__
-    names = [c.__name__ for c in get_subclasses(parent) if not inspect.isabstract(c)]
-    if not inspect.isabstract(parent):
+    names = [c.__name__ for c in hierarchy.concrete(parent)]
+    if not hierarchy.isabstract(parent):
         names.insert(0,parent_key)
-    if as_JSON: names = orjson.dumps(names).decode().encode('utf-8')
+    if as_JSON: names = RawJSON.dumps(names)
     return names
 
 def get_all_children_descriptions(parent: str | Type[Any], as_JSON:bool=True) -> dict | str:
@@ -146,76 +93,78 @@ def get_all_children_descriptions(parent: str | Type[Any], as_JSON:bool=True) ->
         parent_key = parent.__name__
     
     descriptions: list[dict] = [{'classname': c.__name__, 'name':c.name, 'description':c.description} 
-                                for c in get_subclasses(parent) if not inspect.isabstract(c) and not hasattr(c, 'ISOLATE')] 
+                                for c in hierarchy.concrete(parent) if not hasattr(c, 'ISOLATE')] 
     
-    if not inspect.isabstract(parent):
+    if not hierarchy.isabstract(parent):
         descriptions.insert(0,{'classname':parent.__name__, 'name':parent.name, 'description':parent.description})
     
     descriptions: dict = {parent_key:descriptions}
-    if as_JSON: descriptions: str = orjson.dumps(descriptions).decode().encode('utf-8')
+    if as_JSON: descriptions: str = RawJSON.dumps(descriptions)
     return descriptions
 
 def get_child_description(parent: str | Type[Any], child_name:str, as_JSON:bool=True)->dict | str:
     if isinstance(parent,str): parent = str_to_class(parent)
-    description:list[str] = [c.description for c in get_subclasses(cls=parent, match=child_name) if not inspect.isabstract(c)]
+    description:list[str] = [c.description for c in hierarchy.concrete(parent, child_name)]
     description:dict = {child_name:description}
-    if as_JSON: description:str = orjson.dumps(description).decode().encode('utf-8')
+    if as_JSON: description:str = RawJSON.dumps(description)
     return description
 
 def get_description(cls: str | Type[Configuration] | Type[Parameter], as_JSON:bool = True) -> str:
     if isinstance(cls,str): cls = str_to_class(cls)
     description:str = cls.description
-    if as_JSON: description = orjson.dumps(description).decode().encode('utf-8')
+    if as_JSON: description = RawJSON.dumps(description)
     return description
 
 def get_all_children_requirements(parent, as_JSON:bool = True) -> dict[str,Any] :
     if isinstance(parent,str):
         parent = str_to_class(parent)
-    else:
-        parent_key = parent.__name__
-    names = get_all_children_classnames(parent,as_JSON=False)
-    requirements = [c().requirements for c in get_subclasses(parent) if not inspect.isabstract(c)]
-
-    requirements = dict(zip(names,requirements))
+    parent_key = parent.__name__
+    classes = list(hierarchy.concrete(parent))
+    if not hierarchy.isabstract(parent): classes.insert(0,parent)
+    if as_JSON:
+        return raw_object([(parent_key, raw_object([(c.__name__, requirements_cache.get_raw(c)) for c in classes]))])
+    requirements = {c.__name__: requirements_cache.get(c) for c in classes}
     requirements = {parent_key: requirements}
-    if as_JSON: requirements = orjson.dumps(requirements, option=orjson.OPT_SERIALIZE_NUMPY).decode().encode('utf-8')
     return requirements
 
 def get_child_requirements(parent, child_name, as_JSON=True):
     if isinstance(parent,str): parent = str_to_class(parent)
-    requirements = [c().requirements for c in get_subclasses(parent,child_name) if not inspect.isabstract(c)]
+    classes = hierarchy.concrete(parent, child_name)
+    if as_JSON:
+        return raw_object([(child_name, RawJSON(b'[' + b','.join(requirements_cache.get_raw(c) for c in classes) + b']'))])
+    requirements = [requirements_cache.get(c) for c in classes]
     requirements = {child_name:requirements}
-    if as_JSON: requirements = orjson.dumps(requirements).decode().encode('utf-8')
     return requirements
 
 def get_all_requirements(cls,as_JSON=True):
     if isinstance(cls,str): cls = str_to_class(cls)
-    if inspect.isabstract(cls):
+    if hierarchy.isabstract(cls):
         children = get_all_children_classnames(cls.__name__, False)
         requirements = f"'{cls.__name__}' is an abstract class and cannot be directly initialized. Try get_all_children_requirements() searching for requirements of all children: {children}"
+    elif as_JSON:
+        return raw_object([(cls.__name__, requirements_cache.get_raw(cls))])
     else:
-        requirements =  cls().requirements
+        requirements = requirements_cache.get(cls)
     requirements = {cls.__name__: requirements}
-    if as_JSON: requirements = orjson.dumps(requirements, option=orjson.OPT_SERIALIZE_NUMPY).decode().encode('utf-8')
+    if as_JSON: requirements = RawJSON.dumps(requirements)
     return requirements
 
 def get_all_simple_requirements(cls, as_JSON=True):
-    if isinstance(cls,str): cls = str_to_class(cls)
-    if inspect.isabstract(cls):
-        children = get_all_children_classnames(cls.__name__, False)
-        requirements = f"'{cls.__name__}' is an abstract class and cannot be directly initialized. Try get_all_children_requirements() searching for requirements of all children: {children}"
-    else:
-        requirements =  cls().requirements
-    requirements = {cls.__name__: requirements}
-    if as_JSON: requirements = orjson.dumps(requirements, option=orjson.OPT_SERIALIZE_NUMPY).decode().encode('utf-8')
-    return requirements
-
-def get_all_hashes(cls, control_type, digest_only=True, as_JSON=True):
+    return get_all_requirements(cls, as_JSON=as_JSON)
+
+def get_all_hashes(cls, control_type, digest_only=True, as_JSON=True, structural=False):
+    '''
+        The hashes of cls for control_type, or their digest. A config dict or live config reference is built first.
+        structural -> digest the hashes as a Merkle tree instead of SHA-256 of their indented JSON text.
+                      The digests differ from the default ones, compare them only with structural digests
+    '''
     if isinstance(cls,str): cls=str_to_class(cls)
-    # if isinstance(cls, dict): get_class_from_dict(cls)
+    elif isinstance(cls, dict): cls = resolve_config(cls)
     hashes = cls.hash(control_type=control_type)
     if digest_only:
-        if hashes:
+        if hashes and structural:
+            hashes = merkle_hexdigest(hashes)
+        elif hashes:
             import json
             import hashlib
             hashes = json.dumps(hashes, indent=4, sort_keys=True).encode('utf-8')
@@ -226,9 +175,22 @@ def get_all_hashes(cls, control_type, digest_only=True, as_JSON=True):
             hashes=''
 
     hashes = {'hash':hashes}
-    if as_JSON: hashes = orjson.dumps(hashes, option=orjson.OPT_SERIALIZE_NUMPY).decode().encode('utf-8')
+    if as_JSON: hashes = RawJSON.dumps(hashes)
     return hashes
-            
+
+def get_config_digest(config:dict, as_JSON=True):
+    '''
+        Structural digest of a config dict or of a live config. A live config keeps the digest of every subtree,
+        after a patch only the changed paths are hashed again, so a repeated check of a large setup costs the depth of the change
+    '''
+    if is_ref(config):
+        config_hash = config_digest(config)
+    else:
+        config_hash = merkle_hexdigest(config)
+    config_hash = {'hash':config_hash}
+    if as_JSON: config_hash = RawJSON.dumps(config_hash)
+    return config_hash
+
 def hash_parameter(parameter, as_JSON=True):
     if parameter.__class__.__name__ == 'dict':
         parameter = create_parameter_from_dict(parameter)
@@ -236,7 +198,10 @@ def hash_parameter(parameter, as_JSON=True):
         raise Exception('The provided data is not a valid Parameter object')
     
     parameter.hash()
-    if as_JSON: return parameter.to_json()
+    if as_JSON:
+        #spliced into the response as is instead of being sent as a JSON string
+        parameter_json = parameter.to_json()
+        return RawJSON(parameter_json.encode() if isinstance(parameter_json, str) else parameter_json)
     return parameter
 
 def hash_controlled_value(control, value, as_JSON=True):
@@ -258,132 +223,31 @@ def hash_controlled_value(control, value, as_JSON=True):
             raise Exception(f'Provided Input was of type {control.__class__.__name__}. Input must be a dictionary in the form of the Control requirements: {json.dumps(newC.requierments, indent=4,sort_keys=True)}')
         
     control_hash = {'hash':control_hash}
-    if as_JSON: control_hash = json.dumps(control_hash,indent=True,sort_keys=True)
+    if as_JSON: control_hash = RawJSON.dumps(control_hash, option=orjson.OPT_SORT_KEYS | orjson.OPT_SERIALIZE_NUMPY)
+    return control_hash
 
 def get_child_obj_by_name(parent,child_name):
     if isinstance(parent,str): parent = str_to_class(parent)
-    child_list = [c() for c in get_subclasses(parent,child_name)]
+    child_list = [c() for c in hierarchy.subclasses(parent, child_name)]
     return child_list[0]
 
+#builds objects from config dicts with a plan per classname instead of inspecting every node
+deserializer = Deserializer(str_to_class, lambda obj, dependencies: update_with_dependencies(obj, dependencies, False), CONSTANTS)
+
 def create_parameter_from_dict(parameter_dict, parameter=None):
-    if 'classname' not in parameter_dict.keys():
-        raise Exception('Provided dictionary does not include the required key "classname"')
-    if parameter_dict['classname'] != 'Parameter':
-        raise Exception('Provided dictionary is not of type "Parameter". Cannot create class from the provided arguments')
-    
-    if parameter is None:
-        parameter = str_to_class('Parameter')
-        parameter = parameter()
-    primitives = ['str', 'float', 'int','bool']
-    requirements = parameter.requirements
-    for key in parameter_dict:
-        if key in requirements:
-            #DETERMINE the parameter's data type:
-            if parameter_dict[key].__class__.__name__ in primitives:
-                value_type = 'primitive'
-            elif parameter_dict[key].__class__.__name__ == 'list':
-                if len(parameter_dict[key]) > 0:
-                    if all([v.__class__.__name__ in primitives for v in parameter_dict[key]]):
-                        value_type = 'list of primitives'
-                    else:
-                        #This will also catch mixed in primitives, see below
-                        value_type = 'list of objects'
-                else:
-                    value_type = 'primitive'
-            else:
-                value_type = 'object'
-            
-            if value_type == 'primitive' or value_type == 'list of primitives':
-                setattr(parameter,key,parameter_dict[key])
-            elif value_type == 'object':
-                #check if the provided object is a valid framework class
-                value = get_class_from_dict(parameter_dict[key])
-                setattr(parameter, key, value)
-            elif value_type == 'list of objects':
-                # For each list item, create the class. Will be either Parameter or Configuration type
-                new_list = []
-                for object_dict in parameter_dict[key]:
-                    #check for primitives mixed in with objects
-                    if object_dict.__class__.__name__ in primitives:
-                        value = object_dict
-                    else:
-                        value = get_class_from_dict(object_dict)
-                    new_list.append(value)
-                setattr(parameter,key, new_list)
-    return parameter
+    return deserializer.build_parameter(parameter_dict, parameter=parameter)
 
 def get_class_from_dict(parameter_dict:dict):
-    if 'classname' not in parameter_dict.keys():
-        raise Exception('ERROR:query.get_class_from_dict -- Provided dictionary does not include the required key "classname"')
-    try:
-        cls = str_to_class(parameter_dict['classname'])
-        cls = cls()
-    except:
-        raise Exception(f'ERROR:query.get_class_from_dict -- Could not create the class {parameter_dict["classname"]}. Make sure this class exists and is visible to query imports.')
-    
-    requirements = cls.requirements
-    for key in parameter_dict:
-        if key in requirements:
-            parameter = None
-            #Determine if the key is a nested parameter or another framework Configuration class
-            if parameter_dict[key].__class__.__name__ == 'dict':
-                if 'classname' in parameter_dict[key]:
-                    if parameter_dict[key]['classname'] == 'Parameter':
-                        #it's a Parameter object
-                        default_parameter = getattr(cls,key)
-                        if default_parameter.__class__.__name__ == 'Parameter':
-                            parameter = create_parameter_from_dict(parameter_dict[key], parameter=default_parameter)
-                    else:
-                        #it's a framework Configuration class
-                        parameter = get_class_from_dict(parameter_dict[key])
-                else:
-                    raise Exception(f'The key "classname" must be provided at every level of the config tree. No classname key found for object {key}')
-            #If neither, then it's a custom class or framework Primitive
-            elif parameter_dict[key].__class__.__name__ == 'list':
-                new_list = []
-                for objDict in parameter_dict[key]:
-                    if objDict.__class__.__name__ == 'dict':
-                        val = get_class_from_dict(objDict)
-                    else:
-                        val = objDict
-                    new_list.append(val)
-                parameter = new_list
-            else:
-                parameter = parameter_dict[key]
-
-            if parameter is not None: setattr(cls, key, parameter)
-            elif key in CONSTANTS:
-                parameter = parameter_dict[key]
-                parameter = create_parameter_from_dict[parameter_dict[key]]
-                if parameter is not None: setattr(cls, key, parameter)
-            #CHECK if the dictionary key is a valid class property on dynamic class objects
-            elif 'Dynamic' in [base_cls.__name__ for base_cls in type(cls).__bases__]:
-                try:
-                    if parameter_dict[key].__class__.__name__ == 'dict' and 'classname' in parameter_dict[key]:
-                        parameter_dict[key] = get_class_from_dict(parameter_dict[key])
-
-                    #Evaluate property method should throw exception if value is invalid
-                    verified_value = cls.evaluate_property(key,parameter_dict[key])
-                    parameter_dict[key] = verified_value
-
-                    #Initialize the class key to none, proceed to evaluate further
-                    if key not in cls.__dict__.keys():
-                        setattr(cls, key, verified_value)
-                except:
-                    #Ignore invalid properties
-                    pass
-
-                    #Alternate implementation - place exceptions here
-            else:
-                #Handle any other cases here
-                # print(f'Generating class {parameter_dict["classname"]}: Ignoring key {key} for Parameter')
-                pass
+    return deserializer.build(parameter_dict)
 
-            #UPDATE with dependencies after all parameters have been set
-            if 'found_dependencies' in parameter_dict:
-                update_with_dependencies(cls, parameter_dict['found_dependencies'],False)
-
-    return cls
+def resolve_config(config:dict):
+    '''
+        A private copy of the objects of a config dict, built once per content and kept in the object store,
+        or of a live config when config is a reference {'config_id', 'version'?} to one opened with config.open,
+        see server/config_store.py
+    '''
+    if is_ref(config): return resolve(config)
+    return object_store.get(config, get_class_from_dict)
 
 def update_with_dependencies(class_dict, dependencies:list, as_JSON=True):
     if class_dict.__class__.__name__ == 'dict':
@@ -402,7 +266,7 @@ def update_with_dependencies(class_dict, dependencies:list, as_JSON=True):
     # params = [p for p in class_dict.keys() if class_dict[p].__class__.__name__ == 'dict' and p in cls.requirements.keys() and class_dict[p]['classname']=='Parameter']
 
     #Faster check method, but potentially less accurate, assumes true Parameter dictionaries have a "classname" field:
-    if class_dict.__class.__name__ == 'dict':
+    if class_dict.__class__.__name__ == 'dict':
         params = [p for p in class_dict.keys() if class_dict[p].__class__.__name__ == 'dict' and 'classname' in class_dict[p] and class_dict[p]['classname']=='Parameter']
         dep_keys = [k for k in params if 'Dependency' in class_dict[k]['allowed_types']]
     else:
@@ -423,27 +287,29 @@ def update_with_dependencies(class_dict, dependencies:list, as_JSON=True):
             raise Exception(f'The provided Class {cls.name} must be a valid framework Configuration class with a callable method "evaluate_dependencies()" to perform dependency updates.')
         
     if as_JSON:
-        cls = orjson.dumps(cls.requirements,option=orjson.OPT_SERIALIZE_NUMPY).decode()
+        cls = RawJSON.dumps(cls.requirements)
     return cls
 
 
 def generate_structure( substrate:dict, structure:dict):
     import numpy as np
-    substrate = get_class_from_dict(substrate)
-    structure = get_class_from_dict(structure)
+    substrate = resolve_config(substrate)
+    structure = resolve_config(structure)
     structure.substrate = substrate
     structure.generateCoordinates()
     data = structure.toDict(precision=4)
     #RESHAPE the coords for optimizxed rendering in UI (UI uses Y axis as Vertical for rendering)
-    xyz = np.array(data['X'],data['Z'],data['Y']).T
+    xyz = np.array([data['X'],data['Z'],data['Y']]).T
     result = {}
     result['xyz'] = np.ascontiguousarray(xyz)
     result['xyz_flat'] = xyz.flatten()
     result['details'] = structure.getDetails(precision=4)
+    #arrays are returned as is so they can be sent as binary frames
+    return result
 
-def generate_toolpath(part:dict,setup:dict, activeSetup:int, output_dir:str):
-    part = get_class_from_dict(part)
-    setup = get_class_from_dict(setup)
+def _toolpath_generator(part:dict, setup:dict, activeSetup:int, output_dir:str):
+    part = resolve_config(part)
+    setup = resolve_config(setup)
     setup.activeSetup = activeSetup
     toolpath = str_to_class('Toolpath')()
     toolpath_generator = str_to_class('ToolpathGenerator')()
@@ -453,17 +319,15 @@ def generate_toolpath(part:dict,setup:dict, activeSetup:int, output_dir:str):
     toolpath_generator.setup = setup
     toolpath_generator.output_folder = output_dir
     toolpath_generator.toolpath = toolpath
-    result = toolpath_generator.generateAllLayers(output_dir=output_dir, return_precision=3)
-    result = orjson.dumps(result, option=orjson.OPT_SERIALIZE_NUMPY).decode()
-    return result
+    return toolpath_generator
 
-def generate_toolpath_2(part,setup,activeSetup:int,output_dir:str, details:dict,startFileTemplates:list, printlabel:bool):
-    part_config = get_class_from_dict(part[part['configType']])
-    setup_config = get_class_from_dict(setup[setup['configType']])
+def _toolpath_generator_2(part,setup,activeSetup:int,output_dir:str,startFileTemplates:list, printlabel:bool):
+    part_config = resolve_config(part[part['configType']])
+    setup_config = resolve_config(setup[setup['configType']])
     setup_config.activeSetup = activeSetup
     sft_configs = []
     for sft in startFileTemplates:
-        sft_configs.append(get_class_from_dict(sft[sft['configType']]))
+        sft_configs.append(resolve_config(sft[sft['configType']]))
     toolpath = str_to_class('Toolpath')()
     toolpath_generator = str_to_class('ToolpathGenerator')()
     toolpath.part = part_config
@@ -474,40 +338,103 @@ def generate_toolpath_2(part,setup,activeSetup:int,output_dir:str, details:dict,
     toolpath_generator.toolpath = toolpath
     toolpath_generator.startFileTemplates = sft_configs
     toolpath_generator.printLabel = printlabel
-    result = toolpath_generator.generateAllLayers(output_dir=output_dir,return_precision=3,details=details,printlabel=printlabel)
-    result = orjson.dumps(result, option=orjson.OPT_SERIALIZE_NUMPY).decode()
-    return result
+    return toolpath_generator
+
+def iter_layers(result):
+    '''
+        Splits a generateAllLayers result into its top level entries, one per layer,
+        so each can be serialized and sent on its own
+    '''
+    if isinstance(result, dict):
+        for key, layer in result.items():
+            yield {key: layer}
+    elif isinstance(result, (list, tuple)):
+        yield from result
+    else:
+        yield result
+
+def generate_toolpath(part:dict,setup:dict, activeSetup:int, output_dir:str, parallel:int=0):
+    '''
+        parallel -> worker processes generating independent layers at the same time, see server/layers.py
+    '''
+    toolpath_generator = _toolpath_generator(part, setup, activeSetup, output_dir)
+    result = generate_layers(toolpath_generator, parallel, output_dir=output_dir, return_precision=3)
+    return RawJSON.dumps(result)
+
+def generate_toolpath_2(part,setup,activeSetup:int,output_dir:str, details:dict,startFileTemplates:list, printlabel:bool, parallel:int=0,
+                        use_cache:bool=True):
+    '''
+        parallel -> worker processes generating independent layers at the same time, see server/layers.py
+        use_cache -> answer from the toolpath cache, with its G-code files, when these inputs were generated before
+    '''
+    def generate():
+        toolpath_generator = _toolpath_generator_2(part, setup, activeSetup, output_dir, startFileTemplates, printlabel)
+        result = generate_layers(toolpath_generator, parallel, output_dir=output_dir,return_precision=3,details=details,printlabel=printlabel)
+        return RawJSON.dumps(result)
+    if not use_cache: return generate()
+    #live configs are keyed by their content, not their id
+    inputs = {'part':contents(part), 'setup':contents(setup), 'activeSetup':activeSetup, 'details':details,
+              'startFileTemplates':contents(startFileTemplates), 'printlabel':printlabel}
+    return toolpath_cache.cached(inputs, output_dir, generate)
+
+def stream_layers(toolpath_generator, **kwargs):
+    '''
+        Yields every layer as soon as it is generated when the generator has the per layer methods of
+        server/layers.py, mergeLayers then writes the program files from the layers already sent.
+        Other generators yield the entries of generateAllLayers once it returns
+    '''
+    if supports_parallel(toolpath_generator):
+        results = []
+        for layer in toolpath_generator.plan_layers(**kwargs):
+            results.append(toolpath_generator.generateLayer(layer, **kwargs))
+            for chunk in iter_layers(results[-1]):
+                yield RawJSON.dumps(chunk)
+        toolpath_generator.mergeLayers(results, **kwargs)
+        return
+    for layer in iter_layers(toolpath_generator.generateAllLayers(**kwargs)):
+        yield RawJSON.dumps(layer)
+
+def stream_toolpath(part:dict,setup:dict, activeSetup:int, output_dir:str):
+    '''
+        Same as generate_toolpath but yields the result layer by layer instead of one JSON string
+    '''
+    toolpath_generator = _toolpath_generator(part, setup, activeSetup, output_dir)
+    yield from stream_layers(toolpath_generator, output_dir=output_dir, return_precision=3)
+
+def stream_toolpath_2(part,setup,activeSetup:int,output_dir:str, details:dict,startFileTemplates:list, printlabel:bool):
+    '''
+        Same as generate_toolpath_2 but yields the result layer by layer instead of one JSON string
+    '''
+    toolpath_generator = _toolpath_generator_2(part, setup, activeSetup, output_dir, startFileTemplates, printlabel)
+    yield from stream_layers(toolpath_generator, output_dir=output_dir,return_precision=3,details=details,printlabel=printlabel)
 
 def generate_scan(setup:dict, activeSetup:int, output_folder:None):
-    setup = get_class_from_dict(setup)
+    setup = resolve_config(setup)
     setup.activeSetup=activeSetup
     scan_preset = str_to_class('Scan_Preset')()
     scan_preset.setup = setup
     scan_path = scan_preset.generate_scan(output_folder=output_folder)
     result = {'scan_path':scan_path,'setup':setup.requirements}
-    result = orjson.dumps(result,option=orjson.OPT_SERIALIZE_NUMPY).decode()
-    return result
+    return RawJSON.dumps(result)
 
 def processScan(setup:dict, activeSetup:int, zipFile:str):
-    setup = get_class_from_dict(setup)
+    setup = resolve_config(setup)
     setup.activeSetup = activeSetup
     scan = setup.get_active_scan()
     if scan:
         filepath = scan.processMapScan(zipFile=zipFile)
-        return orjson.dumps({'Filepath':filepath})
+        return RawJSON.dumps({'Filepath':filepath})
     
 def process_offsets(setup:dict, rotateReadFile:str, activeSetup:int):
-    setup = get_class_from_dict(setup)
+    setup = resolve_config(setup)
     setup.activeSetup = activeSetup
     setup.process_offsets(rotateReadFile=rotateReadFile)
     result = {'setup':setup.requirements}
-    result = orjson.dumps(result,option=orjson.OPT_SERIALIZE_NUMPY).decode()
-    return result
+    return RawJSON.dumps(result)
 
 def interpolate_grid(IV1,IV2,DV):
     result = interpolate_griddata(ind_var_1=IV1, ind_var_2=IV2, dep_var=DV)
-    result = orjson.dumps(result,option=orjson.OPT_SERIALIZE_NUMPY).decode()
-    return result
+    return RawJSON.dumps(result)
 
 def calculateScanCorrections(vertices,scanFile):
     import numpy as np
@@ -516,7 +443,7 @@ def calculateScanCorrections(vertices,scanFile):
     #Create a new coordinates object
     coordinates = str_to_class('Coordinates')()
     #Reshape the vertices
-    xyz = np.reshape(vertices,(int(len(vertices/3),3))).T
+    xyz = np.reshape(vertices,(int(len(vertices)/3),3)).T
     #incoming vertices has Z column in second column, swap to third column
     xyz[[1,2]] = xyz[[2,1]]
     #convert vertices from cartesian to polar
@@ -527,24 +454,24 @@ def calculateScanCorrections(vertices,scanFile):
     coordinates.Polar = polar
     coordinates.Az = az
 
-    scanFile = get_class_from_dict(scanFile)
+    scanFile = resolve_config(scanFile)
 
     corrections = mandrel.calculateScanCorrections(coordinates=coordinates, scanFile=scanFile.local_filepath)
 
-    #serialize to json
-    result = orjson.dumps({'corrections':corrections, 'min':corrections.min(),'max':corrections.max()}, options=orjson.OPT_SERIALIZE_NUMPY).decode()
+    #corrections grid is returned as an array so it can be sent as a binary frame
+    result = {'corrections':corrections, 'min':float(corrections.min()),'max':float(corrections.max())}
     return result
 
 def save_config(config_dict:dict):
     config_type = config_dict['configType']
     config = config_dict[config_type]
-    config = get_class_from_dict(config)
+    config = resolve_config(config)
     return config.simple_requirements
 
 def load_config(config_dict:dict):
     config_type = config_dict['configType']
     config = config_dict[config_type]
-    config = get_class_from_dict(config)
+    config = resolve_config(config)
     return config.requirements
 
 def export_config(dir_path:str,config_dict:dict,downloaded_files:list):
@@ -0,0 +1,87 @@
+import threading
+import time
+
+import orjson
+
+from server.class_registry import class_registry
+from server.framing import RawJSON
+
+class RequirementsCache():
+    name = 'Requirements Cache'
+    description = 'Default requirements of every class, serialized once and decoded into a private copy per request'
+
+    def __init__(self, registry = class_registry, exclude:set[str] | None = None) -> None:
+        '''
+            registry -> ClassRegistry whose generation invalidates the cache when the source tree changes
+            exclude -> class names whose requirements are built from a new instance on every request
+
+            The cached requirements come from one default instance. Anything that differs per instance,
+            such as a uuid generated in __init__, is the same in every copy handed out. Classes relying on
+            that belong in exclude
+        '''
+        self.registry = registry
+        self.exclude = set(exclude or ())
+        self.entries: dict[type, bytes] = {}
+        self.uncacheable: set[type] = set()
+        self.hits = 0
+        self.misses = 0
+        self._generation = registry.generation
+        self._lock = threading.Lock()
+
+    def _check(self):
+        if self.registry.generation == self._generation: return
+        with self._lock:
+            self.entries = {}
+            self.uncacheable = set()
+            self._generation = self.registry.generation
+
+    def _frozen(self, cls:type) -> bytes | None:
+        self._check()
+        frozen = self.entries.get(cls)
+        if frozen is not None:
+            self.hits += 1
+            return frozen
+        if cls in self.uncacheable or cls.__name__ in self.exclude: return None
+        self.misses += 1
+        try:
+            frozen = orjson.dumps(cls().requirements, option=orjson.OPT_SERIALIZE_NUMPY)
+        except TypeError:
+            #requirements holding objects orjson cannot serialize are never cached
+            self.uncacheable.add(cls)
+            return None
+        self.entries[cls] = frozen
+        return frozen
+
+    def get(self, cls:type):
+        '''
+            A private copy of the default requirements of cls, the caller may change it freely
+        '''
+        frozen = self._frozen(cls)
+        if frozen is None: return cls().requirements
+        return orjson.loads(frozen)
+
+    def get_raw(self, cls:type) -> RawJSON:
+        '''
+            The default requirements of cls, serialized, to splice into a response without decoding
+        '''
+        frozen = self._frozen(cls)
+        if frozen is None: return RawJSON.dumps(cls().requirements)
+        return RawJSON(frozen)
+
+    def warm(self, classes):
+        '''
+            Fills the cache for every class. Classes failing to instantiate are skipped,
+            their requests report the error when they ask for them
+        '''
+        for cls in classes:
+            try:
+                self._frozen(cls)
+            except Exception:
+                pass
+            #hands the GIL back to the event loop between classes
+            time.sleep(0)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {'entries': len(self.entries), 'bytes': sum(map(len, list(self.entries.values()))),
+                'hits': self.hits, 'misses': self.misses, 'hit_rate': self.hits/lookups if lookups else 0.0}
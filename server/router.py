@@ -1,19 +1,384 @@
+from collections import OrderedDict
+import asyncio
+import hashlib
+import orjson
+import time
+import traceback
+
 from utils.decorators import route_handlers
+from server.class_registry import class_registry
+from server.config_store import ConfigStore, config_store
+from server.execution import ExecutionPool, INLINE, THREAD, PROCESS
+from server.framing import RawJSON, dumps, raw_array
+from server.metrics import Metrics, registry
+
+#Execution modes for actions registered outside of server.routes
+#Handlers marked with @execution take their own mode unless overridden here
+DEFAULT_EXECUTION_MODES = {
+    'query.generate_toolpath'         : PROCESS,
+    'query.generate_toolpath_2'       : PROCESS,
+    'query.generate_scan'             : PROCESS,
+    'query.generate_structure'        : PROCESS,
+    'query.processScan'               : PROCESS,
+    'query.process_offsets'           : PROCESS,
+    'query.interpolate_grid'          : PROCESS,
+    'query.calculateScanCorrections'  : PROCESS,
+}
+
+#Largest number of sub-requests accepted in one batch request
+MAX_BATCH_SIZE = 1000
+
+#Actions registered outside of server.routes whose identical in-flight requests share one computation
+DEFAULT_SINGLE_FLIGHT = {
+    'query.generate_toolpath',
+    'query.generate_toolpath_2',
+    'query.generate_scan',
+    'query.generate_structure',
+    'query.interpolate_grid',
+}
+
+def single_flight(func):
+    '''
+        Marks a route handler whose identical concurrent requests may share a single computation.
+        Handlers marked @cached are always single flight. Place below @route
+    '''
+    func.single_flight = True
+    return func
+
+def cached(func):
+    '''
+        Marks a deterministic route handler whose result only depends on its value.
+        The Router answers repeated requests from its ResultCache. Place below @route
+    '''
+    func.cached = True
+    return func
+
+def request_key(action:str, value) -> str:
+    '''
+        Canonical key of a request: the action plus a hash of its value with sorted keys
+    '''
+    canonical = orjson.dumps(value, option=orjson.OPT_SORT_KEYS | orjson.OPT_SERIALIZE_NUMPY)
+    return f'{action}:{hashlib.blake2b(canonical, digest_size=16).hexdigest()}'
+
+class ResultCache():
+    name = 'Result Cache'
+    description = 'LRU cache of serialized route results, bounded by entry count and bytes'
+
+    def __init__(self, max_entries:int = 1024, max_bytes:int = int(1000000*64)) -> None:
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries: OrderedDict[str, RawJSON] = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key:str) -> RawJSON | None:
+        result = self.entries.get(key)
+        if result is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return result
+
+    def put(self, key:str, result:RawJSON):
+        if len(result) > self.max_bytes: return
+        if key in self.entries:
+            self.bytes -= len(self.entries.pop(key))
+        self.entries[key] = result
+        self.bytes += len(result)
+        while len(self.entries) > self.max_entries or self.bytes > self.max_bytes:
+            _, evicted = self.entries.popitem(last=False)
+            self.bytes -= len(evicted)
+            self.evictions += 1
+
+    def clear(self):
+        self.entries.clear()
+        self.bytes = 0
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {'entries': len(self.entries), 'bytes': self.bytes, 'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions, 'hit_rate': self.hits/lookups if lookups else 0.0}
+
+class Computation():
+    name = 'Computation'
+    description = 'A shared in-flight computation and the number of requests waiting on it'
+
+    def __init__(self, future:asyncio.Future) -> None:
+        self.future = future
+        self.waiters = 0
 
 class Router():
     name = 'Router'
     description = 'Handles routes for all endpoints'
 
-    def __init__(self):
+    def __init__(self, pool:ExecutionPool | None = None, execution_modes:dict[str,str] | None = None, cache:ResultCache | None = None,
+                 metrics:Metrics | None = None, configs:ConfigStore | None = None, batch_concurrency:int = 32, classes = class_registry):
+        '''
+            pool -> ExecutionPool used to run the route handlers
+            execution_modes -> per action overrides of the handler execution mode
+            cache -> ResultCache for handlers marked @cached
+            metrics -> Metrics receiving per action counts and latencies, defaults to the process wide registry
+            configs -> ConfigStore resolving the live config references in request values, defaults to the process wide store
+            batch_concurrency -> sub-requests of one batch running at the same time, the max_in_flight of a connection
+            classes -> ClassRegistry whose generation empties the cache when the source tree changes
+        '''
         self.routes = route_handlers
+        self.cache = cache if cache is not None else ResultCache()
+        self.single_flight_actions = set(DEFAULT_SINGLE_FLIGHT)
+        self.in_flight: dict[str, Computation] = {}
+        self.coalesced = 0
+        self.running: dict[str, asyncio.Task] = {}
+        self.metrics = metrics if metrics is not None else registry
+        self.metrics.add_source('cache', self.cache.stats)
+        self.metrics.add_source('single_flight', self.single_flight_stats)
+        self.pool = pool if pool is not None else ExecutionPool()
+        self.metrics.add_source('pool', self.pool.stats)
+        self.execution_modes = dict(DEFAULT_EXECUTION_MODES)
+        if execution_modes: self.execution_modes.update(execution_modes)
+        self.all_routes_imported = False
+        self.configs = configs if configs is not None else config_store
+        self.metrics.add_source('configs', self.configs.stats)
+        self.batch_concurrency = batch_concurrency
+        self.classes = classes
+        self._generation = classes.generation
+
+    def has_route(self, action) -> bool:
+        '''
+            Route modules are imported on first use of one of their actions. An action the class registry
+            does not know imports every route module once, for handlers registered under computed names
+        '''
+        if action in self.routes: return True
+        if not isinstance(action, str): return False
+        if not class_registry.import_route(action) and not self.all_routes_imported:
+            self.all_routes_imported = True
+            from server.routes import import_all
+            import_all()
+        return action in self.routes
+
+    def pin(self, action:str, value):
+        '''
+            value with its live config references pinned to their current version, see ConfigStore.pin.
+            The config.* actions take config ids as they are
+        '''
+        if isinstance(action, str) and action.startswith('config.'): return value
+        return self.configs.pin(value)
+
+    def execution_mode(self, action:str) -> str:
+        if action in self.execution_modes:
+            return self.execution_modes[action]
+        return getattr(self.routes[action], 'execution_mode', THREAD)
+
+    def metrics_label(self, action) -> str:
+        '''
+            Action name used in the metrics. Unknown actions share one label so clients cannot grow the registry
+        '''
+        return action if action in ('metrics', 'cancel', 'batch') or self.has_route(action) else 'unknown'
+
+    def is_streaming(self, action:str) -> bool:
+        return self.has_route(action) and getattr(self.routes[action], 'streaming', False)
 
-    def route_request(self, request):
+    async def stream_request(self, request):
+        '''
+            Routes a request to a streaming handler.
+            Yields a partial response per chunk, tagged with a sequence number, then a final done response
+        '''
+        action = request.get('action')
+        uuid = request.get('uuid')
+        value = self.pin(action, request.get('value'))
+
+        start = time.perf_counter()
+        ok = False
+        untrack = self.track(uuid)
+        try:
+            seq = 0
+            async for chunk in self.pool.stream(self.execution_mode(action), action, uuid, value):
+                yield {'action':action, 'value':chunk, 'status':'partial', 'uuid':uuid, 'seq':seq}
+                seq += 1
+            ok = True
+            yield {'action':action, 'value':{'frames':seq}, 'status':'done', 'uuid':uuid, 'seq':seq}
+        finally:
+            untrack()
+            self.metrics.observe(self.metrics_label(action), time.perf_counter()-start, ok)
+
+    def is_single_flight(self, action:str) -> bool:
+        handler = self.routes[action]
+        return action in self.single_flight_actions or getattr(handler, 'single_flight', False) or getattr(handler, 'cached', False)
+
+    def single_flight_stats(self) -> dict:
+        return {'in_flight': len(self.in_flight), 'coalesced': self.coalesced}
+
+    async def call(self, action:str, uuid:str, value):
+        '''
+            Runs the handler for action. Cached handlers are answered from the cache when possible
+            and identical requests already in flight attach to the running computation
+        '''
+        if not self.is_single_flight(action):
+            return await self.pool.run(self.execution_mode(action), action, uuid, value)
+        try:
+            key = request_key(action, value)
+        except TypeError:
+            #values that cannot be hashed canonically are never shared
+            return await self.pool.run(self.execution_mode(action), action, uuid, value)
+
+        cached = getattr(self.routes[action], 'cached', False)
+        if cached:
+            #answers built from the former class hierarchy are stale
+            if self.classes.generation != self._generation:
+                self.cache.clear()
+                self._generation = self.classes.generation
+            result = self.cache.get(key)
+            if result is not None: return result
+
+        computation = self.in_flight.get(key)
+        if computation is None:
+            computation = Computation(asyncio.ensure_future(self._compute(key, cached, action, uuid, value)))
+            self.in_flight[key] = computation
+            computation.future.add_done_callback(lambda _: self.in_flight.pop(key, None))
+        else:
+            self.coalesced += 1
+        computation.waiters += 1
+        try:
+            #shielded so one requester going away does not cancel the shared computation
+            return await asyncio.shield(computation.future)
+        except asyncio.CancelledError:
+            #the last requester going away does
+            if computation.waiters == 1: computation.future.cancel()
+            raise
+        finally:
+            computation.waiters -= 1
+
+    async def _compute(self, key:str, cached:bool, action:str, uuid:str, value):
+        generation = self.classes.generation
+        result = await self.pool.run(self.execution_mode(action), action, uuid, value)
+        if cached:
+            if not isinstance(result, RawJSON): result = RawJSON.dumps(result)
+            #a result computed across a rescan is returned but not kept
+            if generation == self.classes.generation: self.cache.put(key, result)
+        return result
+
+    def track(self, uuid):
+        '''
+            Registers the current task as the one running uuid, so it can be cancelled.
+            Returns a callable that removes the registration
+        '''
+        task = asyncio.current_task()
+        if uuid is None or task is None: return lambda: None
+        self.running[uuid] = task
+        def untrack():
+            if self.running.get(uuid) is task: del self.running[uuid]
+        return untrack
+
+    def cancel(self, uuid) -> bool:
+        '''
+            Cancels the request running under uuid wherever it runs. A PROCESS handler's worker is killed,
+            a THREAD handler's result is dropped. Returns False if nothing is running under uuid
+        '''
+        task = self.running.get(uuid)
+        if task is None or task.done(): return False
+        task.cancel()
+        return True
+
+    async def route_request(self, request):
+        '''
+            Routes a request to its handler and records the action's latency and errors
+        '''
+        start = time.perf_counter()
+        ok = False
+        untrack = self.track(request.get('uuid'))
+        try:
+            response = await self._route_request(request)
+            ok = response['status'] == 'ok'
+            return response
+        finally:
+            untrack()
+            self.metrics.observe(self.metrics_label(request.get('action')), time.perf_counter()-start, ok)
+
+    async def _route_request(self, request):
         action = request.get('action')
         uuid = request.get('uuid')
         value = request.get('value')
 
-        if action in self.routes:
-            response_data = self.routes[action](uuid, value)
+        if action == 'metrics':
+            return {'action':action, 'value': self.metrics.snapshot(), 'status':'ok','uuid':uuid}
+        if action == 'cancel':
+            target = value.get('uuid') if isinstance(value, dict) else value
+            return {'action':action, 'value': {'uuid':target, 'cancelled':self.cancel(target)}, 'status':'ok','uuid':uuid}
+        if action == 'batch':
+            return {'action':action, 'value': await self.batch(uuid, value), 'status':'ok','uuid':uuid}
+        if self.has_route(action):
+            #config references are pinned to the current version before the request is shared or queued
+            response_data = await self.call(action, uuid, self.pin(action, value))
             return {'action':action, 'value': response_data, 'status':'ok','uuid':uuid}
         else:
             return {'action': action, 'value': 'Unknown action', 'status': 'error', 'uuid': uuid}
+
+    async def batch(self, uuid, requests:list) -> RawJSON:
+        '''
+            Runs a list of sub-requests {'action', 'value', 'uuid'?} and returns their responses in the same order,
+            as a JSON array serialized response by response so RawJSON values of cached handlers are spliced in.
+            INLINE handlers run one after the other on the event loop. PROCESS and single flight handlers, the
+            long running ones, also run one after the other, next to at most batch_concurrency other sub-requests.
+            The batch takes one request slot of its connection, this keeps it close to what the connection could run.
+            A failing sub-request, or one whose response cannot be serialized, only sets the status of its own response
+        '''
+        if not isinstance(requests, list):
+            raise TypeError('batch value must be a list of requests')
+        if len(requests) > MAX_BATCH_SIZE:
+            raise ValueError(f'batch holds {len(requests)} requests, at most {MAX_BATCH_SIZE} are accepted')
+        items = []
+        for index, request in enumerate(requests):
+            if isinstance(request, dict):
+                request = {'uuid': f'{uuid}.{index}', **request}
+            items.append(request)
+
+        responses = [None]*len(items)
+        tasks = {}
+        concurrent = asyncio.Semaphore(self.batch_concurrency)
+        serial = asyncio.Semaphore(1)
+        for index, request in enumerate(items):
+            action = request.get('action') if isinstance(request, dict) else None
+            if not self.has_route(action):
+                tasks[index] = asyncio.ensure_future(self._batch_item(request, concurrent))
+            elif self.execution_mode(action) == INLINE:
+                responses[index] = await self._batch_item(request)
+            elif self.execution_mode(action) == PROCESS or self.is_single_flight(action):
+                tasks[index] = asyncio.ensure_future(self._batch_item(request, serial))
+            else:
+                tasks[index] = asyncio.ensure_future(self._batch_item(request, concurrent))
+        try:
+            if tasks: await asyncio.wait(tasks.values())
+        except asyncio.CancelledError:
+            for task in tasks.values():
+                task.cancel()
+            raise
+        for index, task in tasks.items():
+            responses[index] = task.result()
+        return raw_array(self._batch_frame(response) for response in responses)
+
+    def _batch_frame(self, response:dict) -> bytes:
+        try:
+            return dumps(response)
+        except TypeError:
+            return dumps({'action': response.get('action'), 'value': 'Unable to serialize response JSON',
+                          'status': 'error', 'uuid': response.get('uuid')})
+
+    async def _batch_item(self, request, limit:asyncio.Semaphore | None = None) -> dict:
+        if not isinstance(request, dict):
+            return {'action': None, 'value': 'Malformed request', 'status': 'error', 'uuid': None}
+        action = request.get('action')
+        uuid = request.get('uuid')
+        if action == 'batch' or self.is_streaming(action):
+            return {'action': action, 'value': 'Action cannot be batched', 'status': 'error', 'uuid': uuid}
+        try:
+            if limit is None: return await self.route_request(request)
+            async with limit:
+                return await self.route_request(request)
+        except asyncio.CancelledError:
+            #cancelled through its own uuid, the rest of the batch carries on
+            return {'action': action, 'value': 'Request cancelled', 'status': 'cancelled', 'uuid': uuid}
+        except Exception as e:
+            return {'action': action, 'value': {'error': f'{type(e).__name__}: {e}', 'traceback': traceback.format_exc()},
+                    'status': 'error', 'uuid': uuid}
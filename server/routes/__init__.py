@@ -1,8 +1,15 @@
 from pkgutil import iter_modules
 from pathlib import Path
-from importlib import import_module
 
+from server.class_registry import class_registry
+
+#Route modules are imported on first use of one of their actions, see Router.has_route
 package_dir = Path(__file__).resolve().parent
-for (_, module_name,_) in iter_modules(path=[package_dir]):
-    module = import_module(f'{__name__}.{module_name}')
-   
\ No newline at end of file
+
+def import_all():
+    '''
+        Imports every route module, registering all of their handlers.
+        Through the class registry, the framework modules they import may define new classes
+    '''
+    for (_, module_name,_) in iter_modules(path=[package_dir]):
+        module = class_registry.import_module(f'{__name__}.{module_name}')
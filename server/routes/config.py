@@ -0,0 +1,44 @@
+from utils.decorators import route
+from server.config_store import config_store
+from server.execution import execution, INLINE, THREAD
+
+#Live configs: a client opens a config once, edits it with JSON Patches and sends {'config_id': ...}
+#in place of the config dict in later requests, see server/config_store.py
+#Live configs are held by the server process that opened them, behind server/cluster.py a client
+#keeps using them over the connection it opened them on
+
+@route('config.open')
+@execution(THREAD)
+def open_config(uuid, request):
+    '''
+        {'config', 'config_id'?} -> {'config_id', 'version'}
+    '''
+    live = config_store.open(request['config'], request.get('config_id'))
+    return {'config_id': live.config_id, 'version': live.version}
+
+@route('config.patch')
+@execution(THREAD)
+def patch_config(uuid, request):
+    '''
+        {'config_id', 'patch', 'version'?} -> {'config_id', 'version'}
+        patch is a JSON Patch, version the version it was made against
+    '''
+    live = config_store.patch(request['config_id'], request['patch'], request.get('version'))
+    return {'config_id': live.config_id, 'version': live.version}
+
+@route('config.get')
+@execution(INLINE)
+def get_config(uuid, request):
+    '''
+        {'config_id'} -> {'config_id', 'version', 'config'}, for clients resynchronizing after a refused patch
+    '''
+    live = config_store.get(request['config_id'])
+    return {'config_id': live.config_id, 'version': live.version, 'config': live.document}
+
+@route('config.close')
+@execution(INLINE)
+def close_config(uuid, request):
+    '''
+        {'config_id'} -> {'config_id', 'closed'}
+    '''
+    return {'config_id': request['config_id'], 'closed': config_store.close(request['config_id'])}
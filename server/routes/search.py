@@ -1,7 +1,9 @@
 from utils.decorators import route
+from server.router import cached
 import server.query as query
 
 @route('search')
+@cached
 def search(uuid, request):
     if request['type'] == 'requirements':
         return requirements(classname=request['value'])
@@ -0,0 +1,15 @@
+from utils.decorators import route
+from server.execution import execution, streaming, PROCESS
+import server.query as query
+
+@route('stream_toolpath')
+@execution(PROCESS)
+@streaming
+def stream_toolpath(uuid, request):
+    return query.stream_toolpath(**request)
+
+@route('stream_toolpath_2')
+@execution(PROCESS)
+@streaming
+def stream_toolpath_2(uuid, request):
+    return query.stream_toolpath_2(**request)
@@ -10,15 +10,25 @@ import websockets
 import os
 
 from core.Executor import Executor
+from server.compression import CompressionPolicy, DEFLATE, PERMESSAGE_DEFLATE
+from server.execution import ExecutionPool
+from server.framing import dumps, frame_size, split_arrays, array_frames
+from server.jobs import JobManager, FIFO, QUEUED, RUNNING
+from server.flow_control import ConnectionLimits, FlowControl, FlowStats, ResponseQueue
 from server.router import Router
-from server.routes import *
+
+#Actions answered without a request slot as soon as they are read
+CONTROL_ACTIONS = ('ping', 'cancel', 'jobs.cancel')
 
 class Server(metaclass=ABCMeta):
     name='Server'
     description='Abstract baseclass for various server types'
 
     @abstractmethod
-    def __init__(self, host:str = '127.0.0.1',port:int=8000, logging:bool=False, allowed_clients:list[str] | None=None) -> None:
+    def __init__(self, host:str = '127.0.0.1',port:int=8000, logging:bool=False, allowed_clients:list[str] | None=None,
+                 process_workers:int | None=None, thread_workers:int | None=None, limits:ConnectionLimits | None=None,
+                 jobs_dir:str | None=None, job_concurrency:int=2, job_ordering:str=FIFO,
+                 compression:CompressionPolicy | None=None, warm_caches:bool=True) -> None:
         if allowed_clients is None : allowed_clients = []
         self.host = host
         self.port = port
@@ -26,7 +36,26 @@ class Server(metaclass=ABCMeta):
         self.allowed_clients = ['localhost',host]
         self.allowed_clients.extend([ac for ac in allowed_clients if ac not in self.allowed_clients])
 
-        self.router = Router()
+        #Per connection backpressure, counters are shared by all connections
+        self.limits = limits if limits is not None else ConnectionLimits()
+        self.flow_stats = FlowStats()
+        self.requests_running = 0
+
+        #Route handlers run in the execution pool so the event loop only does framing and I/O
+        self.pool = ExecutionPool(process_workers=process_workers, thread_workers=thread_workers)
+        #a batch runs no more sub-requests at once than its connection could
+        self.router = Router(pool=self.pool, batch_concurrency=self.limits.max_in_flight)
+        self.router.metrics.add_source('flow', self.flow_stats.snapshot)
+
+        #Deflates large responses for clients that ask for it, and for browsers through permessage-deflate
+        self.compression = compression if compression is not None else CompressionPolicy()
+
+        #Query caches are filled in the background once the server is up
+        self.warm_caches = warm_caches
+
+        #Long running requests detached from their connection, results persist in jobs_dir until fetched
+        self.jobs = JobManager(self.router, jobs_dir=jobs_dir, concurrency=job_concurrency, ordering=job_ordering)
+        self.router.metrics.add_source('jobs', self.jobs.stats)
         
     @abstractmethod
     async def firewall(self, path, request_headers):
@@ -42,8 +71,11 @@ class Server(metaclass=ABCMeta):
         '''
             Initial handler for all websocket messages
         '''
+        flow = FlowControl(self.limits, self.flow_stats)
+        self.flow_stats.connections += 1
+        pending = []
         try:
-            output_queue = asyncio.Queue(10)
+            output_queue = ResponseQueue(flow)
             consumer_task = asyncio.create_task(self.consumer_handler(websocket,output_queue))
             producer_task = asyncio.create_task(self.producer_handler(websocket,output_queue))
             #Consumer and producer tasks are create to handle the websocket
@@ -58,45 +90,156 @@ class Server(metaclass=ABCMeta):
                 print('Connection closed by client')
         finally:
             for task in pending:
-                if task == producer_task:
+                if task == producer_task and not websocket.closed:
                     await asyncio.wait_for(output_queue.join(), timeout=14500)
                 task.cancel()
+            #work still running for a client that went away is cancelled, freeing its workers
+            for task in list(output_queue.tasks):
+                task.cancel()
+            self.jobs.unsubscribe_all(output_queue)
+            await flow.close()
+            self.flow_stats.connections -= 1
         if self.logging:
-            print(f'Closing connection with {websocket.host}')
+            print(f'Closing connection with {websocket.host}, throttled {flow.throttled} times')
 
     async def consumer_handler(self, websocket, output_queue):
         ''''
             Decodes json messages and passes them to the API
             pre-processing of requests can be implemented here
+
+            Requests wait in a queue of limits.read_queue messages for a request slot, see start_requests.
+            When the connection has too many requests in flight or too many response bytes queued and that
+            queue is full, reading stops and the websocket's own receive buffer applies backpressure to the client.
+            CONTROL_ACTIONS take no slot and are answered as they are read, so a connection at its limit can
+            still cancel the requests holding its slots
         '''
+        waiting = asyncio.Queue(self.limits.read_queue)
+        starter = asyncio.create_task(self.start_requests(waiting, websocket, output_queue))
         try:
             while True:
-                async for message in websocket:
-                    asyncio.create_task(self.API(orjson.loads(message),websocket,output_queue))
-                if websocket.closed:
+                try:
+                    message = await websocket.recv()
+                except websockets.ConnectionClosed:
                     return
+                message_data = orjson.loads(message)
+                if isinstance(message_data, dict):
+                    self.router.metrics.observe_request(self.router.metrics_label(message_data.get('action')), len(message))
+                if isinstance(message_data, dict) and message_data.get('action') in CONTROL_ACTIONS:
+                    #answered before the next read, which also bounds the control messages of a connection
+                    await self.API(message_data, websocket, output_queue, slot=False)
+                else:
+                    await waiting.put(message_data)
         except Exception:
             if self.logging: print(traceback.format_exc())
+        finally:
+            starter.cancel()
 
-    async def producer_handler(self, websocket, output_queue):
+    async def start_requests(self, waiting, websocket, output_queue):
+        '''
+            Starts the requests read by the consumer, in order, each once a request slot is free
+        '''
+        flow = output_queue.flow
+        while True:
+            message_data = await waiting.get()
+            await flow.acquire()
+            task = asyncio.create_task(self.API(message_data,websocket,output_queue))
+            output_queue.tasks.add(task)
+            task.add_done_callback(output_queue.tasks.discard)
+            self.requests_running += 1
+            task.add_done_callback(self._request_done)
+
+    def _request_done(self, task):
+        self.requests_running -= 1
+
+    def serialize(self, message) -> str:
+        '''
+            Serializes a response for the websocket
+        '''
+        return self.serialize_bytes(message).decode()
+
+    def serialize_bytes(self, message) -> bytes:
+        if not message:
+            message = {'status':'error', 'value': HTTPStatus.BAD_REQUEST.phrase}
+        try:
+            return dumps(message)
+        except Exception:
+            return orjson.dumps({'error': ' Unable to serialize response JSON'})
+
+    async def send_response(self, response, output_queue, binary:bool=False, final:bool=True, compress:bool=False):
+        '''
+            Serializes a response and queues its frames on the connection.
+            With binary, top level NumPy arrays of the value are sent as a JSON header plus a raw
+            binary frame each, ahead of the JSON response which lists them in 'binary_fields'.
+            With compress, frames the compression policy considers large enough are deflated off the event loop:
+            the response becomes a {'status': 'compressed', 'encoding': 'deflate', 'size'} header followed by
+            the deflated JSON as a binary frame, array headers get 'encoding' and 'size' and their frame is deflated
+        '''
+        label = self.router.metrics_label(response.get('action')) if isinstance(response, dict) else 'unknown'
+        nbytes = 0
+        if binary and isinstance(response, dict):
+            value, arrays = split_arrays(response.get('value'))
+            if arrays:
+                for header, frame in array_frames(response, arrays):
+                    if compress: header, frame = await self.compress_frame(label, header, frame)
+                    header = self.serialize(header)
+                    nbytes += len(header) + frame_size(frame)
+                    await output_queue.put(header, final=False)
+                    await output_queue.put(frame, final=False)
+                response = {**response, 'value': value, 'binary_fields': [field for field, _ in arrays]}
+        data = self.serialize_bytes(response)
+        if compress and isinstance(response, dict):
+            header = {'action': response.get('action'), 'uuid': response.get('uuid'), 'status': 'compressed'}
+            header, frame = await self.compress_frame(label, header, data)
+            if frame is not data:
+                header = self.serialize(header)
+                self.router.metrics.observe_response(label, nbytes + len(header) + len(frame))
+                await output_queue.put(header, final=False)
+                await output_queue.put(frame, final=final)
+                return
+        self.router.metrics.observe_response(label, nbytes + len(data))
+        await output_queue.put(data.decode(), final=final)
+
+    def observe_deflate(self, nbytes:int, compressed:int, seconds:float):
+        '''
+            Records a message deflated by the permessage-deflate extension
+        '''
+        self.router.metrics.observe_compression(PERMESSAGE_DEFLATE, nbytes, compressed, seconds)
+
+    async def compress_frame(self, label:str, header:dict, frame) -> tuple[dict, object]:
         '''
-            Waits for the available messages in the output_queue added by consumer
-            Passes the message to the API and sends back to requestor
+            Deflates frame in a worker thread when the compression policy allows it.
+            Returns the frame unchanged when it is too small or does not shrink enough
+        '''
+        size = frame_size(frame)
+        if not self.compression.should_compress(size): return header, frame
+        compressed, seconds = await asyncio.to_thread(self.compression.deflate, frame)
+        self.router.metrics.observe_compression(label, size, len(compressed), seconds)
+        if not self.compression.worthwhile(size, len(compressed)): return header, frame
+        return {**header, 'encoding': DEFLATE, 'size': size}, compressed
 
-            Assumes API does not return empty strings
+    def job_events(self, output_queue):
+        '''
+            Returns the callable the JobManager uses to push job events to this connection
+        '''
+        async def send(event):
+            response = {'action':'jobs.event', 'value':event, 'uuid':event['job'], 'status':'event'}
+            await self.send_response(response, output_queue, final=False)
+        return send
+
+    async def producer_handler(self, websocket, output_queue):
+        '''
+            Waits for the serialized responses in the output_queue added by the API
+            and sends them back to the requestor
         '''
         while True:
             try:
-                message = await output_queue.get()
-                if not message: 
-                    message = (HTTPStatus.BAD_REQUEST, [], b'')
-                else:
-                    try:
-                        message = orjson.dumps(message,option=orjson.OPT_SERIALIZE_NUMPY).decode()
-                    except:
-                        message = {'error': ' Unable to serialize response JSON'}
-                    finally:
-                        await websocket.send(message)
+                message, final = await output_queue.get()
+                try:
+                    await websocket.send(message)
+                finally:
+                    await output_queue.sent(message, final)
+            except websockets.ConnectionClosed:
+                return
             except Exception:
                 if self.logging:
                     print(traceback.format_exc())
@@ -108,35 +251,97 @@ class Server(metaclass=ABCMeta):
         asyncio.run(self._run_server())
         return True
 
-    async def _run_server(self):
+    async def _run_server(self, sock=None, reuse_port:bool=False, stop:asyncio.Event | None=None, drain_timeout:float=60):
+        '''
+            sock -> already bound listening socket shared by several worker processes, replaces host and port
+            reuse_port -> bind host and port with SO_REUSEPORT so several worker processes can listen on it
+            stop -> the server drains and returns once it is set, runs until cancelled otherwise
+            drain_timeout -> seconds to wait for the requests in flight when stopping, jobs are always run to the end
+        '''
         MAX_REQUEST_SIZE = int(1000000*1000*10) #bytes*Mb*Gb ==> 10Gb
         WRITE_LIMIT      = int(1000000*1000*0.25) #250Mb write limit
         READ_LIMIT       = int(1000000*1000*0.25) #250Mb read limit
         PING_TIMEOUT     = None
         CLOSE_TIMEOUT    = 14400 #seconds -> 4 hr for really long toolpath generation times
+        if sock is not None:
+            address = {'sock': sock}
+        else:
+            address = {'host': self.host, 'port': self.port}
+            if reuse_port: address['reuse_port'] = True
+        self.pool.start()
+        self.jobs.start()
+        if self.warm_caches:
+            threading.Thread(target=self.warm, name='warm-caches', daemon=True).start()
         try:
             async with websockets.serve(
                 ws_handler=self.handler, 
-                host=self.host, 
-                port=self.port,
                 process_request=self.firewall,
                 max_size=MAX_REQUEST_SIZE,
                 write_limit=WRITE_LIMIT,
                 read_limit=READ_LIMIT,
                 ping_timeout=PING_TIMEOUT,
-                close_timeout=CLOSE_TIMEOUT
+                close_timeout=CLOSE_TIMEOUT,
+                max_queue=self.limits.read_queue,
+                #permessage-deflate follows the compression policy but runs on the event loop, see PolicyDeflate
+                compression=None,
+                extensions=[self.compression.extension(self.observe_deflate)] if self.compression.negotiate else None,
+                **address
             ) as server:
                 if self.logging:
                     socket_data = server.sockets[0].getsockname()
                     message = {'server':str(socket_data[0]), 'port':str(socket_data[1]), 'PID':str(os.getpid())}
                     print(orjson.dumps(message).decode(),flush=True)
                     print(server)
-                    #waits for the socket server to return -- only happens when server is shutdown
+                #waits for the socket server to return -- only happens when server is shutdown
+                if stop is None:
                     await asyncio.Future()
+                else:
+                    await stop.wait()
+                    await self.drain(server, drain_timeout)
         except Exception:
             if self.logging:
                 print('Unable to start websocket server')
                 print(traceback.format_ex())
+        finally:
+            await self.jobs.stop()
+            self.pool.shutdown(wait=False)
+
+    def warm(self):
+        '''
+            Fills the query caches so the first requests find them ready. Runs in a background thread
+        '''
+        try:
+            import server.query as query
+            self.router.metrics.add_source('requirements', query.requirements_cache.stats)
+            self.router.metrics.add_source('objects', query.object_store.stats)
+            self.router.metrics.add_source('toolpath_cache', query.toolpath_cache.stats)
+            query.warm_requirements()
+        except Exception:
+            if self.logging: print(traceback.format_exc())
+
+    async def drain(self, server, timeout:float):
+        '''
+            Stops accepting connections, then waits up to timeout seconds for the requests in flight and
+            for as long as it takes for the jobs queued and running here, which can take hours.
+            Connections still open afterwards are closed when the server exits
+        '''
+        #closes the listening socket only, open connections keep being served
+        server.server.close()
+        deadline = asyncio.get_running_loop().time() + timeout
+        #connections accepted just before closing get a moment to send their first request
+        await asyncio.sleep(min(1.0, timeout))
+        while self.requests_running or self.flow_stats.queued_bytes:
+            if asyncio.get_running_loop().time() > deadline: break
+            await asyncio.sleep(0.1)
+        while self.jobs.stats()[RUNNING] or self.jobs.stats()[QUEUED]:
+            await asyncio.sleep(1.0)
+
+    def health(self) -> dict:
+        '''
+            Load of this server process, reported to the cluster Supervisor
+        '''
+        return {'pid': os.getpid(), 'connections': self.flow_stats.connections, 'in_flight': self.requests_running,
+                'requests': self.flow_stats.requests, 'jobs_running': self.jobs.stats()[RUNNING]}
 
 @abstractmethod
 async def API(self,message, websocket,output_queue):
@@ -149,33 +354,67 @@ class AppServer(Server):
     name = 'App Server'
     description = 'A websocket server to handle all incoming requests for the application state and processes'
 
-    def __init__(self, host: str = '127.0.0.1', port: int = 8000, logging: bool = False, allowed_clients: list[str] | None = None) -> None:
-        super().__init__(host=host, port=port, logging=logging, allowed_clients=allowed_clients)    
+    def __init__(self, host: str = '127.0.0.1', port: int = 8000, logging: bool = False, allowed_clients: list[str] | None = None,
+                 process_workers: int | None = None, thread_workers: int | None = None, limits: ConnectionLimits | None = None,
+                 jobs_dir: str | None = None, job_concurrency: int = 2, job_ordering: str = FIFO,
+                 compression: CompressionPolicy | None = None, warm_caches: bool = True) -> None:
+        super().__init__(host=host, port=port, logging=logging, allowed_clients=allowed_clients,
+                         process_workers=process_workers, thread_workers=thread_workers, limits=limits,
+                         jobs_dir=jobs_dir, job_concurrency=job_concurrency, job_ordering=job_ordering,
+                         compression=compression, warm_caches=warm_caches)
         self.executor = Executor()
 
     async def firewall(self, path, request_headers):
         return await super().firewall(path, request_headers)
         
-    async def API(self,message,websocket,output_queue):
+    async def API(self,message,websocket,output_queue,slot:bool=True):
         '''
-            Handles all API endpoints
+            Handles all API endpoints. slot is False for CONTROL_ACTIONS, which hold no request slot to free
             requests follow: 
             {
                 'action': '<method string>',
                 'value' : '<dict or string with data>',
-                'uuid'  : '<uuid for request>'
+                'uuid'  : '<uuid for request>',
+                'binary': <optional, send NumPy arrays of the value as binary frames>,
+                'compress': <optional, deflate large frames, see send_response>
             }
+
+            {'action': 'cancel', 'value': '<uuid of a running request>'} stops that request, which answers with status 'cancelled'
+            {'action': 'batch', 'value': [<request>, ...]} answers every sub-request in one frame, see Router.batch
+            'jobs.*' actions run long requests as jobs, see JobManager.handle
+            'config.*' actions hold live configs edited with JSON Patches, {'config_id': ...} then stands in for
+            the config dict in any request, see server/routes/config.py
+
+            streaming actions answer with several frames for the same uuid:
+            {'status': 'partial', 'seq': 0, 'value': <chunk>, ...}, ... then {'status': 'done', 'seq': n, 'value': {'frames': n}, ...}
         '''
         
 
+        binary = False
+        compress = False
         try:
             response = {'action':message['action'],'value':'', 'uuid':message['uuid'], 'status':'ok'}
+            binary = bool(message.get('binary', False))
+            #frames of a connection with permessage-deflate are deflated by the extension already
+            compress = bool(message.get('compress', False)) and not websocket.extensions
             if message['action'] == 'ping': response['value'] = 'OK'
 
+            elif message['action'].startswith('jobs.'):
+                response['value'] = await self.jobs.handle(message['action'], message.get('value'), output_queue, self.job_events(output_queue))
+
+            elif self.router.is_streaming(message['action']):
+                #partial frames go out as they are produced, the done frame is sent below
+                async for frame in self.router.stream_request(message):
+                    response = frame
+                    if frame['status'] == 'partial':
+                        await self.send_response(frame, output_queue, binary=binary, final=False, compress=compress)
+                        #an error after this point is reported as the next frame of the stream
+                        response = {**frame, 'seq': frame['seq']+1, 'value':''}
+
             else:
-                response = self.router.route_request(message)
+                response = await self.router.route_request(message)
 
-        except (KeyError, TypeError):
+        except (KeyError, TypeError) as e:
             response['status'] = 'error'
             response['value'] = {'error':f'Bad Request - Malformed parameter: {e.args[0]}\n\n',
                                  'traceback':traceback.format_exc()
@@ -185,7 +424,12 @@ class AppServer(Server):
             response['value'] = {'error' : 'An unknown error occured',
                                  'traceback': traceback.format_exc()
                                  }
-        await output_queue.put(response)
+        except asyncio.CancelledError:
+            #cancelled by a 'cancel' request or because the connection closed
+            response['status'] = 'cancelled'
+            response['value'] = 'Request cancelled'
+        #only the last frame of a request that holds a slot frees it
+        await self.send_response(response, output_queue, binary=binary, final=slot, compress=compress)
 
         
 if __name__ == '__main__':
@@ -0,0 +1,24 @@
+import os
+
+def server_directory(name:str) -> str:
+    '''
+        Default location of the name directory of the server, in the cache directory of the user running it
+    '''
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'framework', name)
+
+def private_directory(path:str) -> str:
+    '''
+        Creates path with mode 0700 if it is missing and returns it. Files read back from it are trusted,
+        so a path that is a symlink, or a directory owned by another user, raises PermissionError.
+        Group and other permissions of a directory the user owns are removed
+    '''
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    stat = os.lstat(path)
+    if os.path.islink(path) or not os.path.isdir(path):
+        raise PermissionError(f'"{path}" is not a directory')
+    if hasattr(os, 'getuid') and stat.st_uid != os.getuid():
+        raise PermissionError(f'"{path}" is owned by another user')
+    if stat.st_mode & 0o077:
+        os.chmod(path, 0o700)
+    return path
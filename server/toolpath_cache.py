@@ -0,0 +1,270 @@
+import hashlib
+import os
+import shutil
+import threading
+import time
+import uuid as uuid_lib
+
+import orjson
+
+from server.class_registry import class_registry
+from server.framing import RawJSON
+from server.storage import private_directory, server_directory
+
+#Bumped when the layout of an entry changes, older entries are never looked up again
+CACHE_VERSION = 1
+#Stands in for output_dir in stored results, replaced by the output_dir of the request on a hit
+OUTPUT_DIR = b'[output_dir]'
+
+def _files(directory:str) -> dict[str, tuple[int, int]]:
+    '''
+        (mtime, size) of every file below directory, by path relative to it
+    '''
+    files = {}
+    if not directory or not os.path.isdir(directory): return files
+    for path, _, filenames in os.walk(directory):
+        for filename in filenames:
+            full_path = os.path.join(path, filename)
+            try:
+                stat = os.stat(full_path)
+            except OSError:
+                continue
+            files[os.path.relpath(full_path, directory)] = (stat.st_mtime_ns, stat.st_size)
+    return files
+
+def _size(directory:str) -> int:
+    return sum(size for _, size in _files(directory).values())
+
+class ToolpathCache():
+    name = 'Toolpath Cache'
+    description = 'Toolpath results and the files written with them, kept on disk by a hash of the generation inputs'
+
+    def __init__(self, directory:str | None = None, max_bytes:int = int(1000000*2000), max_age:float = 14*24*3600,
+                 registry = class_registry) -> None:
+        '''
+            directory -> where entries are kept, shared by every process of the server. Entries are copied into
+                         output_dir as the G-code driving the machine, so it must be owned by the server user alone
+            max_bytes -> disk budget, least recently used entries are removed beyond it
+            max_age -> seconds an entry is kept after it was last used
+            registry -> ClassRegistry whose source files make up the generator code version
+        '''
+        self.directory = directory or server_directory('toolpath_cache')
+        self._trusted = False
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.registry = registry
+        self.hits = 0
+        self.misses = 0
+        self.stored = 0
+        self.evictions = 0
+        self._version = None
+        self._version_generation = None
+        #counters of this process, every process writes its own file and stats adds them up
+        self._stats_path = os.path.join(self.directory, 'stats', f'{os.getpid()}-{uuid_lib.uuid4().hex[:8]}.json')
+        self._lock = threading.Lock()
+
+    def _check_directory(self):
+        '''
+            Raises PermissionError, an OSError, when the directory could hold entries planted by another user
+        '''
+        if not self._trusted:
+            private_directory(self.directory)
+            self._trusted = True
+
+    def code_version(self) -> str:
+        '''
+            Hash of every framework source file, by mtime and size. Any change to the code that could
+            change a toolpath gives new keys, old entries age out
+        '''
+        self.registry.load()
+        if self._version_generation != self.registry.generation:
+            files = sorted((path, entry['stamp']) for path, entry in self.registry.files.items()
+                           if entry['module'].split('.')[0] in self.registry.class_packages)
+            self._version = hashlib.blake2b(orjson.dumps([CACHE_VERSION, files]), digest_size=16).hexdigest()
+            self._version_generation = self.registry.generation
+        return self._version
+
+    def key(self, inputs:dict, output_dir:str) -> str | None:
+        '''
+            Key of the generation inputs, None if they cannot be hashed. output_dir is only part of the key when
+            it is relative, results under an absolute output_dir are stored with OUTPUT_DIR in its place
+        '''
+        inputs = {**inputs, 'code_version': self.code_version()}
+        if not os.path.isabs(output_dir or ''): inputs['output_dir'] = output_dir
+        try:
+            canonical = orjson.dumps(inputs, option=orjson.OPT_SORT_KEYS | orjson.OPT_SERIALIZE_NUMPY)
+        except TypeError:
+            return None
+        return hashlib.blake2b(canonical, digest_size=16).hexdigest()
+
+    def cached(self, inputs:dict, output_dir:str, generate) -> RawJSON:
+        '''
+            The RawJSON result of generate(), from the cache when the same inputs were generated before.
+            On a hit the files stored with the result are copied into output_dir
+        '''
+        key = self.key(inputs, output_dir)
+        if key is None: return generate()
+        result = self.get(key, output_dir)
+        if result is not None: return result
+        before = _files(output_dir)
+        result = generate()
+        if not isinstance(result, RawJSON): result = RawJSON.dumps(result)
+        try:
+            self.put(key, result, output_dir, before)
+        except OSError:
+            #a full or read only disk only costs the next request a generation
+            pass
+        return result
+
+    def get(self, key:str, output_dir:str) -> RawJSON | None:
+        entry = os.path.join(self.directory, key)
+        try:
+            self._check_directory()
+            with open(os.path.join(entry, 'result.json'), 'rb') as result_file:
+                result = result_file.read()
+            files = os.path.join(entry, 'files')
+            for path in _files(files):
+                target = os.path.join(output_dir, path)
+                os.makedirs(os.path.dirname(target) or '.', exist_ok=True)
+                shutil.copyfile(os.path.join(files, path), target)
+            #the modification time of the entry is its last use
+            os.utime(entry)
+        except OSError:
+            self._count(hit=False)
+            return None
+        self._count(hit=True)
+        if os.path.isabs(output_dir or ''):
+            result = result.replace(OUTPUT_DIR, orjson.dumps(output_dir)[1:-1])
+        return RawJSON(result)
+
+    def put(self, key:str, result:RawJSON, output_dir:str, before:dict):
+        '''
+            Stores result with the files generate wrote to output_dir, those that are new or changed since before
+        '''
+        written = [path for path, stamp in _files(output_dir).items() if before.get(path) != stamp]
+        stored = bytes(result)
+        if os.path.isabs(output_dir or ''):
+            stored = stored.replace(orjson.dumps(output_dir)[1:-1], OUTPUT_DIR)
+        size = len(stored) + sum(os.path.getsize(os.path.join(output_dir, path)) for path in written)
+        if size > self.max_bytes: return
+
+        self._check_directory()
+        entry = os.path.join(self.directory, key)
+        temporary = f'{entry}.{os.getpid()}.tmp'
+        shutil.rmtree(temporary, ignore_errors=True)
+        os.makedirs(os.path.join(temporary, 'files'))
+        try:
+            for path in written:
+                target = os.path.join(temporary, 'files', path)
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                shutil.copyfile(os.path.join(output_dir, path), target)
+            with open(os.path.join(temporary, 'result.json'), 'wb') as result_file:
+                result_file.write(stored)
+            #kept with the entry so eviction does not walk its files
+            with open(os.path.join(temporary, 'size'), 'wb') as size_file:
+                size_file.write(str(size).encode())
+            #the entry appears whole or not at all, another process may have stored it meanwhile
+            os.rename(temporary, entry)
+            self.stored += 1
+        except OSError:
+            shutil.rmtree(temporary, ignore_errors=True)
+            if not os.path.isdir(entry): raise
+        self.evict()
+        self._save()
+
+    def entries(self) -> list[tuple[float, int, str]]:
+        '''
+            (last use, size, path) of every entry
+        '''
+        entries = []
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return entries
+        for name in names:
+            path = os.path.join(self.directory, name)
+            if name == 'stats' or name.endswith('.tmp') or not os.path.isdir(path): continue
+            try:
+                last_used = os.stat(path).st_mtime
+            except OSError:
+                continue
+            try:
+                with open(os.path.join(path, 'size'), 'rb') as size_file:
+                    size = int(size_file.read())
+            except (OSError, ValueError):
+                size = _size(path)
+            entries.append((last_used, size, path))
+        return entries
+
+    def evict(self):
+        '''
+            Removes the entries unused for max_age, then the least recently used until max_bytes is met.
+            Records what is left for stats
+        '''
+        entries = sorted(self.entries())
+        total = sum(size for _, size, _ in entries)
+        count = len(entries)
+        oldest = time.time() - self.max_age
+        for last_used, size, path in entries:
+            if last_used >= oldest and total <= self.max_bytes: break
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+            count -= 1
+            self.evictions += 1
+        usage = os.path.join(self.directory, 'usage.json')
+        temporary = f'{usage}.{os.getpid()}.tmp'
+        try:
+            with open(temporary, 'wb') as usage_file:
+                usage_file.write(orjson.dumps({'entries': count, 'bytes': total}))
+            os.replace(temporary, usage)
+        except OSError:
+            pass
+
+    def _count(self, hit:bool):
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+        self._save()
+
+    def _save(self):
+        with self._lock:
+            counters = {'hits': self.hits, 'misses': self.misses, 'stored': self.stored, 'evictions': self.evictions}
+        try:
+            os.makedirs(os.path.dirname(self._stats_path), mode=0o700, exist_ok=True)
+            with open(self._stats_path, 'wb') as stats_file:
+                stats_file.write(orjson.dumps(counters))
+        except OSError:
+            pass
+
+    def stats(self) -> dict:
+        '''
+            Counters of every process using the cache directory, with the entries on disk as of the last eviction
+        '''
+        totals = {'hits': 0, 'misses': 0, 'stored': 0, 'evictions': 0}
+        stats_dir = os.path.dirname(self._stats_path)
+        oldest = time.time() - self.max_age
+        for name in os.listdir(stats_dir) if os.path.isdir(stats_dir) else ():
+            path = os.path.join(stats_dir, name)
+            try:
+                if os.stat(path).st_mtime < oldest:
+                    #counters of processes gone for max_age
+                    os.remove(path)
+                    continue
+                with open(path, 'rb') as stats_file:
+                    counters = orjson.loads(stats_file.read())
+            except (OSError, orjson.JSONDecodeError):
+                continue
+            for counter in totals:
+                totals[counter] += counters.get(counter, 0)
+        try:
+            with open(os.path.join(self.directory, 'usage.json'), 'rb') as usage_file:
+                usage = orjson.loads(usage_file.read())
+        except (OSError, orjson.JSONDecodeError):
+            usage = {'entries': 0, 'bytes': 0}
+        lookups = totals['hits'] + totals['misses']
+        return {**usage, **totals, 'hit_rate': totals['hits']/lookups if lookups else 0.0}
+
+#Process wide, the directory is shared by every worker process
+toolpath_cache = ToolpathCache()
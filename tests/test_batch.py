@@ -0,0 +1,74 @@
+'''
+    Batch requests: responses of cached handlers, which the Router hands out as RawJSON, are spliced into
+    the batch frame, and a response that cannot be serialized only fails its own item.
+
+    usage: python -m pytest tests
+'''
+import asyncio
+import os
+import sys
+
+import orjson
+import pytest
+
+sys.path.append(os.path.join(os.path.dirname(__file__),'..'))
+pytest.importorskip('utils.decorators')
+pytest.importorskip('core.Executor')
+from utils.decorators import route_handlers
+from server.config_store import ConfigStore
+from server.execution import INLINE
+from server.framing import RawJSON
+from server.metrics import Metrics
+from server.router import ResultCache, Router, cached
+from server.socket_server import AppServer
+
+REQUIREMENTS = {'Tool': {'classname': 'Tool', 'diameter': {'classname': 'Parameter', 'value': 3.0}},
+                'Assembly': {'classname': 'Assembly', 'label': ''}}
+
+@cached
+def search(uuid, request):
+    return {request['value']: REQUIREMENTS[request['value']]}
+
+def unserializable(uuid, request):
+    return {'value': object()}
+
+@pytest.fixture
+def server(tmp_path, monkeypatch):
+    monkeypatch.setitem(route_handlers, 'search', search)
+    monkeypatch.setitem(route_handlers, 'test.unserializable', unserializable)
+    app = AppServer(jobs_dir=str(tmp_path), process_workers=1, warm_caches=False)
+    app.router = Router(pool=app.pool, execution_modes={'search': INLINE, 'test.unserializable': INLINE},
+                        cache=ResultCache(), metrics=Metrics(), configs=ConfigStore())
+    return app
+
+def batch(server:AppServer, requests:list) -> dict:
+    response = asyncio.run(server.router.route_request({'action': 'batch', 'uuid': 'b', 'value': requests}))
+    return orjson.loads(server.serialize_bytes(response))
+
+def test_batch_of_cached_searches(server):
+    requests = [{'action': 'search', 'value': {'type': 'requirements', 'value': 'Tool'}},
+                {'action': 'search', 'value': {'type': 'requirements', 'value': 'Assembly'}}]
+    #the second batch is answered from the ResultCache
+    for _ in range(2):
+        response = batch(server, requests)
+        assert response['status'] == 'ok'
+        assert response['uuid'] == 'b'
+        assert [item['status'] for item in response['value']] == ['ok', 'ok']
+        assert [item['uuid'] for item in response['value']] == ['b.0', 'b.1']
+        assert response['value'][0]['value'] == {'Tool': REQUIREMENTS['Tool']}
+        assert response['value'][1]['value'] == {'Assembly': REQUIREMENTS['Assembly']}
+    assert server.router.cache.hits == 2
+
+def test_batch_value_is_raw_json(server):
+    response = asyncio.run(server.router.route_request({'action': 'batch', 'uuid': 'b', 'value': [
+        {'action': 'search', 'value': {'type': 'requirements', 'value': 'Tool'}}]}))
+    assert isinstance(response['value'], RawJSON)
+
+def test_unserializable_item_fails_alone(server):
+    response = batch(server, [{'action': 'test.unserializable', 'value': None},
+                              {'action': 'search', 'value': {'type': 'requirements', 'value': 'Tool'}}])
+    assert response['status'] == 'ok'
+    assert response['value'][0]['status'] == 'error'
+    assert response['value'][0]['uuid'] == 'b.0'
+    assert response['value'][1]['status'] == 'ok'
+    assert response['value'][1]['value'] == {'Tool': REQUIREMENTS['Tool']}
@@ -0,0 +1,310 @@
+'''
+    Live configs: JSON Patch operations, incremental updates of the objects, catching up worker copies
+    and the structural digest.
+
+    The classes are synthetic, shaped like the framework Configuration classes: a Tool holding Parameters,
+    an Assembly holding a Tool, Parameters and a list of child Assemblies.
+
+    usage: python -m pytest tests
+'''
+import copy
+import os
+import sys
+
+import pytest
+
+sys.path.append(os.path.join(os.path.dirname(__file__),'..'))
+from server.config_store import MAX_LOG, ConfigCache, ConfigStore, LiveConfig, apply_operation, apply_patch, parse_pointer
+from server.deserialize import Deserializer
+from server.merkle import MerkleTree, hexdigest
+
+class Parameter():
+    name = 'Parameter'
+
+    def __init__(self) -> None:
+        self.value = 0.0
+        self.units = 'mm'
+
+    @property
+    def requirements(self) -> dict:
+        return {'classname': 'Parameter', 'value': self.value, 'units': self.units}
+
+class Tool():
+    name = 'Tool'
+
+    def __init__(self) -> None:
+        self.diameter = Parameter()
+        self.label = 'tool'
+
+    @property
+    def requirements(self) -> dict:
+        return {'classname': 'Tool', 'diameter': self.diameter.requirements, 'label': self.label}
+
+class Assembly():
+    name = 'Assembly'
+
+    def __init__(self) -> None:
+        self.width = Parameter()
+        self.height = Parameter()
+        self.label = ''
+        self.tags = []
+        self.tool = Tool()
+        self.children = []
+
+    @property
+    def requirements(self) -> dict:
+        return {'classname': 'Assembly', 'width': self.width.requirements, 'height': self.height.requirements,
+                'label': self.label, 'tags': list(self.tags), 'tool': self.tool.requirements,
+                'children': [child.requirements for child in self.children]}
+
+CLASSES = {'Parameter': Parameter, 'Tool': Tool, 'Assembly': Assembly}
+
+def str_to_class(classname:str) -> type:
+    return CLASSES[classname]
+
+def make_deserializer() -> Deserializer:
+    return Deserializer(str_to_class, lambda obj, dependencies: None)
+
+def parameter(value:float) -> dict:
+    return {'classname': 'Parameter', 'value': value, 'units': 'mm'}
+
+def assembly(label:str, children:list | None = None) -> dict:
+    return {'classname': 'Assembly', 'label': label, 'width': parameter(10.0), 'height': parameter(5.0),
+            'tags': ['a', 'b'], 'tool': {'classname': 'Tool', 'diameter': parameter(3.0), 'label': f'{label} tool'},
+            'children': children or []}
+
+def config() -> dict:
+    return assembly('root', [assembly('first', [assembly('nested')]), assembly('second')])
+
+def built(document:dict) -> dict:
+    return make_deserializer().build(document).requirements
+
+#JSON Patch
+
+def test_parse_pointer():
+    assert parse_pointer('') == []
+    assert parse_pointer('/a/0') == ['a', '0']
+    assert parse_pointer('/a~1b/c~0d') == ['a/b', 'c~d']
+    with pytest.raises(ValueError):
+        parse_pointer('a/b')
+
+@pytest.mark.parametrize('operation, expected', [
+    ({'op': 'add', 'path': '/b', 'value': 2}, {'a': 1, 'b': 2, 'l': [1, 2, 3], 'd': {'x': 1}}),
+    ({'op': 'add', 'path': '/l/1', 'value': 9}, {'a': 1, 'l': [1, 9, 2, 3], 'd': {'x': 1}}),
+    ({'op': 'add', 'path': '/l/-', 'value': 9}, {'a': 1, 'l': [1, 2, 3, 9], 'd': {'x': 1}}),
+    ({'op': 'add', 'path': '/a', 'value': 5}, {'a': 5, 'l': [1, 2, 3], 'd': {'x': 1}}),
+    ({'op': 'remove', 'path': '/l/0'}, {'a': 1, 'l': [2, 3], 'd': {'x': 1}}),
+    ({'op': 'remove', 'path': '/d/x'}, {'a': 1, 'l': [1, 2, 3], 'd': {}}),
+    ({'op': 'replace', 'path': '/d/x', 'value': [1]}, {'a': 1, 'l': [1, 2, 3], 'd': {'x': [1]}}),
+    ({'op': 'replace', 'path': '/l/2', 'value': 0}, {'a': 1, 'l': [1, 2, 0], 'd': {'x': 1}}),
+    ({'op': 'move', 'from': '/a', 'path': '/d/a'}, {'l': [1, 2, 3], 'd': {'x': 1, 'a': 1}}),
+    ({'op': 'move', 'from': '/l/0', 'path': '/l/2'}, {'a': 1, 'l': [2, 3, 1], 'd': {'x': 1}}),
+    ({'op': 'copy', 'from': '/d', 'path': '/e'}, {'a': 1, 'l': [1, 2, 3], 'd': {'x': 1}, 'e': {'x': 1}}),
+    ({'op': 'test', 'path': '/l', 'value': [1, 2, 3]}, {'a': 1, 'l': [1, 2, 3], 'd': {'x': 1}}),
+    ({'op': 'replace', 'path': '', 'value': {'z': 0}}, {'z': 0}),
+])
+def test_operations(operation, expected):
+    document = {'a': 1, 'l': [1, 2, 3], 'd': {'x': 1}}
+    original = copy.deepcopy(document)
+    result, _ = apply_operation(document, operation)
+    assert result == expected
+    #the document patched is never modified
+    assert document == original
+
+def test_unchanged_containers_are_shared():
+    document = {'a': {'x': 1}, 'b': {'y': [1, 2]}}
+    result, paths = apply_operation(document, {'op': 'replace', 'path': '/b/y/0', 'value': 5})
+    assert paths == [['b', 'y', '0']]
+    assert result['a'] is document['a']
+    assert result['b'] is not document['b']
+
+@pytest.mark.parametrize('operation', [
+    {'op': 'add', 'path': '/missing/x', 'value': 1},
+    {'op': 'add', 'path': '/l/4', 'value': 1},
+    {'op': 'add', 'path': '/l/01', 'value': 1},
+    {'op': 'add', 'path': '/b'},
+    {'op': 'remove', 'path': '/missing'},
+    {'op': 'remove', 'path': '/l/3'},
+    {'op': 'remove', 'path': ''},
+    {'op': 'replace', 'path': '/missing', 'value': 1},
+    {'op': 'move', 'from': '/d', 'path': '/d/x/y'},
+    {'op': 'copy', 'path': '/e'},
+    {'op': 'test', 'path': '/a', 'value': 2},
+    {'op': 'increment', 'path': '/a'},
+    {'path': '/a'},
+])
+def test_invalid_operations(operation):
+    with pytest.raises(ValueError):
+        apply_operation({'a': 1, 'l': [1, 2, 3], 'd': {'x': {}}}, operation)
+
+def test_patch_is_all_or_nothing():
+    document = {'a': 1, 'l': [1, 2]}
+    original = copy.deepcopy(document)
+    with pytest.raises(ValueError):
+        apply_patch(document, [{'op': 'replace', 'path': '/a', 'value': 2},
+                               {'op': 'remove', 'path': '/l/0'},
+                               {'op': 'test', 'path': '/a', 'value': 1}])
+    assert document == original
+
+def test_live_patch_is_all_or_nothing():
+    live = LiveConfig('c', config(), deserializer=make_deserializer())
+    live.objects()
+    digest = live.digest()
+    with pytest.raises(ValueError):
+        live.patch([{'op': 'replace', 'path': '/width/value', 'value': 99.0},
+                    {'op': 'remove', 'path': '/children/5'}])
+    assert live.version == 0
+    assert live.document == config()
+    assert live.log == []
+    assert live.digest() == digest
+    #objects half updated by the failed patch are built again from the unchanged document
+    assert live.objects().requirements == built(config())
+
+#Incremental updates
+
+@pytest.mark.parametrize('operations', [
+    [{'op': 'replace', 'path': '/width/value', 'value': 12.5}],
+    [{'op': 'replace', 'path': '/label', 'value': 'renamed'}],
+    [{'op': 'add', 'path': '/tags/-', 'value': 'c'}],
+    [{'op': 'replace', 'path': '/tool/diameter/value', 'value': 6.0}],
+    [{'op': 'replace', 'path': '/tool', 'value': {'classname': 'Tool', 'label': 'new'}}],
+    [{'op': 'replace', 'path': '/children/0/height/value', 'value': 1.0}],
+    [{'op': 'replace', 'path': '/children/0/children/0/tool/label', 'value': 'deep'}],
+    [{'op': 'add', 'path': '/children/1', 'value': assembly('inserted')}],
+    [{'op': 'remove', 'path': '/children/0'}],
+    [{'op': 'move', 'from': '/children/0/children/0', 'path': '/children/1/children/-'}],
+    [{'op': 'remove', 'path': '/width'}],
+    [{'op': 'add', 'path': '/unknown', 'value': 1}],
+    [{'op': 'replace', 'path': '/children/1', 'value': {'classname': 'Tool', 'label': 'not an assembly'}}],
+    [{'op': 'replace', 'path': '', 'value': assembly('replaced')}],
+])
+def test_update_matches_build(operations):
+    live = LiveConfig('c', config(), deserializer=make_deserializer())
+    objects = live.objects()
+    live.patch(operations)
+    assert live.objects().requirements == built(live.document)
+    if operations[0]['path']:
+        #the objects were updated in place, not built again
+        assert live.objects() is objects
+
+def test_update_sequence_matches_build():
+    live = LiveConfig('c', config(), deserializer=make_deserializer())
+    live.objects()
+    patches = [
+        [{'op': 'replace', 'path': '/children/1/width/value', 'value': 2.0}],
+        [{'op': 'add', 'path': '/children/0/children/-', 'value': assembly('added')}],
+        [{'op': 'replace', 'path': '/children/0/children/1/tool/diameter/value', 'value': 8.0},
+         {'op': 'copy', 'from': '/children/0/children/1', 'path': '/children/-'}],
+        [{'op': 'remove', 'path': '/children/0/children/0'}],
+    ]
+    for operations in patches:
+        live.patch(operations)
+        assert live.objects().requirements == built(live.document)
+    assert live.version == len(patches)
+    assert live.rebuilt == 1
+    assert live.incremental > 0
+
+def test_copy_is_private():
+    live = LiveConfig('c', config(), deserializer=make_deserializer())
+    first = live.copy()
+    first.width.value = -1.0
+    assert live.copy().width.value == 10.0
+    assert live.objects().width.value == 10.0
+
+#Worker copies
+
+def test_cache_catches_up():
+    store = ConfigStore(deserializer=make_deserializer())
+    cache = ConfigCache(deserializer=make_deserializer())
+    live = store.open(config(), 'c')
+    store.patch('c', [{'op': 'replace', 'path': '/label', 'value': 'v1'}])
+    worker = cache.get(live.ref())
+    assert cache.rebuilt == 1
+    assert worker.objects().requirements == live.objects().requirements
+
+    store.patch('c', [{'op': 'replace', 'path': '/width/value', 'value': 1.0}])
+    store.patch('c', [{'op': 'add', 'path': '/children/-', 'value': assembly('third')}])
+    assert cache.get(live.ref()) is worker
+    assert cache.caught_up == 1
+    assert worker.version == live.version
+    assert worker.objects().requirements == live.objects().requirements
+
+    assert cache.get(live.ref()) is worker
+    assert cache.hits == 1
+
+def test_cache_catches_up_across_compaction():
+    store = ConfigStore(deserializer=make_deserializer())
+    cache = ConfigCache(deserializer=make_deserializer())
+    live = store.open(config(), 'c')
+    worker = cache.get(live.ref())
+    for index in range(MAX_LOG + 3):
+        store.patch('c', [{'op': 'replace', 'path': '/width/value', 'value': float(index)}])
+    ref = live.ref()
+    #the log was compacted, the worker's version is older than the new base
+    assert ref.base_version > worker.version
+    assert len(ref.patches) < MAX_LOG
+
+    caught_up = cache.get(ref)
+    assert caught_up is not worker
+    assert caught_up.version == live.version
+    assert caught_up.document == live.document
+    assert caught_up.objects().requirements == live.objects().requirements
+    assert cache.rebuilt == 2
+
+def test_cache_keeps_newer_version():
+    store = ConfigStore(deserializer=make_deserializer())
+    cache = ConfigCache(deserializer=make_deserializer())
+    live = store.open(config(), 'c')
+    old = live.ref()
+    store.patch('c', [{'op': 'replace', 'path': '/label', 'value': 'v1'}])
+    new = cache.get(live.ref())
+    #a request pinned to the older version gets it without replacing the newer one
+    assert cache.get(old).version == 0
+    assert cache.get(live.ref()) is new
+
+def test_pin_refuses_stale_version():
+    store = ConfigStore(deserializer=make_deserializer())
+    store.open(config(), 'c')
+    store.patch('c', [{'op': 'replace', 'path': '/label', 'value': 'v1'}])
+    assert store.pin({'part': {'config_id': 'c'}})['part']['version'] == 1
+    with pytest.raises(ValueError):
+        store.pin({'config_id': 'c', 'version': 0})
+    with pytest.raises(ValueError):
+        store.patch('c', [{'op': 'replace', 'path': '/label', 'value': 'v2'}], version=0)
+
+#Digest
+
+def test_digest_ignores_key_order():
+    assert hexdigest({'a': 1, 'b': [1, {'c': 2}]}) == hexdigest({'b': [1, {'c': 2}], 'a': 1})
+    assert hexdigest({'a': 1}) != hexdigest({'a': 1.0})
+    assert hexdigest({'a': [1, 2]}) != hexdigest({'a': [2, 1]})
+
+def test_invalidate_matches_fresh_digest():
+    tree = MerkleTree()
+    document = config()
+    tree.digest(document)
+    patches = [
+        {'op': 'replace', 'path': '/children/0/children/0/width/value', 'value': 1.5},
+        {'op': 'add', 'path': '/children/0', 'value': assembly('inserted')},
+        {'op': 'remove', 'path': '/children/1/tags/0'},
+        {'op': 'move', 'from': '/children/2', 'path': '/tool/spare'},
+        {'op': 'copy', 'from': '/tool', 'path': '/children/0/tool'},
+        {'op': 'add', 'path': '/new', 'value': {'nested': [1, 2]}},
+        {'op': 'remove', 'path': '/new/nested/1'},
+        {'op': 'replace', 'path': '', 'value': assembly('replaced', [assembly('child')])},
+        {'op': 'replace', 'path': '/children/0/label', 'value': 'after root'},
+    ]
+    for operation in patches:
+        document, paths = apply_operation(document, operation)
+        for path in paths:
+            tree.invalidate(path)
+        assert tree.hexdigest(document) == hexdigest(document)
+
+def test_live_digest_rehashes_changed_path():
+    live = LiveConfig('c', config(), deserializer=make_deserializer())
+    live.digest()
+    hashed = live.merkle.hashed
+    live.patch([{'op': 'replace', 'path': '/children/1/width/value', 'value': 4.0}])
+    assert live.digest() == hexdigest(live.document)
+    #the width parameter, its assembly, the children list and the root
+    assert live.merkle.hashed - hashed <= 4
@@ -0,0 +1,66 @@
+'''
+    The HierarchyIndex stays correct as the class registry imports class modules lazily, and is kept
+    while other modules are imported.
+
+    usage: python -m pytest tests
+'''
+import importlib
+import os
+import sys
+
+import pytest
+
+sys.path.append(os.path.join(os.path.dirname(__file__),'..'))
+from server.class_registry import ClassRegistry
+from server.hierarchy import HierarchyIndex
+
+def subclasses(parent:type) -> list:
+    return parent.__subclasses__()
+
+@pytest.fixture
+def registry(tmp_path, monkeypatch, request):
+    #a package name per test, so every test imports its modules afresh
+    package = f'hierarchy_{request.node.name}'
+    os.makedirs(tmp_path / package)
+    (tmp_path / package / '__init__.py').write_text('')
+    (tmp_path / package / 'base.py').write_text('class Base():\n    pass\n')
+    (tmp_path / package / 'child.py').write_text(f'from {package}.base import Base\n\nclass Child(Base):\n    pass\n')
+    monkeypatch.syspath_prepend(str(tmp_path))
+    yield ClassRegistry(root=str(tmp_path), class_packages=(package,), route_packages=(), cache_path=str(tmp_path / 'registry.json'))
+    for module in [name for name in sys.modules if name.startswith(package)]:
+        del sys.modules[module]
+
+def test_lazy_import_drops_index(registry):
+    index = HierarchyIndex(subclasses, registry)
+    base = registry.get_class('Base')
+    assert index.subclasses(base) == ()
+    assert index.subclasses(base) == ()
+    assert index.hits == 1
+
+    child = registry.get_class('Child')
+    assert index.subclasses(base) == (child,)
+    assert index.concrete(base) == (child,)
+
+def test_index_kept_when_other_modules_are_imported(registry):
+    index = HierarchyIndex(subclasses, registry)
+    base = registry.get_class('Base')
+    index.subclasses(base)
+    rebuilds = index.rebuilds
+    importlib.import_module('xml.dom.minidom')
+    #modules already imported are not imported again
+    registry.get_class('Base')
+    index.subclasses(base)
+    assert index.rebuilds == rebuilds
+    assert index.hits == 1
+
+def test_classes_created_at_runtime(registry):
+    index = HierarchyIndex(subclasses, registry)
+    base = registry.get_class('Base')
+    assert index.subclasses(base) == ()
+    created = type('Created', (base,), {})
+    registry.classes_changed()
+    assert index.subclasses(base) == (created,)
+
+    other = type('Other', (base,), {})
+    index.invalidate()
+    assert index.subclasses(base) == (created, other)
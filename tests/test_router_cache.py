@@ -0,0 +1,64 @@
+'''
+    The ResultCache of the Router: answers of @cached handlers are kept until the class registry rescans
+    the source tree, the same as the other caches built from the class hierarchy.
+
+    usage: python -m pytest tests
+'''
+import asyncio
+import os
+import sys
+
+import orjson
+import pytest
+
+sys.path.append(os.path.join(os.path.dirname(__file__),'..'))
+pytest.importorskip('utils.decorators')
+from utils.decorators import route_handlers
+from server.config_store import ConfigStore
+from server.execution import INLINE, ExecutionPool
+from server.metrics import Metrics
+from server.router import ResultCache, Router, cached
+
+class Registry():
+    '''
+        Stands in for the ClassRegistry, its generation is bumped by the tests
+    '''
+    def __init__(self) -> None:
+        self.generation = 1
+
+DESCRIPTIONS = {'Tool': 'a tool'}
+
+@cached
+def describe(uuid, request):
+    return {request: DESCRIPTIONS[request]}
+
+@pytest.fixture
+def router(monkeypatch):
+    monkeypatch.setitem(route_handlers, 'test.describe', describe)
+    monkeypatch.setitem(DESCRIPTIONS, 'Tool', 'a tool')
+    return Router(pool=ExecutionPool(process_workers=1), execution_modes={'test.describe': INLINE}, cache=ResultCache(),
+                  metrics=Metrics(), configs=ConfigStore(), classes=Registry())
+
+def call(router:Router, value):
+    return orjson.loads(bytes(asyncio.run(router.call('test.describe', 'u', value))))
+
+def test_cache_cleared_on_rescan(router):
+    assert call(router, 'Tool') == {'Tool': 'a tool'}
+    DESCRIPTIONS['Tool'] = 'a changed tool'
+    #answered from the cache while the class hierarchy is unchanged
+    assert call(router, 'Tool') == {'Tool': 'a tool'}
+    assert router.cache.hits == 1
+
+    router.classes.generation += 1
+    assert call(router, 'Tool') == {'Tool': 'a changed tool'}
+    assert router.cache.hits == 1
+    assert call(router, 'Tool') == {'Tool': 'a changed tool'}
+    assert router.cache.hits == 2
+
+def test_result_across_rescan_not_kept(router, monkeypatch):
+    def rescanning(uuid, request):
+        router.classes.generation += 1
+        return describe(uuid, request)
+    monkeypatch.setitem(route_handlers, 'test.describe', cached(rescanning))
+    assert call(router, 'Tool') == {'Tool': 'a tool'}
+    assert len(router.cache.entries) == 0